@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""Offline benchmark of the scraper, runs process_dir over synthetic symbol lists against
+fake_finance_server.py and reports symbols/sec, latency percentiles per stage, bytes served per page and peak RSS.
+Each scenario runs in a fresh process so the RSS and the module globals are its own.
+usage: benchmark.py [save] [browsers] [scenario name ...]
+'save' stores the results as the baselines, otherwise results are compared with them.
+'browsers' also runs the scenarios that drive Firefox, they need Firefox and geckodriver"""
+
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+## GLOBAL CONSTANTS
+BASELINES_FULLPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks',
+                                  'baselines.json')
+REGRESSION_TOLERANCE = 0.2 # fraction worse than the baseline that counts as a regression
+MIN_REGRESSION_SEC = 0.01 # stage latencies closer than this to the baseline are noise, eg an fsync
+PERCENTILES = [50, 95, 99]
+STAGES = ['symbol', 'start browser', 'load page', 'wait for page', 'click', 'summary',
+          'income statement', 'balance sheet', 'write results']
+UNLISTED_SHARE = 0.05 # symbols in the lists the fake server does not know
+CANADIAN_SHARE = 0.2 # symbols in a ca_ list
+# (name, workload), latency is the fake server's response time in sec, a workload
+# 'not_slower_than' another scenario of the same run is a regression when it is
+SCENARIOS = [('sequential', {'symbols': 50, 'num_workers': 1, 'worker_type': 'thread',
+                             'latency': 0.02, 'error_rate': 0.0}),
+             ('sequential without prefetch', {'symbols': 50, 'num_workers': 1,
+                                              'worker_type': 'thread', 'latency': 0.02,
+                                              'error_rate': 0.0, 'prefetch_depth': 0}),
+             ('threads', {'symbols': 500, 'num_workers': 8, 'worker_type': 'thread',
+                          'latency': 0.02, 'error_rate': 0.0}),
+             ('processes', {'symbols': 500, 'num_workers': 4, 'worker_type': 'process',
+                            'latency': 0.02, 'error_rate': 0.0}),
+             ('threads large', {'symbols': 2000, 'num_workers': 16, 'worker_type': 'thread',
+                                'latency': 0.02, 'error_rate': 0.0}),
+             ('threads with errors', {'symbols': 500, 'num_workers': 8, 'worker_type': 'thread',
+                                      'latency': 0.02, 'error_rate': 0.05,
+                                      'not_slower_than': 'threads with errors, fixed'}),
+             ('threads with errors, fixed', {'symbols': 500, 'num_workers': 8,
+                                             'worker_type': 'thread', 'latency': 0.02,
+                                             'error_rate': 0.05, 'adaptive': False}),
+             # pages embed images, styles, fonts and a third party ad, see fake_finance_server
+             ('firefox default', {'symbols': 20, 'num_workers': 1, 'worker_type': 'thread',
+                                  'latency': 0.02, 'error_rate': 0.0, 'fetcher': 'selenium',
+                                  'profile': 'default'}),
+             ('firefox lean', {'symbols': 20, 'num_workers': 1, 'worker_type': 'thread',
+                               'latency': 0.02, 'error_rate': 0.0, 'fetcher': 'selenium',
+                               'profile': 'lean'})]
+
+def write_symbol_lists(data_dir_name, num_symbols):
+    """Writes an American and a Canadian list of num_symbols symbols in total,
+    returns the listings for the fake server"""
+    rng = random.Random(num_symbols)
+    listings = dict()
+    symbol_lists = {'us_symbols.csv': [], 'ca_symbols.csv': []}
+    for number in xrange(num_symbols):
+        symbol = 'SYM{}'.format(number)
+        canadian = rng.random() < CANADIAN_SHARE
+        symbol_lists['ca_symbols.csv' if canadian else 'us_symbols.csv'].append(symbol)
+        if rng.random() >= UNLISTED_SHARE:
+            listings[symbol] = rng.choice(['TSE', 'CVE'] if canadian else ['NASDAQ', 'NYSE'])
+    os.makedirs(data_dir_name)
+    for filename, symbols in symbol_lists.items():
+        with open(os.path.join(data_dir_name, filename), 'w') as list_file:
+            list_file.write('Symbol\n' + ''.join(symbol + '\n' for symbol in symbols))
+    return listings
+
+def peak_rss_mb(who):
+    """Peak resident memory of resource.RUSAGE_SELF or the largest of RUSAGE_CHILDREN"""
+    return resource.getrusage(who).ru_maxrss / 1024.0 # kB on Linux
+
+def run_scenario(workload):
+    """Scrapes the workload's symbols from a fake server in a temp dir, returns the measures"""
+    import stock_scrape
+    import fake_finance_server
+
+    work_dir_name = tempfile.mkdtemp(prefix='benchmark_')
+    server = None
+    stdout = sys.stdout
+    try:
+        listings = write_symbol_lists(os.path.join(work_dir_name, 'data'), workload['symbols'])
+        fetcher_type = workload.get('fetcher', 'http')
+        server = fake_finance_server.FakeFinanceServer(listings, latency=workload['latency'],
+                                                       error_rate=workload['error_rate'],
+                                                       resources=fetcher_type == 'selenium')
+        server.start()
+        stock_scrape.BASE_URL = server.base_url
+        stock_scrape.FETCHER_TYPE = fetcher_type
+        stock_scrape.BROWSER_PROFILE = workload.get('profile', 'default')
+        stock_scrape.PREFETCH_DEPTH = workload.get('prefetch_depth', stock_scrape.PREFETCH_DEPTH)
+        stock_scrape.ADAPTIVE_CONCURRENCY = workload.get('adaptive',
+                                                         stock_scrape.ADAPTIVE_CONCURRENCY)
+        sys.stdout = open(os.devnull, 'w') # the scraper's progress output
+        start_time = time.time()
+        stock_scrape.process_dir(os.path.join(work_dir_name, 'data'),
+                                 os.path.join(work_dir_name, 'logs'),
+                                 os.path.join(work_dir_name, 'results'),
+                                 workload['num_workers'], workload['worker_type'], None)
+        elapsed = time.time() - start_time
+    finally:
+        sys.stdout = stdout
+        if server:
+            server.stop()
+        shutil.rmtree(work_dir_name, True)
+
+    stages = dict()
+    for stage in STAGES:
+        if stock_scrape.STAGE_TIMER.count(stage):
+            stages[stage] = {'p{}'.format(percent):
+                             stock_scrape.STAGE_TIMER.percentile(stage, percent)
+                             for percent in PERCENTILES}
+    page_loads = stock_scrape.STAGE_TIMER.count('load page')
+    return {'symbols': workload['symbols'],
+            'elapsed sec': elapsed,
+            'symbols per sec': workload['symbols'] / elapsed,
+            'scrape errors': stock_scrape.TALLY.snapshot().get('scrape errors', 0),
+            'adaptive backoffs': stock_scrape.TALLY.snapshot().get('adaptive backoffs', 0),
+            'errors served': server.errors_served,
+            'requests served': server.requests_served,
+            'bytes per page': server.bytes_served / float(page_loads) if page_loads else 0.0,
+            'peak rss mb': peak_rss_mb(resource.RUSAGE_SELF),
+            'peak worker rss mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+            'stages': stages}
+
+def run_scenario_in_subprocess(name):
+    """Runs the scenario called name in a fresh python process, returns its measures"""
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run', name])
+    return json.loads(output.splitlines()[-1])
+
+def load_baselines():
+    """Saved measures per scenario name, empty if there are none yet"""
+    if not os.path.exists(BASELINES_FULLPATH):
+        return dict()
+    with open(BASELINES_FULLPATH, 'r') as baselines_file:
+        return json.load(baselines_file)
+
+def save_baselines(baselines):
+    """Saves the measures per scenario name as the new baselines"""
+    if not os.path.exists(os.path.dirname(BASELINES_FULLPATH)):
+        os.makedirs(os.path.dirname(BASELINES_FULLPATH))
+    with open(BASELINES_FULLPATH, 'w') as baselines_file:
+        json.dump(baselines, baselines_file, indent=1, sort_keys=True)
+
+def find_regressions(result, baseline):
+    """Measures of result worse than baseline by more than REGRESSION_TOLERANCE"""
+    regressions = []
+    if result['symbols per sec'] < baseline['symbols per sec'] * (1 - REGRESSION_TOLERANCE):
+        regressions.append('symbols per sec {:.1f} vs {:.1f}'.\
+            format(result['symbols per sec'], baseline['symbols per sec']))
+    if result['bytes per page'] > baseline.get('bytes per page', float('inf')) * \
+            (1 + REGRESSION_TOLERANCE):
+        regressions.append('{:.0f} KB per page vs {:.0f} KB'.\
+            format(result['bytes per page'] / 1024, baseline['bytes per page'] / 1024))
+    if result.get('adaptive backoffs', 0) > baseline.get('adaptive backoffs', 0):
+        regressions.append('{} adaptive backoffs vs {}'.\
+            format(result['adaptive backoffs'], baseline.get('adaptive backoffs', 0)))
+    if result['peak rss mb'] > baseline['peak rss mb'] * (1 + REGRESSION_TOLERANCE):
+        regressions.append('peak rss {:.0f} MB vs {:.0f} MB'.\
+            format(result['peak rss mb'], baseline['peak rss mb']))
+    for stage, percentiles in result['stages'].items():
+        baseline_p95 = baseline['stages'].get(stage, {}).get('p95')
+        if baseline_p95 and percentiles['p95'] > baseline_p95 * (1 + REGRESSION_TOLERANCE) and \
+                percentiles['p95'] - baseline_p95 > MIN_REGRESSION_SEC:
+            regressions.append('{} p95 {:.1f} ms vs {:.1f} ms'.\
+                format(stage, percentiles['p95'] * 1000, baseline_p95 * 1000))
+    return regressions
+
+def report(name, result):
+    """Readable summary of one scenario's measures"""
+    lines = ['{}: {} symbols in {:.1f} sec, {:.1f} symbols/sec, peak RSS {:.0f} MB '
+             '(workers {:.0f} MB), {} scrape errors, {} adaptive backoffs'.\
+             format(name, result['symbols'], result['elapsed sec'], result['symbols per sec'],
+                    result['peak rss mb'], result['peak worker rss mb'], result['scrape errors'],
+                    result['adaptive backoffs']),
+             '  {:.0f} KB served per page load, {} requests'.\
+             format(result['bytes per page'] / 1024, result['requests served'])]
+    for stage in STAGES:
+        if stage in result['stages']:
+            lines.append('  {:<18}'.format(stage) + '  '.join(
+                'p{} {:7.1f} ms'.format(percent, result['stages'][stage]['p{}'.format(percent)]
+                                        * 1000) for percent in PERCENTILES))
+    return '\n'.join(lines)
+
+def main():
+    """Runs the scenarios named on the command line, all of them by default"""
+    if len(sys.argv) > 2 and sys.argv[1] == '--run': # inside the scenario's own process
+        print json.dumps(run_scenario(dict(SCENARIOS)[sys.argv[2]]))
+        return
+
+    arguments = sys.argv[1:]
+    save = 'save' in arguments
+    browsers = 'browsers' in arguments
+    names = [argument for argument in arguments if argument not in ('save', 'browsers')] or \
+        [name for name, workload in SCENARIOS
+         if browsers or workload.get('fetcher', 'http') != 'selenium']
+    baselines = load_baselines()
+    results = dict()
+    regression_count = 0
+    for name in names:
+        result = results[name] = run_scenario_in_subprocess(name)
+        print report(name, result)
+        if name in baselines and not save:
+            regressions = find_regressions(result, baselines[name])
+            for regression in regressions:
+                print "  REGRESSION", regression
+            regression_count += len(regressions)
+        baselines[name] = result
+        sys.stdout.flush()
+    for name in names: # scenarios measured against another one of this run
+        other_name = dict(SCENARIOS)[name].get('not_slower_than')
+        if other_name in results and results[name]['symbols per sec'] < \
+                results[other_name]['symbols per sec'] * (1 - REGRESSION_TOLERANCE):
+            print "REGRESSION {} {:.1f} symbols/sec vs {:.1f} for {}".\
+                format(name, results[name]['symbols per sec'],
+                       results[other_name]['symbols per sec'], other_name)
+            regression_count += 1
+    if save:
+        save_baselines(baselines)
+        print "Saved baselines in", BASELINES_FULLPATH
+    sys.exit(1 if regression_count else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Local stand-in for Google Finance, serves synthetic summary and financials pages
+with the same layout the scraper's XPaths expect, so the scraper can run offline.
+Point stock_scrape.BASE_URL at server.base_url to use it."""
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import urlparse
+import random
+import cgi
+import sys
+import time
+
+## PAGE LAYOUT CONSTANTS
+# (label, is_hilite) in the order Google Finance listed the rows
+INCOME_STATEMENT_ROWS = [('Revenue', False), ('Other Revenue, Total', False),
+                         ('Total Revenue', True), ('Cost of Revenue, Total', False),
+                         ('Gross Profit', True), ('Selling/General/Admin. Expenses, Total', False),
+                         ('Research & Development', False), ('Depreciation/Amortization', False),
+                         ('Interest Expense(Income) - Net Operating', False),
+                         ('Unusual Expense (Income)', False), ('Other Operating Expenses, Total', False),
+                         ('Total Operating Expense', True), ('Operating Income', True),
+                         ('Interest Income(Expense), Net Non-Operating', False),
+                         ('Gain (Loss) on Sale of Assets', False), ('Other, Net', False),
+                         ('Income Before Tax', True), ('Income After Tax', True),
+                         ('Minority Interest', False), ('Equity In Affiliates', False),
+                         ('Net Income Before Extra. Items', True), ('Accounting Change', False),
+                         ('Discontinued Operations', False), ('Extraordinary Item', False),
+                         ('Net Income', True)]
+BALANCE_SHEET_ROWS = [('Cash & Equivalents', False), ('Short Term Investments', False),
+                      ('Cash and Short Term Investments', False),
+                      ('Accounts Receivable - Trade, Net', False), ('Receivables - Other', False),
+                      ('Total Receivables, Net', False), ('Total Inventory', False),
+                      ('Prepaid Expenses', False), ('Other Current Assets, Total', False),
+                      ('Total Current Assets', True),
+                      ('Property/Plant/Equipment, Total - Gross', False),
+                      ('Accumulated Depreciation, Total', False), ('Goodwill, Net', False),
+                      ('Intangibles, Net', False), ('Long Term Investments', False),
+                      ('Other Long Term Assets, Total', False), ('Total Assets', True),
+                      ('Accounts Payable', False), ('Accrued Expenses', False),
+                      ('Notes Payable/Short Term Debt', False),
+                      ('Current Port. of LT Debt/Capital Leases', False),
+                      ('Other Current liabilities, Total', False),
+                      ('Total Current Liabilities', True), ('Long Term Debt', False),
+                      ('Capital Lease Obligations', False), ('Total Long Term Debt', True),
+                      ('Total Debt', True), ('Deferred Income Tax', False),
+                      ('Minority Interest', False), ('Other Liabilities, Total', False),
+                      ('Total Liabilities', True), ('Redeemable Preferred Stock, Total', False),
+                      ('Preferred Stock - Non Redeemable, Net', False),
+                      ('Common Stock, Total', False), ('Additional Paid-In Capital', False),
+                      ('Retained Earnings (Accumulated Deficit)', False),
+                      ('Treasury Stock - Common', False), ('ESOP Debt Guarantee', False),
+                      ('Unrealized Gain (Loss)', False), ('Other Equity, Total', False),
+                      ('Total Equity', True), ("Total Liabilities & Shareholders' Equity", True),
+                      ('Shares Outs - Common Stock Primary Issue', False),
+                      ('Total Common Shares Outstanding', False)]
+CASH_FLOW_ROWS = [('Net Income/Starting Line', False), ('Depreciation/Depletion', False),
+                  ('Cash from Operating Activities', True), ('Capital Expenditures', False),
+                  ('Cash from Investing Activities', True), ('Cash from Financing Activities', True),
+                  ('Net Change in Cash', True)]
+
+BODY_WRAPPER = """<html><head><title>{title}</title></head><body>
+<div class="fjfe-bodywrapper"><div id="fjfe-real-body"><div id="fjfe-click-wrapper">
+{appbar}
+<div class="elastic"><div id="app"><div id="gf-viewc"><div class="fjfe-content">
+{content}
+</div></div></div></div>
+</div></div></div></body></html>"""
+
+APPBAR = """<div id="appbar"><div class="elastic"><div class="appbar-center">
+<div class="appbar-snippet-primary"><span>{name}</span></div>
+<div class="appbar-snippet-secondary"><span>({exchange}:{symbol})</span></div>
+</div></div></div>"""
+
+SUMMARY_CONTENT = """<div class="g-wrap">
+<div class="g-section g-tpl-right-1"><div class="g-unit"><div id="market-data-div">
+<div class="snap-panel-and-plusone"><div class="snap-panel">
+<table class="snap-data"><tbody>
+<tr><td class="key">Range</td><td class="val">{low:.2f} - {high:.2f}</td></tr>
+<tr><td class="key">52 week</td><td class="val">{low:.2f} - {high:.2f}</td></tr>
+<tr><td class="key">Open</td><td class="val">{price:.2f}</td></tr>
+<tr><td class="key">Vol / Avg.</td><td class="val">1.20M/3.40M</td></tr>
+<tr><td class="key">Mkt cap</td><td class="val">{market_cap}</td></tr>
+<tr><td class="key">P/E</td><td class="val">{pe:.2f}</td></tr>
+</tbody></table>
+<table class="snap-data"><tbody>
+<tr><td class="key">Div/yield</td><td class="val">-</td></tr>
+</tbody></table>
+</div></div></div></div></div>
+<div class="g-section g-tpl-right-1 sfe-break-top-5"><div class="g-unit g-first"><div class="g-c">
+<div class="sfe-section"><table class="quotes rgt nwp"><tbody>
+<tr><th></th><th class="period">Q</th><th class="period">Y</th></tr>
+<tr><td class="title">Net profit margin</td><td class="period">12.10%</td><td class="period">11.50%</td></tr>
+<tr><td class="title">Operating margin</td><td class="period">15.30%</td><td class="period">14.90%</td></tr>
+<tr><td class="title">Return on average assets</td><td class="period">6.10%</td><td class="period">5.80%</td></tr>
+<tr><td class="title">Return on average equity</td><td class="period">13.20%</td><td class="period">12.70%</td></tr>
+<tr><td class="title">Employees</td><td class="period">{employees}</td><td class="period"></td></tr>
+</tbody></table></div>
+<div class="sfe-section">{address}<br>{country}</div>
+</div></div></div>
+</div>"""
+
+NOT_FOUND_CONTENT = """<div class="g-wrap"><div class="g-section">
+Your search - <b>{query}</b> - produced no matches.</div></div>"""
+
+FINANCIALS_CONTROLS = """<div id="fs-type-tabs">
+<div id=":0"><a class="t"><b class="t"><b class="t">Income Statement</b></b></a></div>
+<div id=":1"><a class="t"><b class="t"><b class="t">Balance Sheet</b></b></a></div>
+<div id=":2"><a class="t"><b class="t"><b class="t">Cash Flow</b></b></a></div>
+</div>
+<div class="gf-table-control-plain"><div class="g-section g-tpl-67-33 g-split">
+<div class="g-unit g-first"><a id="interim" href="javascript:void(0)">Quarterly Data</a> |
+<a id="annual" href="javascript:void(0)">Annual Data</a></div></div></div>"""
+
+
+def fake_number(rng, scale):
+    """Random amount around scale, formatted like Google Finance tables eg 1,234.00"""
+    return '{:,.2f}'.format(rng.uniform(0.2, 1.0) * scale)
+
+def statement_table(div_id, rows, period_dates, rng, multiplier_text):
+    """Builds one fs-table, the first period column is the most recent"""
+    header_cells = ['<th class="lm lft nwp">{}</th>'.format(multiplier_text)]
+    for column, period_date in enumerate(period_dates):
+        css_class = 'rgt rm' if column == len(period_dates) - 1 else 'rgt'
+        header_cells.append('<th class="{}">12 months ending {}</th>'.format(css_class,
+                                                                           period_date))
+    body_rows = []
+    for label, is_hilite in rows:
+        cells = ['<td class="lft lm{}">{}</td>'.format(' bld' if is_hilite else '',
+                                                       cgi.escape(label))]
+        for column in xrange(len(period_dates)):
+            css_class = 'r bld' if is_hilite else 'r'
+            if column == len(period_dates) - 1:
+                css_class += ' rm'
+            value = '-' if rng.random() < 0.05 else fake_number(rng, 100000)
+            cells.append('<td class="{}">{}</td>'.format(css_class, value))
+        body_rows.append('<tr{}>{}</tr>'.format(' class="hilite"' if is_hilite else '',
+                                                ''.join(cells)))
+    return '<div id="{}"><table id="fs-table"><thead><tr>{}</tr></thead><tbody>{}</tbody>' \
+           '</table></div>'.format(div_id, ''.join(header_cells), ''.join(body_rows))
+
+def summary_page(symbol, exchange, name, rng):
+    """Summary page of a listed symbol"""
+    price = rng.uniform(5, 500)
+    content = SUMMARY_CONTENT.format(low=price * 0.8, high=price * 1.2, price=price,
+                                     market_cap='{:.2f}B'.format(rng.uniform(0.1, 800)),
+                                     pe=rng.uniform(5, 60),
+                                     employees='{:,}'.format(rng.randint(10, 200000)),
+                                     address='1 Main Street',
+                                     country='Canada' if exchange in ('TSE', 'CVE')
+                                     else 'United States')
+    return BODY_WRAPPER.format(title=name, appbar=APPBAR.format(name=cgi.escape(name),
+                                                                exchange=exchange,
+                                                                symbol=symbol),
+                               content=content)
+
+def financials_page(symbol, exchange, name, rng, num_years):
+    """Financials page, like Google Finance it holds every statement and the tabs
+    only switch which one is visible"""
+    annual_dates = ['{}-12-31'.format(2016 - year) for year in xrange(num_years)]
+    interim_dates = ['2016-{:02d}-30'.format(month) for month in (12, 9, 6, 3, 1)]
+    multiplier_text = 'In Millions of USD (except for per share items)'
+    tables = []
+    for prefix, rows in (('inc', INCOME_STATEMENT_ROWS), ('bal', BALANCE_SHEET_ROWS),
+                         ('cas', CASH_FLOW_ROWS)):
+        tables.append(statement_table(prefix + 'interimdiv', rows, interim_dates, rng,
+                                      multiplier_text))
+        tables.append(statement_table(prefix + 'annualdiv', rows, annual_dates, rng,
+                                      multiplier_text))
+    return BODY_WRAPPER.format(title=name, appbar=APPBAR.format(name=cgi.escape(name),
+                                                                exchange=exchange,
+                                                                symbol=symbol),
+                               content=FINANCIALS_CONTROLS + '\n'.join(tables))
+
+# path -> (content type, size in bytes) of the static files pages embed with resources on,
+# like the charts, styles, fonts and ads of the real pages that the scraper never reads
+STATIC_RESOURCES = {'/static/finance.css': ('text/css', 24 * 1024),
+                    '/static/chart.png': ('image/png', 120 * 1024),
+                    '/static/roboto.woff2': ('font/woff2', 64 * 1024),
+                    '/ads/banner.js': ('application/javascript', 48 * 1024)}
+# the ad is loaded from localhost, a different host than the 127.0.0.1 pages are served from
+RESOURCE_HEAD = """<link rel="stylesheet" href="/static/finance.css">
+<style>@font-face { font-family: Roboto; src: url(/static/roboto.woff2); }
+body { font-family: Roboto; }</style>"""
+RESOURCE_BODY = """<img src="/static/chart.png" width="600" height="300">
+<script src="http://localhost:{port}/ads/banner.js"></script>"""
+
+def static_resource(path):
+    """Filler content of a STATIC_RESOURCES path"""
+    content_type, size = STATIC_RESOURCES[path]
+    if content_type == 'text/css':
+        rule = '.gf-filler {{ margin: 0; }}\n'
+        return content_type, (rule * (size // len(rule) + 1))[:size]
+    if content_type == 'application/javascript':
+        line = 'var gf_filler = 0;\n'
+        return content_type, (line * (size // len(line) + 1))[:size]
+    return content_type, '\0' * size
+
+ERROR_PAGE = '<html><head><title>Error</title></head><body>Server Error</body></html>'
+
+def not_found_page(query):
+    """Search page for a symbol that is not listed on the requested exchange"""
+    return BODY_WRAPPER.format(title='Search', appbar='',
+                               content=NOT_FOUND_CONTENT.format(query=cgi.escape(query)))
+
+
+class FakeFinanceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers /finance?q=[EXCHANGE:]SYMBOL[&fstype=ii] from the server's listings"""
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def do_GET(self):
+        parsed_url = urlparse.urlsplit(self.path)
+        query = urlparse.parse_qs(parsed_url.query)
+        if self.server.resources and parsed_url.path in STATIC_RESOURCES:
+            content_type, body = static_resource(parsed_url.path)
+            self.send_body(200, content_type, body)
+            return
+        self.server.delay()
+        if self.server.inject_error():
+            self.send_page(500, ERROR_PAGE)
+            return
+        if parsed_url.path != '/finance' or 'q' not in query:
+            self.send_page(404, not_found_page(self.path))
+            return
+        page = self.server.render(query['q'][0], query.get('fstype', [''])[0])
+        if self.server.resources:
+            page = page.replace('</head>', RESOURCE_HEAD + '</head>', 1).replace(
+                '</body>', RESOURCE_BODY.format(port=self.server.server_address[1]) + '</body>', 1)
+        self.send_page(200, page)
+
+    def send_page(self, status, page):
+        """Sends page as utf-8 html"""
+        self.send_body(status, 'text/html; charset=utf-8', page.encode('utf-8'))
+
+    def send_body(self, status, content_type, body):
+        """Sends body, counting it in the server's bytes_served"""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count_served(len(body))
+
+    def log_message(self, format, *args):
+        """Quiet, the scraper prints its own progress"""
+        pass
+
+class FakeFinanceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded stand-in server, listings maps symbol to exchange eg {'AAPL': 'NASDAQ'}
+    Symbols without an exchange in the query are found on their listed exchange.
+    Every response is delayed by latency sec, or a random time in a (min, max) latency,
+    and error_rate of the requests are answered with a server error.
+    With resources pages embed STATIC_RESOURCES like a browser would load them.
+    requests_served and bytes_served count the responses and their body bytes"""
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, listings, port=0, num_years=4, latency=0.0, error_rate=0.0,
+                 resources=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), FakeFinanceHandler)
+        self.listings = listings
+        self.num_years = num_years
+        self.latency = latency
+        self.error_rate = error_rate
+        self.resources = resources
+        self.errors_served = 0
+        self.requests_served = 0
+        self.bytes_served = 0
+        self._count_lock = threading.Lock()
+        self._thread = None
+
+    def delay(self):
+        """Sleeps for the injected latency"""
+        if isinstance(self.latency, tuple):
+            time.sleep(random.uniform(*self.latency))
+        elif self.latency:
+            time.sleep(self.latency)
+
+    def inject_error(self):
+        """True for the requests picked to fail"""
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors_served += 1
+            return True
+        return False
+
+    def count_served(self, num_bytes):
+        """Counts a response of num_bytes"""
+        with self._count_lock:
+            self.requests_served += 1
+            self.bytes_served += num_bytes
+
+    @property
+    def base_url(self):
+        """Use in place of stock_scrape.BASE_URL"""
+        return 'http://127.0.0.1:{}/finance?q='.format(self.server_address[1])
+
+    def render(self, query, fstype):
+        """Page for a q= query, fstype 'ii' is the financials page"""
+        if ':' in query:
+            exchange, symbol = query.split(':', 1)
+        else:
+            exchange, symbol = None, query
+        listed_exchange = self.listings.get(symbol)
+        if not listed_exchange or (exchange and exchange != listed_exchange):
+            return not_found_page(query)
+
+        rng = random.Random(symbol) # same numbers for a symbol on every load
+        name = '{} Corporation'.format(symbol.title())
+        if fstype == 'ii':
+            return financials_page(symbol, listed_exchange, name, rng, self.num_years)
+        return summary_page(symbol, listed_exchange, name, rng)
+
+    def start(self):
+        """Serve from a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket"""
+        self.shutdown()
+        self.server_close()
+
+def main():
+    """Serve listings from a symbols csv (symbol,exchange per row) until interrupted,
+    usage: fake_finance_server.py [listings.csv] [port] [latency sec] [error rate]"""
+    listings = dict()
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rU') as listings_file:
+            for line in listings_file:
+                fields = [field.strip() for field in line.split(',')]
+                if len(fields) >= 2 and fields[0]:
+                    listings[fields[0]] = fields[1]
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    error_rate = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+    server = FakeFinanceServer(listings, port, latency=latency, error_rate=error_rate)
+    print "Serving {} symbols at {}".format(len(listings), server.base_url)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,37 @@
 
 import re
 import datetime as datetime
-from random import randint
 import time
 import csv
 import os
 import sys
+import threading
+import contextlib
+import collections
+import bisect
+import Queue
+import urlparse
+import urllib
+import multiprocessing
+import multiprocessing.pool
+import multiprocessing.util
+import httplib
+import socket
+import zlib
+import hashlib
+import json
+import fcntl
+import struct
+import sqlite3
+import StringIO
+from lxml import html as lxml_html
+from lxml import etree as lxml_etree
 from selenium import webdriver
+from selenium.common.exceptions import NoSuchElementException, WebDriverException
+try:
+    import numpy
+except ImportError: # only the columnar output needs numpy
+    numpy = None
 
 ## GLOBAL CONSTANTS
 NASDAQ = "NASDAQ"
@@ -17,335 +42,1605 @@ NYSE = "NYSE"
 TSE = "TSE"
 CVE = "CVE"
 RESULT_MULTIPLIER = "K"
+NUM_WORKERS = 1 # browsers scraping in parallel
+WORKER_TYPE = 'thread' # 'thread' or 'process'
+MAX_REQUESTS_PER_SEC = 0.5 # page loads per host across all workers, None for no cap
+FETCHER_TYPE = 'selenium' # 'selenium' drives Firefox, 'http' fetches pages and parses them with lxml
+BASE_URL = 'https://www.google.com/finance?q=' # point at a stand-in server for offline runs
+BROWSER_PROFILE = 'default' # 'lean' runs Firefox headless without images, media, fonts and
+                            # third party hosts
+LEAN_PROFILE_ALLOWED_HOSTS = ['google.com', 'gstatic.com'] # and their subdomains, BASE_URL's
+                                                           # host is always allowed
+LEAN_PROFILE_DISK_CACHE_KB = 256 * 1024 # Firefox disk cache of the lean profile
+BROWSER_TABS = 1 # tabs per Firefox session with worker threads, each tab scrapes its own symbol
+EXCHANGE_CACHE_TTL = 30 * 24 * 3600 # sec to trust the exchange a symbol was found on
+EXCHANGE_CACHE_NEGATIVE_TTL = 3 * 24 * 3600 # sec to skip a symbol that was not found
+PAGE_CACHE_DIR = None # on-disk cache of fetched pages, eg 'cache' to re-run a run without fetching again
+PAGE_CACHE_TTL = 7 * 24 * 3600 # sec a cached page is served for
+PAGE_CACHE_MAX_BYTES = 2 * 1024 ** 3 # least recently used pages are evicted beyond this
+HOST_RATE_LIMITS = {} # host -> page loads per sec, overrides MAX_REQUESTS_PER_SEC for that host
+RATE_LIMIT_BURST = 1 # page loads a host may get at once before the rate limit kicks in
+MAX_IN_FLIGHT = 32 # concurrent requests of the fetch_pages pipeline, the Prefetcher keeps
+                   # PREFETCH_DEPTH
+PREFETCH_DEPTH = 4 # symbols ahead of the one being scraped whose pages are fetched in the
+                   # background in sequential runs with FETCHER_TYPE 'http', 0 for none
+RESULT_BATCH_ROWS = 50 # result rows written to a results file at once
+RESULT_FLUSH_SEC = 30 # sec at most between writes of the buffered result rows
+COLUMNAR_OUTPUT = False # also save each finished results file as typed numpy columns (needs numpy)
+FULL_STATEMENTS = False # also save every row and period of each statement per symbol (needs numpy)
+METRICS_EXPORT = 'jsonl' # stage timings to logs/metrics.jsonl, 'prometheus' for logs/metrics.prom
+SESSION_MAX_PAGES = 500 # pages a browser session loads before it is replaced, None for no limit
+SESSION_MAX_RSS_MB = 1500 # memory of a browser and its child processes that gets it replaced
+INCREMENTAL_REFRESH = False # reload statements only of symbols a new fiscal period is likely for
+FRESHNESS_FILING_LAG_DAYS = 60 # days after a fiscal year ends that its statements are expected
+FRESHNESS_RECHECK_DAYS = 7 # days between statement reloads while a new period is late
+FRESHNESS_MAX_AGE_DAYS = 120 # statements older than this are reloaded anyway, eg for restatements
+WORK_QUEUE_DB = None # shared SQLite work queue, eg logs/work_queue.db on a shared volume, lets
+                     # several nodes work the same lists, None keeps the per file checkpoints
+WORK_QUEUE_LEASE_SEC = 300 # a claimed symbol goes back to the queue if its node stops heartbeating
+WORK_QUEUE_MAX_ATTEMPTS = 3 # tries of a symbol before it is given up with what its last try scraped
+WORK_QUEUE_POLL_SEC = 10 # sec between claims while other nodes hold the last leases, workers waiting
+                         # on this node's own leases wake up once one of them is done
+WORK_QUEUE_CLAIM_BATCH = 5 # symbols a worker claims at once, fewer write transactions
+ADAPTIVE_CONCURRENCY = True # AIMD control of symbols scraped at once and of the request rate
+                            # from load latency and failures, NUM_WORKERS and rate caps at most
+ADAPTIVE_WINDOW = 40 # page loads per control decision
+ADAPTIVE_MAX_FAILURE_RATE = 0.25 # share of page loads in a window failing that halves both,
+                                 # well above the few percent retries take care of
+ADAPTIVE_MAX_LOAD_SEC = 8 # median page load in a window above this halves them too
+ADAPTIVE_RATE_STEP = 0.1 # fraction of the rate caps added back after a good window
+ADAPTIVE_MIN_RATE = 0.05 # lowest fraction of the rate caps to go down to
+ADAPTIVE_BACKOFF_SEC = 30 # pause after a decrease, doubles while decreases follow each other
+ADAPTIVE_MAX_BACKOFF_SEC = 600
+SCRAPE_MAX_ATTEMPTS = 3 # tries of a symbol whose pages failed to load before it is written as is
+SCRAPE_RETRY_SEC = 5 # wait before trying such a symbol again in sequential runs, doubles each try
+PAGE_READY_TIMEOUT = 15 # sec to wait for a page's content to show up
+PAGE_READY_POLL = 0.1 # sec between checks for a page's content
+SUMMARY_READY_XPATH = "//div[@id='appbar'] | //div[@id='gf-viewc']"
+FINANCIALS_READY_XPATH = "//table[@id='fs-table']"
+INCOME_STATEMENT_READY_XPATH = "//div[@id='incannualdiv']/table[@id='fs-table']"
+BALANCE_SHEET_READY_XPATH = "//div[@id='balannualdiv']/table[@id='fs-table']"
+SITE_PAGE_XPATH = "//div[@id='gf-viewc']" # every page of the site has it, eg not a block page
+PAGE_LOADED_SCRIPT = "return document.readyState == 'complete';"
 
 def return_base_url(stock_symbol, exchange=None):
     """Return string of the URL to visit given a stock symbol and stock exchange
     Stock exchange can be blank
     """
-    ## URL CONSTANTS
-    const_base_url = 'https://www.google.com/finance?q='
-
     if not exchange:
-        return const_base_url + stock_symbol
+        return BASE_URL + stock_symbol
         
     else:
-        return const_base_url + exchange + '%3A'+stock_symbol
+        return BASE_URL + exchange + '%3A'+stock_symbol
         
 def return_finance_url(stock_symbol, exchange):
     """Returns the path to the financials page from the main stock listing page,
     e.g. on Google Finance"""
     const_financial_url_path = '&fstype=ii'
     return return_base_url(stock_symbol, exchange) + const_financial_url_path
-def initialize_browser():
-    """Initialize browser"""
+def lean_profile_preferences(allowed_hosts):
+    """Firefox preferences of the 'lean' BROWSER_PROFILE. Requests to hosts other than
+    allowed_hosts and their subdomains go to a proxy that is not there, so they fail at once"""
+    proxy_autoconfig = """function FindProxyForURL(url, host) {{
+        var allowed = {};
+        for (var i = 0; i < allowed.length; i++) {{
+            if (host == allowed[i] || dnsDomainIs(host, '.' + allowed[i])) return 'DIRECT';
+        }}
+        return 'PROXY 127.0.0.1:9';
+    }}""".format(json.dumps(allowed_hosts))
+    return {'permissions.default.image': 2, # no images
+            'media.autoplay.enabled': False, 'media.autoplay.default': 5,
+            'media.preload.default': 0,
+            'gfx.downloadable_fonts.enabled': False, 'browser.display.use_document_fonts': 0,
+            'network.proxy.type': 2, # proxy autoconfig, blocks third party hosts
+            'network.proxy.autoconfig_url': 'data:text/javascript,' +
+                                            urllib.quote(proxy_autoconfig),
+            'network.proxy.allow_hijacking_localhost': True,
+            'network.cookie.cookieBehavior': 1, # no third party cookies
+            'network.prefetch-next': False, 'network.dns.disablePrefetch': True,
+            'network.http.speculative-parallel-limit': 0,
+            'browser.cache.disk.enable': True, 'browser.cache.memory.enable': True,
+            'browser.cache.disk.smart_size.enabled': False,
+            'browser.cache.disk.capacity': LEAN_PROFILE_DISK_CACHE_KB,
+            'app.update.enabled': False, 'browser.shell.checkDefaultBrowser': False,
+            'datareporting.healthreport.uploadEnabled': False,
+            'toolkit.telemetry.enabled': False}
+
+def initialize_browser(profile=None):
+    """Initialize browser, profile defaults to BROWSER_PROFILE"""
+    profile = profile or BROWSER_PROFILE
     ffprofile = webdriver.FirefoxProfile()
-    browser = webdriver.Firefox(firefox_profile=ffprofile)
+    if profile == 'lean':
+        allowed_hosts = LEAN_PROFILE_ALLOWED_HOSTS + [urlparse.urlsplit(BASE_URL).hostname]
+        for preference, value in lean_profile_preferences(allowed_hosts).items():
+            ffprofile.set_preference(preference, value)
+        ffoptions = webdriver.FirefoxOptions()
+        ffoptions.add_argument('-headless')
+        browser = webdriver.Firefox(firefox_profile=ffprofile, firefox_options=ffoptions)
+    elif profile == 'default':
+        browser = webdriver.Firefox(firefox_profile=ffprofile)
+    else:
+        raise ValueError('Unknown browser profile {}'.format(profile))
     return browser
-def browser_load_url(browser, url_string):
-    """load browser from url_string"""
-    browser.get(url_string)
-    browser_wait()
+def initialize_fetcher(fetcher_type=None):
+    """Starts a page fetcher, fetcher_type defaults to FETCHER_TYPE.
+    Fetchers are either a selenium browser or an HttpFetcher, both support
+    get, find_element(s)_by_xpath, page_source, current_url and quit.
+    They are wrapped in a CachingFetcher while the PAGE_CACHE is on, or the PREFETCHER for
+    http fetchers"""
+    fetcher_type = fetcher_type or FETCHER_TYPE
+    with STAGE_TIMER.span('start browser'):
+        if fetcher_type == 'http':
+            fetcher = HttpFetcher()
+        elif fetcher_type == 'selenium':
+            fetcher = initialize_browser()
+        else:
+            raise ValueError('Unknown fetcher type {}'.format(fetcher_type))
+    if PREFETCHER and fetcher_type == 'http': # serves the PAGE_CACHE's pages too
+        return CachingFetcher(fetcher, PREFETCHER)
+    if PAGE_CACHE:
+        return CachingFetcher(fetcher, PAGE_CACHE)
+    return fetcher
+
+def parse_html(page_source):
+    """Parses html with lxml, returns None for an empty page"""
+    if not page_source or not page_source.strip():
+        return None
+    document = lxml_html.document_fromstring(page_source)
+    for line_break in document.iter('br'): # rendered as new lines by browsers
+        line_break.tail = '\n' + (line_break.tail or '')
+    return document
+
+def element_text(element):
+    """Text of an lxml element with whitespace collapsed, like a browser renders it"""
+    lines = [' '.join(line.split()) for line in element.text_content().splitlines()]
+    return '\n'.join(line for line in lines if line)
+
+def find_lxml_elements(document, xpath_string, fetcher):
+    """Elements matching xpath_string in a parsed page, as LxmlElements clicking through fetcher"""
+    if document is None:
+        return []
+    return [LxmlElement(element, fetcher) for element in document.xpath(xpath_string)
+            if isinstance(element, lxml_html.HtmlElement)]
+
+def find_lxml_element(document, xpath_string, fetcher):
+    """First element matching xpath_string, raises NoSuchElementException like selenium"""
+    elements = find_lxml_elements(document, xpath_string, fetcher)
+    if not elements:
+        raise NoSuchElementException('Unable to locate element: {}'.format(xpath_string))
+    return elements[0]
+
+class LxmlElement(object):
+    """Element found in html parsed with lxml, mimics the selenium WebElement calls used here"""
+
+    def __init__(self, element, fetcher):
+        self._element = element
+        self._fetcher = fetcher
+
+    @property
+    def text(self):
+        """Text of the element with whitespace collapsed, like a browser renders it"""
+        return element_text(self._element)
+
+    def click(self):
+        """Follows real links, tabs and javascript links only switch between parts of
+        the page that are already in the downloaded html, so they are no-ops"""
+        if self._element.tag == 'a':
+            link = self._element
+        else:
+            link = next(self._element.iterancestors('a'), None)
+        if link is None:
+            return
+        href = link.get('href')
+        if href and not href.startswith(('#', 'javascript:')):
+            self._fetcher.get(urlparse.urljoin(self._fetcher.current_url, href))
+
+class HttpFetcher(object):
+    """Browserless fetcher, downloads pages over keep-alive HTTP connections (one per host,
+    reused between pages) and evaluates the scraper's XPaths with lxml"""
+    const_max_redirects = 5
+    static_pages = True # no javascript runs, a loaded page never changes
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self.current_url = None
+        self.page_source = u''
+        self.document = None # parsed current page
+        self._connections = dict()
+
+    def get(self, url_string):
+        """Loads url_string, following redirects"""
+        for _ in xrange(self.const_max_redirects + 1):
+            response, body = self._request(url_string)
+            location = response.getheader('location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url_string = urlparse.urljoin(url_string, location)
+                continue
+            break
+        if response.status >= 400:
+            raise IOError('HTTP {} loading {}'.format(response.status, url_string))
+
+        self.current_url = url_string
+        charset = response.msg.getparam('charset') or 'utf-8'
+        self.page_source = body.decode(charset, 'replace')
+        self.document = parse_html(body)
+
+    def _connection(self, scheme, host):
+        """Returns the pooled connection to host, opening it if needed"""
+        key = (scheme, host)
+        if key not in self._connections:
+            if scheme == 'https':
+                self._connections[key] = httplib.HTTPSConnection(host, timeout=self.timeout)
+            else:
+                self._connections[key] = httplib.HTTPConnection(host, timeout=self.timeout)
+        return self._connections[key]
+
+    def _drop_connection(self, scheme, host):
+        """Closes and forgets the pooled connection to host"""
+        connection = self._connections.pop((scheme, host), None)
+        if connection:
+            connection.close()
+
+    def _request(self, url_string):
+        """GET url_string on the pooled connection, returns (response, body).
+        Retries once on a fresh connection since the server may have closed an idle one"""
+        parsed_url = urlparse.urlsplit(url_string)
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path += '?' + parsed_url.query
+        headers = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive',
+                   'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:50.0) Gecko/20100101'}
+        for attempt in (1, 2):
+            connection = self._connection(parsed_url.scheme, parsed_url.netloc)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                self._drop_connection(parsed_url.scheme, parsed_url.netloc)
+                if attempt == 2:
+                    raise
+                continue
+            if response.getheader('connection', '').lower() == 'close':
+                self._drop_connection(parsed_url.scheme, parsed_url.netloc)
+            if response.getheader('content-encoding', '').lower() == 'gzip':
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            return response, body
+
+    def find_elements_by_xpath(self, xpath_string):
+        """All elements matching xpath_string on the current page"""
+        return find_lxml_elements(self.document, xpath_string, self)
+
+    def find_element_by_xpath(self, xpath_string):
+        """First element matching xpath_string, raises NoSuchElementException like selenium"""
+        return find_lxml_element(self.document, xpath_string, self)
+
+    def quit(self):
+        """Closes all pooled connections"""
+        for scheme, host in self._connections.keys():
+            self._drop_connection(scheme, host)
+
+def write_file_atomically(fullpath, data):
+    """Writes data to a temp file and renames it over fullpath, so readers never see
+    a partly written file. Returns the number of bytes written"""
+    temp_fullpath = '{}.{}.{}.tmp'.format(fullpath, os.getpid(), threading.current_thread().ident)
+    with open(temp_fullpath, 'wb') as temp_file:
+        temp_file.write(data)
+    os.rename(temp_fullpath, fullpath)
+    return len(data)
+
+class PageCache(object):
+    """Compressed on-disk cache of fetched pages. Page contents are stored once under their
+    sha1 (content addressed), and each url points at the content it returned.
+    Entries older than ttl (sec) are misses, the least recently used files are evicted
+    once the cache grows beyond max_bytes"""
+    const_evict_to = 0.9 # share of max_bytes to evict down to
+
+    def __init__(self, cache_dir, ttl=None, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.ttl = PAGE_CACHE_TTL if ttl is None else ttl
+        self.max_bytes = PAGE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self._urls_dir = os.path.join(cache_dir, 'urls')
+        self._pages_dir = os.path.join(cache_dir, 'pages')
+        for dir_name in (self._urls_dir, self._pages_dir):
+            if not os.path.exists(dir_name):
+                os.makedirs(dir_name)
+        self._lock = threading.Lock()
+        self._num_bytes = sum(size for _, size, _ in self._cache_files())
+
+    def _url_fullpath(self, url_string):
+        """Entry file of url_string"""
+        if isinstance(url_string, unicode):
+            url_string = url_string.encode('utf-8')
+        return os.path.join(self._urls_dir, hashlib.sha1(url_string).hexdigest())
+
+    def _page_fullpath(self, content_hash):
+        """Compressed page file of content_hash"""
+        return os.path.join(self._pages_dir, content_hash + '.z')
+
+    def _cache_files(self):
+        """(last used time, size, fullpath) of every file in the cache"""
+        cache_files = []
+        for dir_name in (self._urls_dir, self._pages_dir):
+            for filename in os.listdir(dir_name):
+                try:
+                    file_stat = os.stat(os.path.join(dir_name, filename))
+                except OSError: # removed by another process meanwhile
+                    continue
+                cache_files.append((file_stat.st_mtime, file_stat.st_size,
+                                    os.path.join(dir_name, filename)))
+        return cache_files
+
+    def get(self, url_string):
+        """Cached page source of url_string, None if it is not cached or expired"""
+        url_fullpath = self._url_fullpath(url_string)
+        try:
+            with open(url_fullpath, 'r') as url_file:
+                entry = json.load(url_file)
+            if time.time() - entry['fetched'] >= self.ttl:
+                TALLY.add('page cache miss')
+                return None
+            page_fullpath = self._page_fullpath(entry['page'])
+            with open(page_fullpath, 'rb') as page_file:
+                page_source = zlib.decompress(page_file.read()).decode('utf-8')
+            # mark as recently used, for eviction
+            os.utime(url_fullpath, None)
+            os.utime(page_fullpath, None)
+        except (IOError, OSError, ValueError, KeyError, zlib.error):
+            TALLY.add('page cache miss')
+            return None
+        TALLY.add('page cache hit')
+        return page_source
+
+    def put(self, url_string, page_source):
+        """Stores page_source as the page of url_string"""
+        page_bytes = page_source.encode('utf-8')
+        content_hash = hashlib.sha1(page_bytes).hexdigest()
+        page_fullpath = self._page_fullpath(content_hash)
+        num_bytes = 0
+        if not os.path.exists(page_fullpath):
+            num_bytes += write_file_atomically(page_fullpath, zlib.compress(page_bytes, 6))
+        num_bytes += write_file_atomically(self._url_fullpath(url_string),
+                                           json.dumps({'url': url_string, 'page': content_hash,
+                                                       'fetched': time.time()}))
+        with self._lock:
+            self._num_bytes += num_bytes
+            evict_now = self._num_bytes > self.max_bytes
+        if evict_now:
+            self.evict()
+
+    def delete(self, url_string):
+        """Forgets the page of url_string, its content file goes once it is evicted"""
+        try:
+            os.remove(self._url_fullpath(url_string))
+        except OSError: # not cached
+            pass
+
+    def evict(self):
+        """Removes the least recently used files until the cache is below max_bytes again.
+        A url whose page was evicted is a miss"""
+        with self._lock:
+            cache_files = sorted(self._cache_files())
+            self._num_bytes = sum(size for _, size, _ in cache_files)
+            for _, size, fullpath in cache_files:
+                if self._num_bytes <= self.const_evict_to * self.max_bytes:
+                    break
+                try:
+                    os.remove(fullpath)
+                except OSError: # removed by another process meanwhile
+                    pass
+                self._num_bytes -= size
+
+PAGE_CACHE = None
+
+def page_cache_report():
+    """Summary of page cache lookups"""
+    totals = TALLY.snapshot()
+    hits = totals.get('page cache hit', 0)
+    misses = totals.get('page cache miss', 0)
+    return 'Page cache: {} hits, {} misses, {:.0%} hit rate'.\
+        format(hits, misses, hits / float(hits + misses) if hits + misses else 0.0)
+
+class CachingFetcher(object):
+    """Serves pages from a PageCache, and loads the others with fetcher, storing them
+    once browser_load_url found them ready, see keep_page. Cached pages are answered
+    with lxml like an HttpFetcher"""
+
+    def __init__(self, fetcher, page_cache):
+        self.fetcher = fetcher
+        self.page_cache = page_cache
+        self._cached_url = None
+        self._cached_source = None
+        self._cached_document = None
+        self._unsaved_url = None
+
+    @property
+    def static_pages(self):
+        """Cached pages never change, so there is nothing to wait for"""
+        return self._cached_url is not None or getattr(self.fetcher, 'static_pages', False)
+
+    @property
+    def current_url(self):
+        """Url of the current page"""
+        if self._cached_url is not None:
+            return self._cached_url
+        return self.fetcher.current_url
+
+    def get(self, url_string):
+        """Loads url_string from the cache, or from the web waiting for its rate limit"""
+        page_source = self.page_cache.get(url_string)
+        if page_source is not None:
+            self._cached_url = url_string
+            self._cached_source = page_source
+            self._cached_document = parse_html(page_source)
+            self._unsaved_url = None
+        else:
+            self._cached_url = self._cached_source = self._cached_document = None
+            rate_limit_wait(url_string)
+            self.fetcher.get(url_string)
+            count_page_served(self.fetcher)
+            self._unsaved_url = url_string
+
+    def keep_page(self):
+        """Stores the page loaded from the web, once it passed the readiness check,
+        so block or captcha pages never end up in the cache"""
+        if self._unsaved_url:
+            self.page_cache.put(self._unsaved_url, self.fetcher.page_source)
+            self._unsaved_url = None
+
+    @property
+    def page_source(self):
+        """Html of the current page"""
+        if self._cached_url is not None:
+            return self._cached_source
+        return self.fetcher.page_source
+
+    @property
+    def document(self):
+        """Current page parsed with lxml"""
+        if self._cached_url is not None:
+            return self._cached_document
+        if isinstance(self.fetcher, HttpFetcher): # already parsed
+            return self.fetcher.document
+        return parse_html(self.page_source)
+
+    def find_elements_by_xpath(self, xpath_string):
+        """All elements matching xpath_string on the current page"""
+        if self._cached_url is not None:
+            return find_lxml_elements(self._cached_document, xpath_string, self)
+        return self.fetcher.find_elements_by_xpath(xpath_string)
+
+    def find_element_by_xpath(self, xpath_string):
+        """First element matching xpath_string, raises NoSuchElementException like selenium"""
+        if self._cached_url is not None:
+            return find_lxml_element(self._cached_document, xpath_string, self)
+        return self.fetcher.find_element_by_xpath(xpath_string)
+
+    def quit(self):
+        """Quits the wrapped fetcher"""
+        self.fetcher.quit()
+
+class ExchangeCache(object):
+    """On-disk map of (stock symbol, country) to the exchange the symbol was found on,
+    or None for symbols that were not found, so later runs load the right summary page
+    first and skip symbols that keep failing. Entries expire after ttl (sec),
+    not found entries after negative_ttl (sec)"""
+
+    def __init__(self, cache_fullpath, ttl=None, negative_ttl=None, save_every=50):
+        self.cache_fullpath = cache_fullpath
+        self.ttl = EXCHANGE_CACHE_TTL if ttl is None else ttl
+        self.negative_ttl = EXCHANGE_CACHE_NEGATIVE_TTL if negative_ttl is None else negative_ttl
+        self.save_every = save_every
+        self._entries = self._load()
+        self._num_unsaved = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(stock_symbol, which_country=None):
+        """Cache key, symbols are cleaned up like they are for scraping"""
+        return '{}:{}'.format('Canada' if which_country == 'Canada' else 'USA',
+                              clean_up_stock_symbol(stock_symbol))
+
+    def _load(self):
+        """Entries saved on disk, empty if there are none yet"""
+        try:
+            with open(self.cache_fullpath, 'r') as cache_file:
+                return json.load(cache_file)
+        except (IOError, ValueError):
+            return dict()
+
+    def lookup(self, stock_symbol, which_country=None, count=True):
+        """Returns (hit, exchange), exchange is None on a hit for a symbol that was not found.
+        count tallies the hit or miss"""
+        with self._lock:
+            entry = self._entries.get(self.key(stock_symbol, which_country))
+        if entry:
+            ttl = self.ttl if entry['exchange'] else self.negative_ttl
+            if time.time() - entry['checked'] < ttl:
+                if count:
+                    TALLY.add('exchange cache hit' if entry['exchange']
+                              else 'exchange cache negative hit')
+                return True, entry['exchange']
+        if count:
+            TALLY.add('exchange cache miss')
+        return False, None
+
+    def record(self, stock_symbol, which_country, exchange):
+        """Remembers the exchange stock_symbol was found on, None if it was not found"""
+        with self._lock:
+            self._entries[self.key(stock_symbol, which_country)] = {'exchange': exchange,
+                                                                    'checked': time.time()}
+            self._num_unsaved += 1
+            save_now = self._num_unsaved >= self.save_every
+        if save_now:
+            self.save()
+
+    def save(self):
+        """Merges with the entries on disk, other processes may have saved meanwhile,
+        then replaces the cache file in one step"""
+        with self._lock:
+            with open(self.cache_fullpath + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                for key, entry in self._load().items():
+                    if key not in self._entries or \
+                            entry['checked'] > self._entries[key]['checked']:
+                        self._entries[key] = entry
+                temp_fullpath = '{}.{}.tmp'.format(self.cache_fullpath, os.getpid())
+                with open(temp_fullpath, 'w') as cache_file:
+                    json.dump(self._entries, cache_file)
+                os.rename(temp_fullpath, self.cache_fullpath)
+                self._num_unsaved = 0
+
+EXCHANGE_CACHE = None
+
+class FreshnessIndex(object):
+    """On-disk record per (stock symbol, country) of the last statements scraped: the exchange,
+    the Current Year period date, when they were loaded, a hash of their values and the
+    values themselves. With incremental the values are reused instead of loading the
+    financials page again, until a new fiscal period is likely, ie filing_lag_days after
+    the Current Year period plus a year, rechecked every recheck_days after that,
+    or until they are max_age_days old"""
+
+    def __init__(self, index_fullpath, incremental=False, filing_lag_days=None,
+                 recheck_days=None, max_age_days=None, save_every=200):
+        self.index_fullpath = index_fullpath
+        self.incremental = incremental
+        self.filing_lag = 24 * 3600 * (FRESHNESS_FILING_LAG_DAYS if filing_lag_days is None
+                                       else filing_lag_days)
+        self.recheck = 24 * 3600 * (FRESHNESS_RECHECK_DAYS if recheck_days is None
+                                    else recheck_days)
+        self.max_age = 24 * 3600 * (FRESHNESS_MAX_AGE_DAYS if max_age_days is None
+                                    else max_age_days)
+        self.save_every = save_every
+        self._entries = self._load()
+        self._num_unsaved = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Entries saved on disk, empty if there are none yet"""
+        try:
+            with open(self.index_fullpath, 'r') as index_file:
+                return json.load(index_file)
+        except (IOError, ValueError):
+            return dict()
+
+    def statements_due(self, entry, now=None):
+        """True if a new fiscal period is likely out since the entry's statements were loaded"""
+        now = now or time.time()
+        age = now - entry['loaded']
+        if age >= self.max_age:
+            return True
+        try:
+            period_end = time.mktime(time.strptime(entry['current_year'], '%Y-%m-%d'))
+        except (TypeError, ValueError): # no period date, only recheck now and then
+            return age >= self.recheck
+        next_period_due = period_end + 365 * 24 * 3600 + self.filing_lag
+        return now >= next_period_due and age >= min(self.recheck, now - next_period_due)
+
+    def lookup(self, stock_symbol, which_country, exchange, count=True):
+        """Statement result columns still current for the symbol on exchange,
+        None if they have to be loaded. count tallies which of the two it was"""
+        if not self.incremental:
+            return None
+        with self._lock:
+            entry = self._entries.get(ExchangeCache.key(stock_symbol, which_country))
+        if entry and entry['exchange'] == exchange and not self.statements_due(entry):
+            if count:
+                TALLY.add('statements current')
+            return dict(entry['statements'])
+        if count:
+            TALLY.add('statements due')
+        return None
+
+    def record(self, stock_symbol, which_country, stock_result_dict):
+        """Remembers the statement columns just loaded for stock_symbol"""
+        statements = {column: stock_result_dict.get(column, 'N/A')
+                      for column in STATEMENT_COLUMNS}
+        statements_hash = hashlib.sha1(json.dumps(statements, sort_keys=True)).hexdigest()
+        key = ExchangeCache.key(stock_symbol, which_country)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                TALLY.add('statements unchanged' if entry['hash'] == statements_hash
+                          else 'statements changed')
+            self._entries[key] = {'exchange': stock_result_dict['Exchange'],
+                                  'current_year': statements['Current Year'],
+                                  'loaded': time.time(), 'hash': statements_hash,
+                                  'statements': statements}
+            self._num_unsaved += 1
+            save_now = self._num_unsaved >= self.save_every
+        if save_now:
+            self.save()
+
+    def save(self):
+        """Merges with the entries on disk, other processes may have saved meanwhile,
+        then replaces the index file in one step"""
+        with self._lock:
+            with open(self.index_fullpath + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                for key, entry in self._load().items():
+                    if key not in self._entries or \
+                            entry['loaded'] > self._entries[key]['loaded']:
+                        self._entries[key] = entry
+                write_file_atomically(self.index_fullpath, json.dumps(self._entries))
+                self._num_unsaved = 0
+
+FRESHNESS_INDEX = None
+
+def browser_report():
+    """Summary of the browser sessions started and why they were replaced"""
+    totals = TALLY.snapshot()
+    return 'Browser sessions: {} started, {} recycled after {} pages, {} recycled ' \
+           'over {} MB, {} died'.format(totals.get('browser sessions started', 0),
+                                       totals.get('browser sessions recycled for pages', 0),
+                                       SESSION_MAX_PAGES,
+                                       totals.get('browser sessions recycled for memory', 0),
+                                       SESSION_MAX_RSS_MB,
+                                       totals.get('browser sessions died', 0))
+
+def exchange_cache_report():
+    """Summary of exchange cache lookups"""
+    totals = TALLY.snapshot()
+    hits = totals.get('exchange cache hit', 0)
+    negative_hits = totals.get('exchange cache negative hit', 0)
+    misses = totals.get('exchange cache miss', 0)
+    lookups = hits + negative_hits + misses
+    return 'Exchange cache: {} hits, {} skipped as not found, {} misses, {:.0%} hit rate'.\
+        format(hits, negative_hits, misses,
+               (hits + negative_hits) / float(lookups) if lookups else 0.0)
+
+def failure_report():
+    """Summary of symbols whose pages failed to load, and how the CONTROLLER reacted"""
+    totals = TALLY.snapshot()
+    report = 'Failures: {} symbols had pages fail to load, {} tries again, {} backoffs, ' \
+             '{} statements without data'.format(totals.get('transient failures', 0),
+                                                  totals.get('transient retries', 0),
+                                                  totals.get('adaptive backoffs', 0),
+                                                  totals.get('statements without data', 0))
+    if CONTROLLER and CONTROLLER.adjustments: # process workers have their own
+        report += ', ending at {} at once and {:.0%} of the rate'.\
+            format(CONTROLLER.concurrency, CONTROLLER.rate_scale)
+    return report
+
+def prefetch_report():
+    """Summary of the pages fetched ahead of the symbols and how many of them were used"""
+    totals = TALLY.snapshot()
+    return 'Prefetch: {} pages fetched ahead, {} used, {} unused, waited {:.1f} sec for ' \
+           'pages still in flight'.format(totals.get('pages prefetched', 0),
+                                          totals.get('prefetched pages used', 0),
+                                          totals.get('prefetched pages unused', 0),
+                                          totals.get('prefetch wait sec', 0.0))
+
+def freshness_report():
+    """Summary of the statements reused vs loaded, and how many loads found changes"""
+    totals = TALLY.snapshot()
+    return 'Freshness index: {} symbols reused current statements, {} loaded them, ' \
+           '{} changed, {} unchanged'.format(totals.get('statements current', 0),
+                                            totals.get('statements due', 0),
+                                            totals.get('statements changed', 0),
+                                            totals.get('statements unchanged', 0))
+
+def browser_load_url(browser, url_string, ready_xpath=None):
+    """load browser from url_string, waiting for the host's rate limit first
+    and for an element matching ready_xpath afterwards. Only pages that loaded
+    are kept in the page cache"""
+    with STAGE_TIMER.span('load page'):
+        if not isinstance(browser, CachingFetcher): # only waits for pages not in the cache
+            rate_limit_wait(url_string)
+        start_time = time.time()
+        loaded = False
+        if hasattr(SCRAPE_HEALTH, 'page_urls'): # dropped from the cache if the symbol fails
+            SCRAPE_HEALTH.page_urls.append(url_string)
+        try:
+            browser.get(url_string)
+            if not isinstance(browser, CachingFetcher): # counted when the cache goes to the web
+                count_page_served(browser)
+            loaded = True
+            if ready_xpath and not wait_until_ready(browser, ready_xpath):
+                if page_loaded(browser) and browser.find_elements_by_xpath(SITE_PAGE_XPATH):
+                    TALLY.add('pages without content') # eg the financials of a fund
+                else: # timed out loading, or a page that is not the site's
+                    loaded = False
+            if loaded and isinstance(browser, CachingFetcher):
+                browser.keep_page()
+        finally:
+            if not loaded:
+                note_load_failure()
+            if CONTROLLER:
+                CONTROLLER.record_load(time.time() - start_time, not loaded)
+def page_loaded(browser):
+    """True if the current page finished loading, to tell a page without the content waited
+    for from one still loading"""
+    if getattr(browser, 'static_pages', False):
+        return True
+    try:
+        return bool(browser_session(browser).execute_script(PAGE_LOADED_SCRIPT))
+    except Exception:
+        return False
+def rate_limit_wait(url_string):
+    """Waits until the RATE_LIMITER allows loading url_string"""
+    if RATE_LIMITER:
+        TALLY.add('rate limit wait sec', RATE_LIMITER.wait(url_string))
+def count_page_served(browser):
+    """Counts a page the session loaded, sessions are recycled after SESSION_MAX_PAGES"""
+    browser.pages_served = getattr(browser, 'pages_served', 0) + 1
+def browser_session(browser):
+    """The browser session itself, without a CachingFetcher around it"""
+    return browser.fetcher if isinstance(browser, CachingFetcher) else browser
+def process_tree_rss_bytes(pid):
+    """Resident memory of process pid and all its descendants (eg geckodriver, Firefox and
+    its content processes), read from /proc. None where there is no /proc"""
+    if not os.path.isdir('/proc'):
+        return None
+    child_pids = dict()
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(entry), 'r') as stat_file:
+                    parent_pid = int(stat_file.read().rsplit(')', 1)[1].split()[1])
+            except (IOError, IndexError, ValueError): # the process just ended
+                continue
+            child_pids.setdefault(parent_pid, []).append(int(entry))
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    rss_bytes = 0
+    pending_pids = [pid]
+    while pending_pids:
+        current_pid = pending_pids.pop()
+        try:
+            with open('/proc/{}/statm'.format(current_pid), 'r') as statm_file:
+                rss_bytes += int(statm_file.read().split()[1]) * page_size
+        except (IOError, IndexError, ValueError):
+            pass
+        pending_pids.extend(child_pids.get(current_pid, []))
+    return rss_bytes
+def browser_rss_bytes(browser):
+    """Memory of the processes behind a selenium session, None for sessions without any"""
+    service_process = getattr(getattr(browser_session(browser), 'service', None), 'process', None)
+    if service_process is None:
+        return None
+    return process_tree_rss_bytes(service_process.pid)
 def browser_quit(browser):
     """Quits the browser"""
     browser.quit()
-def browser_wait(approx_time=None):
-    """Randomizes an arbitrary wait time (in sec)"""
-    if (not approx_time) or approx_time < 3:
-        time.sleep(2 + randint(0, 2))
-    else:
-        time.sleep(approx_time + randint(0, round(0.5 * approx_time)))
-def browser_xpath_click(browser, xpath_string):
-    """Performs a browser click with a wait command"""
-    browser.find_element_by_xpath(xpath_string).click()
-    browser_wait()
-
-def grab_summary_data(browser, stock_symbol, which_country=None):
-    """Retrieves basic information from a stock's Summary page , eg
-    stock name, symbol, current PE ratio, market cap, employees
-    """
-    const_sum_xpath_base = """/html/body/div[@class='fjfe-bodywrapper']
-        /div[@id='fjfe-real-body']/div[@id='fjfe-click-wrapper']"""
-    const_summary_xpaths_dict = {'stock_name' : """{}/div[@id='appbar']/div[@class='elastic']
-                                    /div[@class='appbar-center']
-                                    /div[@class='appbar-snippet-primary']
-                                    /span""".format(const_sum_xpath_base),
-                                 'stock_symbol' : """{}/div[@id='appbar']/div[@class='elastic']
-                                    /div[@class='appbar-center']
-                                    /div[@class='appbar-snippet-secondary']
-                                    /span""".format(const_sum_xpath_base),
-                                 'current_pe' : """{}/div[@class='elastic']/div[@id='app']
-                                    /div[@id='gf-viewc']/div[@class='fjfe-content']
-                                    /div[@class='g-wrap']/div[@class='g-section g-tpl-right-1']
-                                    /div[@class='g-unit']/div[@id='market-data-div']
-                                    /div[@class='snap-panel-and-plusone']/div[@class='snap-panel']
-                                    /table[@class='snap-data'][1]/tbody/tr[6]
-                                    /td[@class='val']""".format(const_sum_xpath_base),
-                                 'employees' : """{}/div[@class='elastic']/div[@id='app']
-                                    /div[@id='gf-viewc']/div[@class='fjfe-content']
-                                    /div[@class='g-wrap']
-                                    /div[@class='g-section g-tpl-right-1 sfe-break-top-5']
-                                    /div[@class='g-unit g-first']/div[@class='g-c']
-                                    /div[@class='sfe-section'][1]/table[@class='quotes rgt nwp']
-                                    /tbody/tr[6]
-                                    /td[@class='period'][1]""".format(const_sum_xpath_base),
-                                 'market_cap' : """{}/div[@class='elastic']/div[@id='app']
-                                    /div[@id='gf-viewc']/div[@class='fjfe-content']
-                                    /div[@class='g-wrap']/div[@class='g-section g-tpl-right-1']
-                                    /div[@class='g-unit']/div[@id='market-data-div']
-                                    /div[@class='snap-panel-and-plusone']/div[@class='snap-panel']
-                                    /table[@class='snap-data'][1]/tbody/tr[5]
-                                    /td[@class='val']""".format(const_sum_xpath_base),
-                                 'country_origin' : """{}/div[@class='elastic']/div[@id='app']
-                                    /div[@id='gf-viewc']/div[@class='fjfe-content']
-                                    /div[@class='g-wrap']
-                                    /div[@class='g-section g-tpl-right-1 sfe-break-top-5']
-                                    /div[@class='g-unit g-first']/div[@class='g-c']
-                                    /div[@class='sfe-section'][2]""".format(const_sum_xpath_base)
-
-                                }
-
-    result_dict = dict()
-
-    if not which_country or which_country != 'Canada':  #if USA, or by default
+def browser_is_alive(browser):
+    """Health check, a dead or crashed session raises on any command"""
+    try:
+        browser.current_url
+        return True
+    except Exception:
+        return False
+def browser_xpath_click(browser, xpath_string, ready_xpath=None):
+    """Performs a browser click, then waits for an element matching ready_xpath"""
+    with STAGE_TIMER.span('click'):
+        browser.find_element_by_xpath(xpath_string).click()
+        if ready_xpath:
+            wait_until_ready(browser, ready_xpath)
+def wait_until_ready(browser, ready_xpath, timeout=None):
+    """Polls the page until an element matching ready_xpath is there, instead of sleeping
+    a fixed time. Returns False if it did not show up within timeout (sec)"""
+    timeout = timeout or PAGE_READY_TIMEOUT
+    start_time = time.time()
+    while not browser.find_elements_by_xpath(ready_xpath):
+        if getattr(browser, 'static_pages', False): # polling would not change the page
+            return False
+        if time.time() - start_time >= timeout:
+            print "      Warning, page not ready after {} sec".format(timeout)
+            TALLY.add('page wait sec', time.time() - start_time)
+            STAGE_TIMER.record('wait for page', time.time() - start_time)
+            return False
+        time.sleep(PAGE_READY_POLL)
+    TALLY.add('page wait sec', time.time() - start_time)
+    STAGE_TIMER.record('wait for page', time.time() - start_time)
+    return True
+
+# what went wrong while the current thread scraped its symbol and the pages it loaded,
+# see scrape_symbol
+SCRAPE_HEALTH = threading.local()
+
+def note_load_failure():
+    """Counts a page that raised or never got ready for the symbol being scraped"""
+    SCRAPE_HEALTH.load_failures = getattr(SCRAPE_HEALTH, 'load_failures', 0) + 1
+
+def note_empty_extraction():
+    """Counts a loaded statement without data, eg of a fund, not a failure of the page"""
+    TALLY.add('statements without data')
+
+class Tally(object):
+    """Thread safe running totals per category, eg seconds spent waiting vs scraping
+    or cache hits"""
+
+    def __init__(self):
+        self.totals = dict()
+        self._lock = threading.Lock()
+
+    def add(self, category, amount=1):
+        """Adds amount to category"""
+        with self._lock:
+            self.totals[category] = self.totals.get(category, 0) + amount
+
+    def merge(self, totals):
+        """Adds the totals of another tally, eg from a worker process"""
+        for category, amount in totals.items():
+            self.add(category, amount)
+
+    def snapshot(self):
+        """Copy of the current totals"""
+        with self._lock:
+            return dict(self.totals)
+
+    def since(self, snapshot):
+        """Totals added after snapshot was taken"""
+        return {category: amount - snapshot.get(category, 0)
+                for category, amount in self.snapshot().items()}
+
+TALLY = Tally()
+
+# upper bounds (sec) of the latency histogram buckets, each 1.25 times the one before
+HISTOGRAM_BOUNDS = [0.0005 * 1.25 ** step for step in xrange(60)] # up to about 300 sec
+
+class Histogram(object):
+    """Counts of durations per HISTOGRAM_BOUNDS bucket plus their count, sum and extremes,
+    a fixed size summary however many durations are added"""
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(HISTOGRAM_BOUNDS) + 1) # the last one has no bound
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        """Counts one duration"""
+        self.bucket_counts[bisect.bisect_left(HISTOGRAM_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def merge(self, other):
+        """Adds the counts of another histogram"""
+        self.bucket_counts = [mine + theirs for mine, theirs in
+                              zip(self.bucket_counts, other.bucket_counts)]
+        self.count += other.count
+        self.sum += other.sum
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, percent):
+        """Estimated duration percent of the durations are at most, interpolated within
+        its bucket, None if there are none"""
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bucket, bucket_count in enumerate(self.bucket_counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = HISTOGRAM_BOUNDS[bucket - 1] if bucket else 0.0
+                upper = HISTOGRAM_BOUNDS[bucket] if bucket < len(HISTOGRAM_BOUNDS) else self.max
+                estimate = lower + (upper - lower) * (rank - seen) / bucket_count
+                return min(max(estimate, self.min), self.max)
+            seen += bucket_count
+        return self.max
+
+class StageTimer(object):
+    """Thread safe latency histograms per stage, eg page loads.
+    Inside a task() block the durations a thread records also go to a separate StageTimer,
+    eg to tell how long the stages of one file or one symbol took"""
+
+    def __init__(self):
+        self.histograms = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def record(self, stage, seconds):
+        """Adds one duration of stage"""
+        with self._lock:
+            self.histograms.setdefault(stage, Histogram()).add(seconds)
+        for task_timer in getattr(self._local, 'task_timers', []):
+            task_timer.record(stage, seconds)
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        """Times the with block as one run of stage"""
+        start_time = time.time()
         try:
-            retrieved_stock_symbol = browser.find_element_by_xpath\
-                (const_summary_xpaths_dict['stock_symbol']).text.strip('()').split(':')[1]
-            result_dict['Stock Symbol'] = retrieved_stock_symbol
-        except:
-            result_dict['Stock Symbol'] = 'N/A'
-
-        
-        if result_dict['Stock Symbol'] != stock_symbol:
-            print "    Warning 1, {} is not in NASDAQ, retry with NYSE".format(stock_symbol)
+            yield
+        finally:
+            self.record(stage, time.time() - start_time)
+
+    @contextlib.contextmanager
+    def task(self):
+        """Yields a StageTimer that also gets what this thread records in the with block"""
+        task_timer = StageTimer()
+        if not hasattr(self._local, 'task_timers'):
+            self._local.task_timers = []
+        self._local.task_timers.append(task_timer)
+        try:
+            yield task_timer
+        finally:
+            self._local.task_timers.remove(task_timer)
+
+    def merge(self, histograms):
+        """Adds the histograms of another timer, eg from a worker process"""
+        with self._lock:
+            for stage, histogram in histograms.items():
+                self.histograms.setdefault(stage, Histogram()).merge(histogram)
+
+    def percentile(self, stage, percent):
+        """Estimated duration percent of the runs of stage took at most, None if it never ran"""
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            return histogram.percentile(percent) if histogram else None
+
+    def count(self, stage):
+        """Number of runs of stage"""
+        with self._lock:
+            return self.histograms[stage].count if stage in self.histograms else 0
+
+STAGE_TIMER = StageTimer()
+RUN_ID = None # start time of the process_dir run, labels its exported metrics
+
+def _format_ms(seconds):
+    return '{:.0f} ms'.format(seconds * 1000) if seconds is not None else 'n/a'
+
+def file_summary(work_filename, file_timer, elapsed, row_count, retry_count=0):
+    """One line on how the symbols of a file went, row_count of them were written after
+    retry_count tries again, timings from the file's StageTimer (every try counts there)"""
+    return '{}: {} symbols in {:.1f} sec ({:.2f} symbols/sec), {} tries again, ' \
+           'per try p50 {} p95 {}, {} page loads p95 {}'.\
+           format(work_filename, row_count, elapsed, row_count / elapsed if elapsed else 0.0,
+                  retry_count, _format_ms(file_timer.percentile('symbol', 50)),
+                  _format_ms(file_timer.percentile('symbol', 95)),
+                  file_timer.count('load page'), _format_ms(file_timer.percentile('load page', 95)))
+
+def metrics_jsonl(timer, **labels):
+    """One json line per stage of timer: count, sum, percentiles and bucket counts,
+    plus RUN_ID and labels"""
+    lines = []
+    for stage, histogram in sorted(timer.histograms.items()):
+        record = dict(labels, run=RUN_ID, stage=stage, count=histogram.count,
+                      sum_sec=histogram.sum, min_sec=histogram.min, max_sec=histogram.max,
+                      p50_sec=histogram.percentile(50), p95_sec=histogram.percentile(95),
+                      p99_sec=histogram.percentile(99),
+                      buckets={'{:.6g}'.format(bound): bucket_count for bound, bucket_count
+                               in zip(HISTOGRAM_BOUNDS + [float('inf')], histogram.bucket_counts)
+                               if bucket_count})
+        lines.append(json.dumps(record, sort_keys=True))
+    return lines
+
+def metrics_prometheus(timer, tally):
+    """Prometheus text format of the stage histograms of timer and the totals of tally"""
+    lines = ['# HELP stock_scrape_stage_seconds Time spent per scraping stage',
+             '# TYPE stock_scrape_stage_seconds histogram']
+    for stage, histogram in sorted(timer.histograms.items()):
+        cumulative_count = 0
+        for bound, bucket_count in zip(HISTOGRAM_BOUNDS, histogram.bucket_counts):
+            cumulative_count += bucket_count
+            lines.append('stock_scrape_stage_seconds_bucket{{stage="{}",le="{:.6g}"}} {}'.\
+                format(stage, bound, cumulative_count))
+        lines.append('stock_scrape_stage_seconds_bucket{{stage="{}",le="+Inf"}} {}'.\
+            format(stage, histogram.count))
+        lines.append('stock_scrape_stage_seconds_sum{{stage="{}"}} {}'.format(stage, histogram.sum))
+        lines.append('stock_scrape_stage_seconds_count{{stage="{}"}} {}'.\
+            format(stage, histogram.count))
+    lines.extend(['# HELP stock_scrape_tally Running totals, eg cache hits or seconds waited',
+                  '# TYPE stock_scrape_tally gauge'])
+    for category, amount in sorted(tally.snapshot().items()):
+        lines.append('stock_scrape_tally{{category="{}"}} {}'.format(category, amount))
+    return '\n'.join(lines) + '\n'
+
+def export_run_metrics(logs_dir_name):
+    """Exports the run's stage timings as METRICS_EXPORT says"""
+    if METRICS_EXPORT == 'jsonl':
+        with open('{}/metrics.jsonl'.format(logs_dir_name), 'a') as metrics_file:
+            metrics_file.writelines(line + '\n' for line in metrics_jsonl(STAGE_TIMER))
+    elif METRICS_EXPORT == 'prometheus':
+        write_file_atomically('{}/metrics.prom'.format(logs_dir_name),
+                              metrics_prometheus(STAGE_TIMER, TALLY))
+
+def export_file_metrics(logs_dir_name, work_filename, file_timer):
+    """Appends the stage timings of one file to the jsonl export"""
+    if METRICS_EXPORT == 'jsonl':
+        with open('{}/metrics.jsonl'.format(logs_dir_name), 'a') as metrics_file:
+            metrics_file.writelines(line + '\n' for line in
+                                    metrics_jsonl(file_timer, file=work_filename))
+
+def time_report():
+    """Summary of time spent scraping, split into waiting and working"""
+    totals = TALLY.snapshot()
+    scraping = totals.get('scrape sec', 0.0)
+    page_wait = totals.get('page wait sec', 0.0)
+    rate_wait = totals.get('rate limit wait sec', 0.0)
+    return 'Scraping took {:.1f} sec: waited {:.1f} sec for pages, {:.1f} sec for ' \
+           'rate limits, worked {:.1f} sec'.format(scraping, page_wait, rate_wait,
+                                                   scraping - page_wait - rate_wait)
+
+class TabbedBrowser(object):
+    """One selenium session with num_tabs tabs that are lent out like separate browsers.
+    Selenium drives one tab at a time, so every command switches to its tab under a lock,
+    but page loads are started without waiting for them, so they go on in the background
+    while the other tabs are used"""
+
+    def __init__(self, driver, num_tabs):
+        self.driver = driver
+        self.lock = threading.RLock()
+        for _ in xrange(num_tabs - 1):
+            driver.execute_script("window.open('about:blank');")
+        self.tabs = [BrowserTab(self, window_handle) for window_handle in driver.window_handles]
+        self._open_handles = set(driver.window_handles)
+        self._current_handle = None
+
+    def switch_to(self, window_handle):
+        """Makes window_handle the tab commands go to, call with the lock held"""
+        if window_handle != self._current_handle:
+            self.driver.switch_to.window(window_handle)
+            self._current_handle = window_handle
+
+    def close_tab(self, window_handle):
+        """Closes a tab, the session is quit with its last tab"""
+        with self.lock:
+            self._open_handles.discard(window_handle)
+            if not self._open_handles:
+                self.driver.quit()
+                return
             try:
-                browser_load_url(browser, return_base_url(stock_symbol, NYSE))
-                retrieved_stock_symbol = browser.find_element_by_xpath\
-                    (const_summary_xpaths_dict['stock_symbol']).text.strip('()').split(':')[1]
-                result_dict['Stock Symbol'] = retrieved_stock_symbol
-            except:
-                result_dict['Stock Symbol'] = 'N/A'
-
-        
-        if result_dict['Stock Symbol'] != stock_symbol:
-            print "    Warning 2, {} not in NYSE, retry with empty.".format(stock_symbol)
+                self.switch_to(window_handle)
+                self.driver.close()
+            finally:
+                self._current_handle = None
+
+class BrowserTab(object):
+    """A tab of a TabbedBrowser, with the selenium browser methods the scraper uses.
+    get returns once the load started, the new page is only looked at after it replaced
+    the old one, so waiting for it (wait_until_ready) keeps other tabs going"""
+
+    # marks the old page, the new page does not have it once it replaced the old one
+    UNLOADING_SCRIPT = "document.documentElement.setAttribute('data-unloading', '1'); " \
+                       "window.location.href = arguments[0];"
+    LOADED_SCRIPT = "return document.readyState != 'loading' && " \
+                    "!document.documentElement.hasAttribute('data-unloading');"
+
+    def __init__(self, tabbed_browser, window_handle):
+        self.tabbed_browser = tabbed_browser
+        self.window_handle = window_handle
+        self._navigating = False
+
+    @property
+    def service(self):
+        """The driver's service, for the memory of its processes"""
+        return self.tabbed_browser.driver.service
+
+    def _command(self, method, *args):
+        with self.tabbed_browser.lock:
+            self.tabbed_browser.switch_to(self.window_handle)
+            return method(*args)
+
+    def get(self, url_string):
+        """Starts loading url_string in this tab"""
+        self._navigating = True
+        self._command(self.tabbed_browser.driver.execute_script, self.UNLOADING_SCRIPT,
+                      url_string)
+
+    def _page_replaced(self):
+        """False while the tab still shows the page from before the last get"""
+        if self._navigating:
             try:
-                browser_load_url(browser, return_base_url(stock_symbol))
-                retrieved_stock_symbol = browser.find_element_by_xpath\
-                    (const_summary_xpaths_dict['stock_symbol']).text.strip('()').split(':')[1]
-                result_dict['Stock Symbol'] = retrieved_stock_symbol
-            except:
-                result_dict['Stock Symbol'] = 'N/A'
-        
-        if result_dict['Stock Symbol'] != stock_symbol:
-            print "    Still could not find {}, giving up".format(stock_symbol)
-
-        try:
-            result_dict['Exchange'] = browser.find_element_by_xpath\
-                (const_summary_xpaths_dict['stock_symbol']).text.strip('()').split(':')[0]
-        except:
-            result_dict['Exchange'] = 'N/A'
-
-    else: # assume Canada
+                self._navigating = not self.tabbed_browser.driver.execute_script(
+                    self.LOADED_SCRIPT)
+            except WebDriverException: # the old page is being torn down
+                pass
+        return not self._navigating
+
+    def _find_elements(self, xpath_string):
+        if not self._page_replaced():
+            return []
+        return [TabElement(element, self)
+                for element in self.tabbed_browser.driver.find_elements_by_xpath(xpath_string)]
+
+    def find_elements_by_xpath(self, xpath_string):
+        return self._command(self._find_elements, xpath_string)
+
+    def _execute_script(self, script, args):
+        if not self._page_replaced():
+            return None
+        return self.tabbed_browser.driver.execute_script(script, *args)
+
+    def execute_script(self, script, *args):
+        """Runs script on the tab's page, None while it still shows the page from before
+        the last get"""
+        return self._command(self._execute_script, script, args)
+
+    def find_element_by_xpath(self, xpath_string):
+        elements = self.find_elements_by_xpath(xpath_string)
+        if not elements:
+            raise NoSuchElementException('Unable to locate element: {}'.format(xpath_string))
+        return elements[0]
+
+    @property
+    def page_source(self):
+        return self._command(lambda: self.tabbed_browser.driver.page_source)
+
+    @property
+    def current_url(self):
+        return self._command(lambda: self.tabbed_browser.driver.current_url)
+
+    def quit(self):
+        """Closes the tab"""
+        self.tabbed_browser.close_tab(self.window_handle)
+
+class TabElement(object):
+    """Selenium element of a BrowserTab, switches to its tab first"""
+
+    def __init__(self, element, tab):
+        self._element = element
+        self._tab = tab
+
+    @property
+    def text(self):
+        return self._tab._command(lambda: self._element.text)
+
+    def click(self):
+        self._tab._command(self._element.click)
+
+    def get_attribute(self, name):
+        return self._tab._command(self._element.get_attribute, name)
+
+class TabFactory(object):
+    """browser_factory of a BrowserPool lending out the tabs of TabbedBrowsers with
+    num_tabs tabs, a new session is started once all tabs of the last one are lent out"""
+
+    def __init__(self, num_tabs):
+        self.num_tabs = num_tabs
+        self._spare_tabs = []
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            if not self._spare_tabs:
+                with STAGE_TIMER.span('start browser'):
+                    self._spare_tabs = TabbedBrowser(initialize_browser(), self.num_tabs).tabs
+            tab = self._spare_tabs.pop(0)
+        if PAGE_CACHE:
+            return CachingFetcher(tab, PAGE_CACHE)
+        return tab
+
+    def close(self):
+        """Closes the tabs not lent out, so their sessions quit with their last tab"""
+        with self._lock:
+            spare_tabs, self._spare_tabs = self._spare_tabs, []
+        for tab in spare_tabs:
+            try:
+                tab.quit()
+            except Exception:
+                pass
+
+class BrowserPool(object):
+    """Pool of long-lived browser sessions, borrowed per symbol and returned afterwards
+    so a browser is not started and quit for every stock symbol.
+    browser_factory is called to start a session, defaults to initialize_fetcher, or to the
+    tabs of Firefox sessions with num_tabs (default BROWSER_TABS) tabs each.
+    Sessions that loaded max_pages pages or grew past max_rss_mb are replaced when they
+    are returned, between symbols, so their memory growth is capped
+    """
 
+    def __init__(self, size=1, browser_factory=None, max_pages=None, max_rss_mb=None,
+                 num_tabs=None):
+        self.size = size
+        num_tabs = min(num_tabs or BROWSER_TABS, size)
+        if browser_factory is None and FETCHER_TYPE == 'selenium' and num_tabs > 1:
+            browser_factory = TabFactory(num_tabs)
+        self.browser_factory = browser_factory or initialize_fetcher
+        self.max_pages = max_pages or SESSION_MAX_PAGES
+        self.max_rss_mb = max_rss_mb or SESSION_MAX_RSS_MB
+        self._idle_browsers = Queue.Queue()
+        self._lock = threading.Lock()
+        self._num_open = 0
+        self._closed = False
+
+    def acquire(self):
+        """Borrow a healthy browser, starts a new session if the pool is not full yet,
+        otherwise waits for one to be returned"""
+        while True:
+            try:
+                browser = self._idle_browsers.get_nowait()
+            except Queue.Empty:
+                browser = None
+                with self._lock:
+                    start_new_browser = self._num_open < self.size
+                    if start_new_browser:
+                        self._num_open += 1
+                if start_new_browser:
+                    try:
+                        browser = self.browser_factory()
+                        TALLY.add('browser sessions started')
+                        return browser
+                    except:
+                        with self._lock:
+                            self._num_open -= 1
+                        raise
+                try:
+                    browser = self._idle_browsers.get(timeout=1)
+                except Queue.Empty:
+                    continue # a session may have been discarded meanwhile, retry
+
+            if browser_is_alive(browser):
+                return browser
+            print "  Browser session died, replacing it"
+            TALLY.add('browser sessions died')
+            self._discard(browser)
+
+    def release(self, browser):
+        """Return a borrowed browser to the pool, dead sessions and sessions due for
+        recycling are dropped and replaced on a later acquire"""
+        if self._closed or not browser_is_alive(browser):
+            self._discard(browser)
+        elif self._recycle_if_due(browser):
+            self._discard(browser)
+        else:
+            self._idle_browsers.put(browser)
+
+    def _recycle_if_due(self, browser):
+        """True if browser passed the page count or memory limit, logs why"""
+        pages_served = getattr(browser_session(browser), 'pages_served', 0)
+        if self.max_pages and pages_served >= self.max_pages:
+            print "  Recycling browser session after {} pages".format(pages_served)
+            TALLY.add('browser sessions recycled for pages')
+            return True
+        rss_bytes = browser_rss_bytes(browser) if self.max_rss_mb else None
+        if rss_bytes is not None and rss_bytes > self.max_rss_mb * 1024 ** 2:
+            print "  Recycling browser session using {:.0f} MB after {} pages".\
+                format(rss_bytes / 1024.0 ** 2, pages_served)
+            TALLY.add('browser sessions recycled for memory')
+            return True
+        return False
+
+    def close(self):
+        """Quit all idle sessions, borrowed sessions are quit when released"""
+        self._closed = True
+        while True:
+            try:
+                browser = self._idle_browsers.get_nowait()
+            except Queue.Empty:
+                break
+            self._discard(browser)
+        if hasattr(self.browser_factory, 'close'):
+            self.browser_factory.close()
+
+    def _discard(self, browser):
+        """Quit a session and free its slot in the pool"""
+        with self._lock:
+            self._num_open -= 1
         try:
-            retrieved_exchange = browser.find_element_by_xpath\
-                (const_summary_xpaths_dict['stock_symbol']).text.strip('()').split(':')[0]
-            retrieved_stock_symbol = browser.find_element_by_xpath\
-                (const_summary_xpaths_dict['stock_symbol']).text.strip('()').split(':')[1]
-            result_dict['Exchange'] = retrieved_exchange
-            result_dict['Stock Symbol'] = retrieved_stock_symbol
-
-        except:
-            result_dict['Exchange'] = 'N/A'
-            result_dict['Stock Symbol'] = 'N/A'
-
-        if result_dict['Exchange'] != TSE or result_dict['Stock Symbol'] != stock_symbol:
-            print "    Warning 1, {} is not in TSE, retry with CVE".format(stock_symbol)
+            browser_quit(browser)
+        except Exception:
+            pass
+
+## XPATH TABLES, compiled once at import
+_SUMMARY_XPATH_BASE = """/html/body/div[@class='fjfe-bodywrapper']
+    /div[@id='fjfe-real-body']/div[@id='fjfe-click-wrapper']"""
+SUMMARY_XPATHS = {'stock_name' : """{}/div[@id='appbar']/div[@class='elastic']
+                      /div[@class='appbar-center']
+                      /div[@class='appbar-snippet-primary']
+                      /span""".format(_SUMMARY_XPATH_BASE),
+                  'stock_symbol' : """{}/div[@id='appbar']/div[@class='elastic']
+                      /div[@class='appbar-center']
+                      /div[@class='appbar-snippet-secondary']
+                      /span""".format(_SUMMARY_XPATH_BASE),
+                  'current_pe' : """{}/div[@class='elastic']/div[@id='app']
+                      /div[@id='gf-viewc']/div[@class='fjfe-content']
+                      /div[@class='g-wrap']/div[@class='g-section g-tpl-right-1']
+                      /div[@class='g-unit']/div[@id='market-data-div']
+                      /div[@class='snap-panel-and-plusone']/div[@class='snap-panel']
+                      /table[@class='snap-data'][1]/tbody/tr[6]
+                      /td[@class='val']""".format(_SUMMARY_XPATH_BASE),
+                  'employees' : """{}/div[@class='elastic']/div[@id='app']
+                      /div[@id='gf-viewc']/div[@class='fjfe-content']
+                      /div[@class='g-wrap']
+                      /div[@class='g-section g-tpl-right-1 sfe-break-top-5']
+                      /div[@class='g-unit g-first']/div[@class='g-c']
+                      /div[@class='sfe-section'][1]/table[@class='quotes rgt nwp']
+                      /tbody/tr[6]
+                      /td[@class='period'][1]""".format(_SUMMARY_XPATH_BASE),
+                  'market_cap' : """{}/div[@class='elastic']/div[@id='app']
+                      /div[@id='gf-viewc']/div[@class='fjfe-content']
+                      /div[@class='g-wrap']/div[@class='g-section g-tpl-right-1']
+                      /div[@class='g-unit']/div[@id='market-data-div']
+                      /div[@class='snap-panel-and-plusone']/div[@class='snap-panel']
+                      /table[@class='snap-data'][1]/tbody/tr[5]
+                      /td[@class='val']""".format(_SUMMARY_XPATH_BASE),
+                  'country_origin' : """{}/div[@class='elastic']/div[@id='app']
+                      /div[@id='gf-viewc']/div[@class='fjfe-content']
+                      /div[@class='g-wrap']
+                      /div[@class='g-section g-tpl-right-1 sfe-break-top-5']
+                      /div[@class='g-unit g-first']/div[@class='g-c']
+                      /div[@class='sfe-section'][2]""".format(_SUMMARY_XPATH_BASE)
+                 }
+
+# different columns end with different Xpaths
+_FS_XPATH_Y1 = "'][1]"
+_FS_XPATH_YLAST = " rm']"
+_FS_XPATH_Y2 = "'][2]"
+_FS_XPATH_CONTENT = """/html/body/div[@class='fjfe-bodywrapper']/div[@id='fjfe-real-body']
+    /div[@id='fjfe-click-wrapper']/div[@class='elastic']/div[@id='app']/div[@id='gf-viewc']
+    /div[@class='fjfe-content']"""
+
+def income_statement_xpaths(y1_suffix, y2_suffix):
+    """XPaths of the income statement fields, the suffixes pick the current and previous
+    year columns"""
+    const_inc_xpath_base = """{}/div[@id='incannualdiv']
+        /table[@id='fs-table']""".format(_FS_XPATH_CONTENT)
+    return {'multiplier' : """{}/thead/tr/th[@class='lm lft nwp']""".format(const_inc_xpath_base),
+            'total_revenue_this_year' : """{}/tbody/tr[@class='hilite'][1]
+                /td[@class='r bld{}""".format(const_inc_xpath_base, y1_suffix),
+            'cost_of_revenue': """{}/tbody/tr[4]
+                /td[@class='r{}""".format(const_inc_xpath_base, y1_suffix),
+            'gross_profit' : """{}/tbody/tr[@class='hilite'][2]
+                /td[@class='r bld{}""".format(const_inc_xpath_base, y1_suffix),
+            'sell_gen_admin_exp' : """{}/tbody/tr[6]
+                /td[@class='r{}""".format(const_inc_xpath_base, y1_suffix),
+            'r_and_d': """{}/tbody/tr[7]
+                /td[@class='r{}""".format(const_inc_xpath_base, y1_suffix),
+            'net_income_this_year' : """{}/tbody/tr[@class='hilite'][8]
+                /td[@class='r bld{}""".format(const_inc_xpath_base, y1_suffix),
+            'total_revenue_last_year' : """{}/tbody/tr[@class='hilite'][1]
+                /td[@class='r bld{}""".format(const_inc_xpath_base, y2_suffix),
+            'net_income_last_year' : """{}/tbody/tr[@class='hilite'][8]
+                /td[@class='r bld{}""".format(const_inc_xpath_base, y2_suffix),
+            'date_this_year' : """{}/thead/tr
+                /th[@class='rgt{}""".format(const_inc_xpath_base, y1_suffix),
+            'date_last_year' : """{}/thead/tr
+                /th[@class='rgt{}""".format(const_inc_xpath_base, y2_suffix)
+           }
+
+def balance_sheet_xpaths(y1_suffix):
+    """XPaths of the balance sheet fields, the suffix picks the current year column"""
+    const_bal_xpath_base = """{}/div[@id='balannualdiv']
+        /table[@id='fs-table']""".format(_FS_XPATH_CONTENT)
+    return {'multiplier' : """{}/thead/tr/th[@class='lm lft nwp']""".format(const_bal_xpath_base),
+            'cash_short_term_invest' : """{}/tbody/tr[3]
+                /td[@class='r{}""".format(const_bal_xpath_base, y1_suffix),
+            'total_curr_assets' : """{}/tbody/tr[@class='hilite'][1]
+                /td[@class='r bld{}""".format(const_bal_xpath_base, y1_suffix),
+            'total_assets': """{}/tbody/tr[@class='hilite'][2]
+                /td[@class='r bld{}""".format(const_bal_xpath_base, y1_suffix),
+            'total_curr_liab' : """{}/tbody/tr[@class='hilite'][3]
+                /td[@class='r bld{}""".format(const_bal_xpath_base, y1_suffix),
+            'total_liab' : """{}/tbody/tr[@class='hilite'][6]
+                /td[@class='r bld{}""".format(const_bal_xpath_base, y1_suffix),
+            'retained_earn' : """{}/tbody/tr[36]
+                /td[@class='r{}""".format(const_bal_xpath_base, y1_suffix),
+            'total_liab_s_equity' : """{}/tbody/tr[@class='hilite'][8]
+                /td[@class='r bld{}""".format(const_bal_xpath_base, y1_suffix)
+           }
+
+def compile_xpath_table(xpaths_dict):
+    """Compiles every XPath of a field table with lxml"""
+    return {field: lxml_etree.XPath(xpath_string) for field, xpath_string in xpaths_dict.items()}
+
+SUMMARY_XPATH_TABLE = compile_xpath_table(SUMMARY_XPATHS)
+# keyed by the number of year columns, 3 stands for 3 or more
+INCOME_STATEMENT_XPATH_TABLES = {
+    1: compile_xpath_table(income_statement_xpaths(_FS_XPATH_YLAST, _FS_XPATH_YLAST)),
+    2: compile_xpath_table(income_statement_xpaths(_FS_XPATH_Y1, _FS_XPATH_YLAST)),
+    3: compile_xpath_table(income_statement_xpaths(_FS_XPATH_Y1, _FS_XPATH_Y2))}
+BALANCE_SHEET_XPATH_TABLES = {
+    'first': compile_xpath_table(balance_sheet_xpaths(_FS_XPATH_Y1)),
+    'last': compile_xpath_table(balance_sheet_xpaths(_FS_XPATH_YLAST))}
+INCOME_STATEMENT_YEARS_XPATH = lxml_etree.XPath("""{}/div[@id='incannualdiv']
+    /table[@id='fs-table']/thead/tr/th""".format(_FS_XPATH_CONTENT))
+BALANCE_SHEET_YEARS_XPATH = lxml_etree.XPath("""{}/div[@id='balannualdiv']
+    /table[@id='fs-table']/thead/tr/th""".format(_FS_XPATH_CONTENT))
+
+# tabs and links of the financials page, only clicked for a statement the page lacks
+STATEMENT_TAB_XPATHS = {'income_statements' : """{}/div[@id='fs-type-tabs']
+                            /div[@id=':0']/a[@class='t']/b[@class='t']
+                            /b[@class='t']""".format(_FS_XPATH_CONTENT),
+                        'balance_sheet' : """{}/div[@id='fs-type-tabs']
+                            /div[@id=':1']""".format(_FS_XPATH_CONTENT),
+                        'annual_data' : """{}/div[@class='gf-table-control-plain']
+                            /div[@class='g-section g-tpl-67-33 g-split']
+                            /div[@class='g-unit g-first']
+                            /a[@id='annual']""".format(_FS_XPATH_CONTENT),
+                        'annual_data_alt' : """{}/div[@class='gf-table-control-plain']
+                            /div[@class='gf-control']/a[@id='annual']""".format(_FS_XPATH_CONTENT)
+                       }
+# (statement, XPath of its annual table, the same compiled, lists of tabs or links clicked in
+# turn to show it, the first of each list that is on the page)
+ANNUAL_STATEMENTS = [('income statement', INCOME_STATEMENT_READY_XPATH,
+                      lxml_etree.XPath(INCOME_STATEMENT_READY_XPATH),
+                      [['income_statements'], ['annual_data', 'annual_data_alt']]),
+                     ('balance sheet', BALANCE_SHEET_READY_XPATH,
+                      lxml_etree.XPath(BALANCE_SHEET_READY_XPATH), [['balance_sheet']])]
+
+# result column -> field, for fields scaled by the statement's multiplier
+INCOME_STATEMENT_FIELDS = [('Total Revenue Current Year', 'total_revenue_this_year'),
+                           ('Cost of Revenue Total', 'cost_of_revenue'),
+                           ('Gross Profit', 'gross_profit'),
+                           ('Selling General Admin Expenses', 'sell_gen_admin_exp'),
+                           ('Research and Development', 'r_and_d'),
+                           ('Net Income Current Year', 'net_income_this_year'),
+                           ('Total Revenue Last Year', 'total_revenue_last_year'),
+                           ('Net Income Last Year', 'net_income_last_year')]
+BALANCE_SHEET_FIELDS = [('Cash and Short Term Investments', 'cash_short_term_invest'),
+                        ('Total Current Assets', 'total_curr_assets'),
+                        ('Total Assets', 'total_assets'),
+                        ('Total Current Liabilities', 'total_curr_liab'),
+                        ('Total Liabilities', 'total_liab'),
+                        ('Retained Earnings', 'retained_earn'),
+                        ('Total Liabilities and Shareholders Equity', 'total_liab_s_equity')]
+# result columns read from the financials page, see FreshnessIndex
+STATEMENT_COLUMNS = ['Current Year', 'Previous Year'] + \
+    [column for column, field in INCOME_STATEMENT_FIELDS + BALANCE_SHEET_FIELDS]
+
+def parse_page(browser):
+    """Parses the page loaded in browser once, HttpFetchers already hold the parsed page"""
+    if isinstance(browser, (HttpFetcher, CachingFetcher)):
+        return browser.document
+    return parse_html(browser.page_source)
+
+def extract_fields(document, xpath_table):
+    """Evaluates a compiled field table on a parsed page in one pass,
+    returns field -> text of the first match, None where nothing matched"""
+    fields = dict()
+    for field, xpath in xpath_table.items():
+        matches = xpath(document) if document is not None else []
+        fields[field] = element_text(matches[0]) if matches else None
+    return fields
+
+def split_symbol_snippet(fields, index):
+    """Part of the '(EXCHANGE:SYMBOL)' snippet, 0 for exchange, 1 for symbol"""
+    try:
+        return fields['stock_symbol'].strip('()').split(':')[index]
+    except (AttributeError, IndexError):
+        return 'N/A'
+
+def exchanges_to_try(which_country=None, known_exchange=None):
+    """Exchanges to look stock symbols up on in order, None is a search without exchange.
+    A known_exchange, eg from the ExchangeCache, is tried first"""
+    if which_country == 'Canada':
+        exchanges = [TSE, CVE]
+    else: # if USA, or by default
+        exchanges = [NASDAQ, NYSE, None]
+    if known_exchange:
+        exchanges = [known_exchange] + [item for item in exchanges if item != known_exchange]
+    return exchanges
+
+def found_symbol(result_dict, stock_symbol, which_country=None):
+    """True if the summary page loaded was the one of stock_symbol"""
+    if result_dict.get('Stock Symbol') != stock_symbol:
+        return False
+    if which_country == 'Canada':
+        return result_dict.get('Exchange') in (TSE, CVE)
+    return True
+
+def grab_summary_data(browser, stock_symbol, which_country=None, exchanges=None):
+    """Retrieves basic information from a stock's Summary page , eg
+    stock name, symbol, current PE ratio, market cap, employees.
+    The page for the first of exchanges (default exchanges_to_try) must be loaded already,
+    the others are loaded in turn until stock_symbol is found.
+    The extraction is timed as the 'summary' stage, the loads as 'load page'
+    """
+    exchanges = exchanges or exchanges_to_try(which_country)
+    result_dict = dict()
+    start_time = time.time()
+    fields = extract_fields(parse_page(browser), SUMMARY_XPATH_TABLE)
+    extraction_sec = time.time() - start_time
+
+    for attempt, exchange in enumerate(exchanges):
+        if attempt > 0:
+            print "    Warning {}, {} is not in {}, retry with {}".\
+                format(attempt, stock_symbol, exchanges[attempt - 1] or 'search',
+                       exchange or 'empty')
             try:
-                browser_load_url(browser, return_base_url(stock_symbol, CVE))
-                retrieved_exchange = browser.find_element_by_xpath\
-                    (const_summary_xpaths_dict['stock_symbol']).text.strip('()').split(':')[0]
-                retrieved_stock_symbol = browser.find_element_by_xpath\
-                    (const_summary_xpaths_dict['stock_symbol']).text.strip('()').split(':')[1]
-                result_dict['Exchange'] = retrieved_exchange
-                result_dict['Stock Symbol'] = retrieved_stock_symbol
+                browser_load_url(browser, return_base_url(stock_symbol, exchange),
+                                 SUMMARY_READY_XPATH)
+                start_time = time.time()
+                fields = extract_fields(parse_page(browser), SUMMARY_XPATH_TABLE)
+                extraction_sec += time.time() - start_time
             except:
-                result_dict['Exchange'] = 'N/A'
-                result_dict['Stock Symbol'] = 'N/A'
-
-
-        if (result_dict['Exchange'] != CVE and result_dict['Exchange'] != TSE)\
-            or result_dict['Stock Symbol'] != stock_symbol:
+                fields = dict()
+        result_dict['Exchange'] = split_symbol_snippet(fields, 0)
+        result_dict['Stock Symbol'] = split_symbol_snippet(fields, 1)
+        if found_symbol(result_dict, stock_symbol, which_country):
+            break
+    else:
+        print "    Still could not find {}, giving up".format(stock_symbol)
 
-            print "    Still could not find {}, giving up".format(stock_symbol)
+    start_time = time.time()
+    result_dict.update(summary_fields_to_results(fields))
+    STAGE_TIMER.record('summary', extraction_sec + time.time() - start_time)
+    return result_dict
 
-    try:
-        result_dict['Stock Name'] = browser.find_element_by_xpath\
-            (const_summary_xpaths_dict['stock_name']).text
-    except:
+def summary_fields_to_results(fields):
+    """Converts the extracted summary page fields into result columns"""
+    result_dict = dict()
+    if fields.get('stock_name') is not None:
+        result_dict['Stock Name'] = fields['stock_name']
+    else:
         result_dict['Stock Name'] = 'N/A'
     try:
-        market_cap_as_float = convert_readable_num_to_float(browser.find_element_by_xpath\
-            (const_summary_xpaths_dict['market_cap']).text, RESULT_MULTIPLIER)
-        result_dict['Market Cap'] = market_cap_as_float
+        result_dict['Market Cap'] = convert_readable_num_to_float(fields['market_cap'],
+                                                                  RESULT_MULTIPLIER)
     except:
         result_dict['Market Cap'] = 'N/A'
     try:
-        employees_as_string = browser.find_element_by_xpath\
-            (const_summary_xpaths_dict['employees']).text
-        result_dict['Employees'] = int(convert_readable_num_to_float(employees_as_string))
+        result_dict['Employees'] = int(convert_readable_num_to_float(fields['employees']))
     except:
         result_dict['Employees'] = 'N/A'
     try:
-        result_dict['Current PE Ratio'] = browser.find_element_by_xpath\
-            (const_summary_xpaths_dict['current_pe']).text.strip()
+        result_dict['Current PE Ratio'] = fields['current_pe'].strip()
     except:
         result_dict['Current PE Ratio'] = 'N/A'
     try:
-        country_string = browser.find_element_by_xpath\
-            (const_summary_xpaths_dict['country_origin']).text.strip()
-        country_identified = False
-        result_dict['Country'] = country_string
-
-        
+        result_dict['Country'] = fields['country_origin'].strip()
     except:
         result_dict['Country'] = 'N/A'
-
-    
     return result_dict
 
-def grab_income_statement_data(browser):
-    """Extract data from income statement page of Google Finance, need to pass in browser object """
+def scaled_fields_to_results(fields, column_fields_list, multiplier):
+    """Converts statement fields to floats in RESULT_MULTIPLIER units, 'N/A' if missing"""
+    result_dict = dict()
+    for column_name, field in column_fields_list:
+        try:
+            result_dict[column_name] = multiplier * convert_readable_num_to_float(fields[field])
+        except:
+            result_dict[column_name] = 'N/A'
+    return result_dict
 
-    # different columns end with different Xpaths
-    const_bal_xpath_y1 = "'][1]"
-    const_bal_xpath_ylast = " rm']"
-    const_bal_xpath_y2 = "'][2]"
+def find_period_date(date_str):
+    """Period end date in a column header eg '12 months ending 2016-09-24'"""
+    match = re.search('[0-2][0-9][0-9][0-9]-[0-1][0-9]-[0-3][0-9]', date_str)
+    return match.group(0)
 
-    const_inc_xpath_year = """/html/body/div[@class='fjfe-bodywrapper']/div[@id='fjfe-real-body']
-        /div[@id='fjfe-click-wrapper']/div[@class='elastic']/div[@id='app']/div[@id='gf-viewc']
-        /div[@class='fjfe-content']/div[@id='incannualdiv']/table[@id='fs-table']/thead/tr/th"""
+def grab_income_statement_data(browser, document=None):
+    """Extract data from income statement page of Google Finance, need to pass in browser object,
+    or the already parsed page as document"""
+    if document is None:
+        document = parse_page(browser)
 
     # num years to handle which columns refer to this year vs previous year etc.
-    num_years = len(browser.find_elements_by_xpath(const_inc_xpath_year)) - 1
+    num_years = len(INCOME_STATEMENT_YEARS_XPATH(document)) - 1 if document is not None else 0
 
-    if num_years == 0:
+    if num_years <= 0:
         print "      Warning, no income statement data!"
+        note_empty_extraction()
         return {}
     elif num_years == 1:
         print "      Warning, only 1 year of data available."
-        y1_suffix = const_bal_xpath_ylast
-        y2_suffix = const_bal_xpath_ylast
     elif num_years == 2:
         print "      Warning, only 2 years of data available."
-        y1_suffix = const_bal_xpath_y1
-        y2_suffix = const_bal_xpath_ylast
-    else:
-        y1_suffix = const_bal_xpath_y1
-        y2_suffix = const_bal_xpath_y2
-
-    const_inc_xpath_base = """/html/body/div[@class='fjfe-bodywrapper']/div[@id='fjfe-real-body']
-        /div[@id='fjfe-click-wrapper']/div[@class='elastic']/div[@id='app']/div[@id='gf-viewc']
-        /div[@class='fjfe-content']/div[@id='incannualdiv']/table[@id='fs-table']"""
-
-    const_multipler_xpath = """{}/thead/tr/th[@class='lm lft nwp']""".format(const_inc_xpath_base)
-
-    const_income_statements_xpath = {'total_revenue_this_year' : """{}/tbody/tr[@class='hilite'][1]
-                                            /td[@class='r bld{}""".format(const_inc_xpath_base,
-                                                                          y1_suffix),
-                                     'cost_of_revenue': """{}/tbody/tr[4]
-                                            /td[@class='r{}""".format(const_inc_xpath_base,
-                                                                      y1_suffix),
-                                     'gross_profit' : """{}/tbody/tr[@class='hilite'][2]
-                                            /td[@class='r bld{}""".format(const_inc_xpath_base,
-                                                                          y1_suffix),
-                                     'sell_gen_admin_exp' : """{}/tbody/tr[6]
-                                            /td[@class='r{}""".format(const_inc_xpath_base,
-                                                                      y1_suffix),
-                                     'r_and_d': """{}/tbody/tr[7]
-                                            /td[@class='r{}""".format(const_inc_xpath_base,
-                                                                      y1_suffix),
-                                     'net_income_this_year' : """{}/tbody/tr[@class='hilite'][8]
-                                            /td[@class='r bld{}""".format(const_inc_xpath_base,
-                                                                          y1_suffix),
-                                     'total_revenue_last_year' : """{}/tbody/tr[@class='hilite'][1]
-                                            /td[@class='r bld{}""".format(const_inc_xpath_base,
-                                                                          y2_suffix),
-                                     'net_income_last_year' : """{}/tbody/tr[@class='hilite'][8]
-                                            /td[@class='r bld{}""".format(const_inc_xpath_base,
-                                                                          y2_suffix),
-                                     'date_this_year' : """{}/thead/tr
-                                            /th[@class='rgt{}""".format(const_inc_xpath_base,
-                                                                        y1_suffix),
-                                     'date_last_year' : """{}/thead/tr
-                                            /th[@class='rgt{}""".format(const_inc_xpath_base,
-                                                                        y2_suffix)
-                                    }
-    result_dict = dict()
 
-    multiplier = grab_multiplier(browser,
-                                 const_multipler_xpath) / si_suffix_to_float(RESULT_MULTIPLIER)
-    
-    try:
-        result_dict['Total Revenue Current Year'] = multiplier * \
-            convert_readable_num_to_float(browser.find_element_by_xpath\
-            (const_income_statements_xpath['total_revenue_this_year']).text)
-    except:
-        result_dict['Total Revenue Current Year'] = 'N/A'
-    try:
-        result_dict['Cost of Revenue Total'] = multiplier * \
-            convert_readable_num_to_float(browser.find_element_by_xpath\
-            (const_income_statements_xpath['cost_of_revenue']).text)
-    except:
-        result_dict['Cost of Revenue Total'] = 'N/A'
-    try:
-        result_dict['Gross Profit'] = multiplier * \
-            convert_readable_num_to_float(browser.find_element_by_xpath\
-            (const_income_statements_xpath['gross_profit']).text)
-    except:
-        result_dict['Gross Profit'] = 'N/A'
-    try:
-        result_dict['Selling General Admin Expenses'] = multiplier * \
-            convert_readable_num_to_float(browser.find_element_by_xpath\
-            (const_income_statements_xpath['sell_gen_admin_exp']).text)
-    except:
-        result_dict['Selling General Admin Expenses'] = 'N/A'
-    try:
-        result_dict['Research and Development'] = multiplier * \
-            convert_readable_num_to_float(browser.find_element_by_xpath\
-            (const_income_statements_xpath['r_and_d']).text)
-    except:
-        result_dict['Research and Development'] = 'N/A'
-    try:
-        result_dict['Net Income Current Year'] = multiplier * \
-            convert_readable_num_to_float(browser.find_element_by_xpath\
-            (const_income_statements_xpath['net_income_this_year']).text)
-    except:
-        result_dict['Net Income Current Year'] = 'N/A'
-    try:
-        if num_years == 1:
-            result_dict['Total Revenue Last Year'] = 'N/A'
-        else:
-            result_dict['Total Revenue Last Year'] = multiplier * \
-                convert_readable_num_to_float(browser.find_element_by_xpath\
-                (const_income_statements_xpath['total_revenue_last_year']).text)
-    except:
+    fields = extract_fields(document, INCOME_STATEMENT_XPATH_TABLES[min(num_years, 3)])
+    multiplier = multiplier_from_text(fields['multiplier']) / si_suffix_to_float(RESULT_MULTIPLIER)
+
+    result_dict = scaled_fields_to_results(fields, INCOME_STATEMENT_FIELDS, multiplier)
+    if num_years == 1:
         result_dict['Total Revenue Last Year'] = 'N/A'
-    try:
-        if num_years == 1:
-            result_dict['Net Income Last Year'] = 'N/A'
-        else:
-            result_dict['Net Income Last Year'] = multiplier * \
-                convert_readable_num_to_float(browser.find_element_by_xpath\
-                (const_income_statements_xpath['net_income_last_year']).text)
-    except:
         result_dict['Net Income Last Year'] = 'N/A'
 
     try:
-        date_str = browser.find_element_by_xpath\
-            (const_income_statements_xpath['date_this_year']).text
-        match = re.search('[0-2][0-9][0-9][0-9]-[0-1][0-9]-[0-3][0-9]', date_str)
-        result_dict['Current Year'] = match.group(0)
+        result_dict['Current Year'] = find_period_date(fields['date_this_year'])
     except:
         result_dict['Current Year'] = 'N/A'
 
@@ -353,110 +1648,32 @@ def grab_income_statement_data(browser):
         if num_years == 1:
             result_dict['Previous Year'] = 'N/A'
         else:
-            date_str = browser.find_element_by_xpath\
-                (const_income_statements_xpath['date_last_year']).text
-            match = re.search('[0-2][0-9][0-9][0-9]-[0-1][0-9]-[0-3][0-9]', date_str)
-            result_dict['Previous Year'] = match.group(0)
+            result_dict['Previous Year'] = find_period_date(fields['date_last_year'])
     except:
         result_dict['Previous Year'] = 'N/A'
 
     return result_dict
 
-def grab_balance_sheet_data(browser):
+def grab_balance_sheet_data(browser, document=None):
     """ Extract data from Annual Balance Sheet page of a Stock """
-
-    const_bal_xpath_y1 = "'][1]"
-    const_bal_xpath_ylast = " rm']"
-
-    const_bal_xpath_year = """/html/body/div[@class='fjfe-bodywrapper']/div[@id='fjfe-real-body']
-        /div[@id='fjfe-click-wrapper']/div[@class='elastic']/div[@id='app']/div[@id='gf-viewc']
-        /div[@class='fjfe-content']/div[@id='balannualdiv']/table[@id='fs-table']/thead/tr/th"""
+    if document is None:
+        document = parse_page(browser)
 
     # num_years to handle which column refers to this year vs previous year etc.
-    num_years = len(browser.find_elements_by_xpath(const_bal_xpath_year)) - 1
+    num_years = len(BALANCE_SHEET_YEARS_XPATH(document)) - 1 if document is not None else 0
 
-    if num_years == 0:
+    if num_years <= 0:
         print "      Warning, no balance sheet data!"
+        note_empty_extraction()
         return {}
     elif num_years > 2:
-        y1_suffix = const_bal_xpath_y1
+        fields = extract_fields(document, BALANCE_SHEET_XPATH_TABLES['first'])
     else:
-        y1_suffix = const_bal_xpath_ylast
-
-    const_bal_xpath_base = """/html/body/div[@class='fjfe-bodywrapper']/div[@id='fjfe-real-body']
-        /div[@id='fjfe-click-wrapper']/div[@class='elastic']/div[@id='app']/div[@id='gf-viewc']
-        /div[@class='fjfe-content']/div[@id='balannualdiv']/table[@id='fs-table']"""
-
-    const_multiplier_xpath = """{}/thead/tr/th[@class='lm lft nwp']""".format(const_bal_xpath_base)
-    const_balance_sheet_xpaths_dict = {'cash_short_term_invest' : """{}/tbody/tr[3]
-                                            /td[@class='r{}""".format(const_bal_xpath_base,
-                                                                      y1_suffix),
-                                       'total_curr_assets' : """{}/tbody/tr[@class='hilite'][1]
-                                            /td[@class='r bld{}""".format(const_bal_xpath_base,
-                                                                          y1_suffix),
-                                       'total_assets': """{}/tbody/tr[@class='hilite'][2]
-                                            /td[@class='r bld{}""".format(const_bal_xpath_base,
-                                                                          y1_suffix),
-                                       'total_curr_liab' : """{}/tbody/tr[@class='hilite'][3]
-                                            /td[@class='r bld{}""".format(const_bal_xpath_base,
-                                                                          y1_suffix),
-                                       'total_liab' : """{}/tbody/tr[@class='hilite'][6]
-                                            /td[@class='r bld{}""".format(const_bal_xpath_base,
-                                                                          y1_suffix),
-                                       'retained_earn' : """{}/tbody/tr[36]
-                                            /td[@class='r{}""".format(const_bal_xpath_base,
-                                                                      y1_suffix),
-                                       'total_liab_s_equity' : """{}/tbody/tr[@class='hilite'][8]
-                                            /td[@class='r bld{}""".format(const_bal_xpath_base,
-                                                                          y1_suffix)
-                                      }
-    result_dict = dict()
-    multiplier = grab_multiplier(browser,
-                                 const_multiplier_xpath) / si_suffix_to_float(RESULT_MULTIPLIER)
-    try:
-        result_dict['Cash and Short Term Investments'] = multiplier * \
-            convert_readable_num_to_float(browser.find_element_by_xpath\
-            (const_balance_sheet_xpaths_dict['cash_short_term_invest']).text)
-    except:
-        result_dict['Cash and Short Term Investments'] = 'N/A'
-    try:
-        result_dict['Total Current Assets'] = multiplier * \
-            convert_readable_num_to_float(browser.find_element_by_xpath\
-            (const_balance_sheet_xpaths_dict['total_curr_assets']).text)
-    except:
-        result_dict['Total Current Assets'] = 'N/A'
-    try:
-        result_dict['Total Assets'] = multiplier * \
-            convert_readable_num_to_float(browser.find_element_by_xpath\
-            (const_balance_sheet_xpaths_dict['total_assets']).text)
-    except:
-        result_dict['Total Assets'] = 'N/A'
-    try:
-        result_dict['Total Current Liabilities'] = multiplier * \
-            convert_readable_num_to_float(browser.find_element_by_xpath\
-            (const_balance_sheet_xpaths_dict['total_curr_liab']).text)
-    except:
-        result_dict['Total Current Liabilities'] = 'N/A'
-    try:
-        result_dict['Total Liabilities'] = multiplier * \
-            convert_readable_num_to_float(browser.find_element_by_xpath\
-            (const_balance_sheet_xpaths_dict['total_liab']).text)
-    except:
-        result_dict['Total Liabilities'] = 'N/A'
-    try:
-        result_dict['Retained Earnings'] = multiplier * \
-            convert_readable_num_to_float(browser.find_element_by_xpath\
-            (const_balance_sheet_xpaths_dict['retained_earn']).text)
-    except:
-        result_dict['Retained Earnings'] = 'N/A'
-    try:
-        result_dict['Total Liabilities and Shareholders Equity'] = multiplier * \
-            convert_readable_num_to_float(browser.find_element_by_xpath\
-            (const_balance_sheet_xpaths_dict['total_liab_s_equity']).text)
-    except:
-        result_dict['Total Liabilities and Shareholders Equity'] = 'N/A'
+        fields = extract_fields(document, BALANCE_SHEET_XPATH_TABLES['last'])
+
+    multiplier = multiplier_from_text(fields['multiplier']) / si_suffix_to_float(RESULT_MULTIPLIER)
+    return scaled_fields_to_results(fields, BALANCE_SHEET_FIELDS, multiplier)
 
-    return result_dict
 def convert_readable_num_to_float(num_as_string, desired_base_unit=None):
     """ converts dollar numbers as str into floats with a multiplication factor,
     eg 1,000,000 expressed in thousands ('K') becomes 1000.0 """
@@ -477,22 +1694,247 @@ def convert_readable_num_to_float(num_as_string, desired_base_unit=None):
 
     return current_number/desired_multiplier
 
+SI_SUFFIX_TO_FLOAT_DICT = {'K':1000.0, 'M':1000000.0,
+                           'B':1000000000.0, 'T':1000000000000.0
+                          }
+
 def si_suffix_to_float(suffix_string):
-    """TBA"""
-    si_suffix_to_float_dict = {'K':1000.0, 'M':1000000.0,
-                               'B':1000000000.0, 'T':1000000000000.0
-                              }
-    if suffix_string in si_suffix_to_float_dict:
-        return si_suffix_to_float_dict[suffix_string]
+    """Multiplication factor of an SI suffix eg 'K' -> 1000.0, 1.0 for anything else"""
+    if suffix_string in SI_SUFFIX_TO_FLOAT_DICT:
+        return SI_SUFFIX_TO_FLOAT_DICT[suffix_string]
     else:
         return 1.0
 
-def grab_multiplier(browser, xpath_string):
-    """Read the multiplication factor for financials info, e.g. usually Millions, returns float"""
-    raw_string = browser.find_element_by_xpath(xpath_string).text
-    if 'million' in raw_string.lower():
+def require_numpy(feature):
+    """Raises ImportError naming feature if numpy is not installed"""
+    if numpy is None:
+        raise ImportError("{} needs numpy".format(feature))
+
+def _text_array(raw_strings):
+    """String array of raw_strings (any shape) with None as '', and where it was None.
+    Byte strings stay bytes, unless some of them are unicode"""
+    if isinstance(raw_strings, numpy.ndarray) and raw_strings.dtype.kind in 'SU':
+        text, missing = raw_strings, numpy.zeros(raw_strings.shape, dtype=bool)
+    else:
+        raw = numpy.asarray(raw_strings, dtype=object)
+        missing = numpy.equal(raw, None)
+        raw = numpy.where(missing, '', raw)
+        try:
+            text = raw.astype('S')
+        except UnicodeEncodeError:
+            text = raw.astype('U')
+    if text.dtype.itemsize == 0:
+        text = text.astype(text.dtype.kind + '1')
+    return text, missing
+
+def _char_codes(text):
+    """(strings, width) matrix of the characters of text as numbers (bytes or code points),
+    0 past the end of each string, so whole columns of strings are edited with array
+    operations. 0 codes are skipped when the strings are read back, so setting a code
+    to 0 cuts that character out"""
+    code_type = numpy.uint8 if text.dtype.kind == 'S' else numpy.uint32
+    width = text.dtype.itemsize // numpy.dtype(code_type).itemsize
+    return numpy.array(text).reshape(-1).view(code_type).reshape(text.size, width)
+
+def _codes_to_text(codes):
+    """Flat string array of the strings in a code matrix, without the 0 codes"""
+    order = numpy.argsort(codes == 0, axis=1, kind='mergesort') # moves the 0 codes to the end
+    packed = numpy.ascontiguousarray(codes[numpy.arange(len(codes))[:, None], order])
+    kind = 'S' if codes.dtype == numpy.uint8 else 'U'
+    return packed.view('{}{}'.format(kind, codes.shape[1])).reshape(-1)
+
+def _parse_floats_one_by_one(text):
+    """float() on each distinct string of text, returns (values, valid)"""
+    distinct_text, inverse = numpy.unique(text, return_inverse=True)
+    distinct_values = numpy.full(distinct_text.shape, numpy.nan)
+    distinct_valid = numpy.zeros(distinct_text.shape, dtype=bool)
+    for position, item in enumerate(distinct_text):
+        try:
+            distinct_values[position] = float(item)
+            distinct_valid[position] = True
+        except ValueError:
+            pass
+    return distinct_values[inverse], distinct_valid[inverse]
+
+def _codes_to_floats(codes):
+    """Returns (values, valid) of float() on every string of a code matrix, nan where it fails.
+    Plain decimals such as -1234.5 of up to 15 digits are worked out with array arithmetic,
+    exact digits over a power of ten round the same way float() does. The rest, eg
+    exponents or whitespace, go through float() one distinct string at a time"""
+    digits = (codes >= ord('0')) & (codes <= ord('9'))
+    dots = codes == ord('.')
+    first_position = numpy.argmax(codes != 0, axis=1)
+    first_chars = codes[numpy.arange(len(codes)), first_position]
+    leading_signs = ((first_chars == ord('-')) | (first_chars == ord('+')))[:, None] & \
+        (numpy.arange(codes.shape[1]) == first_position[:, None])
+    digit_count = digits.sum(axis=1)
+    plain = ((codes == 0) | digits | dots | leading_signs).all(axis=1) & \
+        (dots.sum(axis=1) <= 1) & (digit_count >= 1) & (digit_count <= 15)
+
+    digit_values = numpy.where(digits, codes - ord('0'), 0).T.astype(numpy.int64)
+    digit_scales = numpy.where(digits.T, 10, 1)
+    mantissa = numpy.zeros(len(codes), dtype=numpy.int64)
+    for column in xrange(codes.shape[1]): # column by column, as rows of the transposed matrix
+        mantissa *= digit_scales[column]
+        mantissa += digit_values[column]
+    fraction_digits = (digits & (numpy.cumsum(dots, axis=1) > 0)).sum(axis=1)
+    values = mantissa / 10.0 ** fraction_digits
+    values = numpy.where(first_chars == ord('-'), -values, values)
+    valid = plain.copy()
+
+    if not plain.all():
+        other = ~plain
+        values[other], valid[other] = _parse_floats_one_by_one(_codes_to_text(codes[other]))
+    return values, valid
+
+def convert_readable_nums_to_floats(nums_as_strings, desired_base_unit=None, multipliers=None):
+    """convert_readable_num_to_float over a whole column or table of strings at once,
+    None for missing cells. Returns (values, valid), float64 and bool arrays of the same shape,
+    valid is False wherever convert_readable_num_to_float would raise.
+    multipliers eg from multipliers_from_texts are broadcast over the values"""
+    require_numpy("convert_readable_nums_to_floats")
+    text, missing = _text_array(nums_as_strings)
+    codes = _char_codes(text)
+    codes[codes == ord(u',')] = 0
+    rows = numpy.arange(len(codes))
+    present = codes != 0
+    last_position = codes.shape[1] - 1 - numpy.argmax(present[:, ::-1], axis=1)
+
+    dashes = (present.sum(axis=1) == 1) & (codes[rows, last_position] == ord(u'-'))
+    codes[rows[dashes], last_position[dashes]] = ord(u'0')
+    if desired_base_unit:
+        desired_multiplier = si_suffix_to_float(desired_base_unit)
+    else:
+        desired_multiplier = 1.0
+
+    last_chars = codes[rows, last_position]
+    current_multiplier = numpy.ones(len(codes))
+    for suffix, suffix_multiplier in SI_SUFFIX_TO_FLOAT_DICT.items():
+        current_multiplier[last_chars == ord(suffix)] = suffix_multiplier
+    if desired_multiplier != 1.0:
+        codes[rows, last_position] = 0
+
+    numbers, valid = _codes_to_floats(codes)
+    values = (numbers * current_multiplier / desired_multiplier).reshape(text.shape)
+    valid = valid.reshape(text.shape) & ~missing
+    if multipliers is not None:
+        values = numpy.asarray(multipliers) * values
+    return numpy.where(valid, values, numpy.nan), valid
+
+def multipliers_from_texts(raw_strings):
+    """multiplier_from_text over an array of table headers, returns float64 array"""
+    require_numpy("multipliers_from_texts")
+    text = numpy.char.lower(_text_array(raw_strings)[0])
+    return numpy.where(numpy.char.find(text, u'million') >= 0, 1000000.0,
+                       numpy.where(numpy.char.find(text, u'thousand') >= 0, 1000.0, 1.0))
+
+# statement -> div holding its fs-table, the financials page holds all of them at once
+FS_TABLE_DIVS = [('income_annual', 'incannualdiv'), ('income_interim', 'incinterimdiv'),
+                 ('balance_annual', 'balannualdiv'), ('balance_interim', 'balinterimdiv'),
+                 ('cash_flow_annual', 'casannualdiv'), ('cash_flow_interim', 'casinterimdiv')]
+FS_TABLE_XPATHS = {statement: lxml_etree.XPath("//div[@id='{}']/table[@id='fs-table']".\
+                                               format(div_id))
+                   for statement, div_id in FS_TABLE_DIVS}
+FS_TABLE_HEADER_XPATH = lxml_etree.XPath("./thead/tr/th")
+FS_TABLE_ROWS_XPATH = lxml_etree.XPath("./tbody/tr")
+FS_TABLE_CELLS_XPATH = lxml_etree.XPath("./td")
+
+class StatementTable(object):
+    """One statement with every row and period, values[row, column] is labels[row] for the
+    period ending periods[column] in RESULT_MULTIPLIER units, valid marks cells with a number"""
+
+    def __init__(self, labels, periods, values, valid):
+        self.labels = list(labels)
+        self.periods = list(periods)
+        self.values = values
+        self.valid = valid
+
+    def value(self, label, period):
+        """Value of the row labelled label for the period ending period, None if missing"""
+        row = self.labels.index(label)
+        column = self.periods.index(period)
+        return self.values[row, column] if self.valid[row, column] else None
+
+def capture_statement_table(table_element):
+    """Converts a whole fs-table element into a StatementTable, None if it has no header"""
+    headers = [element_text(th) for th in FS_TABLE_HEADER_XPATH(table_element)]
+    if not headers:
+        return None
+    periods = []
+    for header in headers[1:]:
+        try:
+            periods.append(find_period_date(header))
+        except AttributeError: # no date in the header
+            periods.append(header)
+    rows = [[element_text(td) for td in FS_TABLE_CELLS_XPATH(tr)]
+            for tr in FS_TABLE_ROWS_XPATH(table_element)]
+    rows = [row for row in rows if row]
+    cells = numpy.empty((len(rows), len(periods)), dtype=object) # None where a row is short
+    for row_number, row in enumerate(rows):
+        row_cells = row[1:len(periods) + 1]
+        cells[row_number, :len(row_cells)] = row_cells
+    multiplier = multiplier_from_text(headers[0]) / si_suffix_to_float(RESULT_MULTIPLIER)
+    values, valid = convert_readable_nums_to_floats(cells, multipliers=multiplier)
+    return StatementTable([row[0] for row in rows], periods, values, valid)
+
+def capture_statement_tables(document):
+    """Every statement table of a parsed financials page, statement -> StatementTable"""
+    require_numpy("capture_statement_tables")
+    tables = dict()
+    for statement, xpath in FS_TABLE_XPATHS.items():
+        matches = xpath(document) if document is not None else []
+        table = capture_statement_table(matches[0]) if matches else None
+        if table is not None:
+            tables[statement] = table
+    return tables
+
+class StatementStore(object):
+    """Keeps the full statements of each symbol in store_dir as EXCHANGE_SYMBOL.npz,
+    with arrays <statement>.values, .valid, .labels and .periods"""
+
+    def __init__(self, store_dir):
+        require_numpy("StatementStore")
+        self.store_dir = store_dir
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+    def fullpath(self, stock_symbol, exchange):
+        """Where the statements of stock_symbol on exchange are saved"""
+        return os.path.join(self.store_dir, '{}_{}.npz'.format(exchange, stock_symbol))
+
+    def save(self, stock_symbol, exchange, tables):
+        """Saves {statement: StatementTable} of a symbol, replacing what was saved before"""
+        arrays = dict()
+        for statement, table in tables.items():
+            arrays[statement + '.values'] = table.values
+            arrays[statement + '.valid'] = table.valid
+            arrays[statement + '.labels'] = numpy.array(table.labels, dtype='U')
+            arrays[statement + '.periods'] = numpy.array(table.periods, dtype='U')
+        npz_buffer = StringIO.StringIO()
+        numpy.savez_compressed(npz_buffer, **arrays)
+        write_file_atomically(self.fullpath(stock_symbol, exchange), npz_buffer.getvalue())
+
+    def load(self, stock_symbol, exchange):
+        """{statement: StatementTable} saved for a symbol, empty if there are none"""
+        try:
+            saved = numpy.load(self.fullpath(stock_symbol, exchange))
+        except IOError:
+            return dict()
+        with saved:
+            statements = set(name.rsplit('.', 1)[0] for name in saved.files)
+            return {statement: StatementTable(saved[statement + '.labels'],
+                                              saved[statement + '.periods'],
+                                              saved[statement + '.values'],
+                                              saved[statement + '.valid'])
+                    for statement in statements}
+
+STATEMENT_STORE = None
+
+def multiplier_from_text(raw_string):
+    """Multiplication factor from a table header eg 'In Millions of USD', returns float"""
+    if raw_string and 'million' in raw_string.lower():
         return 1000000.0
-    elif 'thousand' in raw_string.lower():
+    elif raw_string and 'thousand' in raw_string.lower():
         return 1000.0
     else:
         return 1.0
@@ -500,125 +1942,218 @@ def clean_up_stock_symbol(input_stock_symbol):
     """Handles stock symbols with whitespace, but also, those that use hats ^
     to distinguish stock_classes eg DD^B for B class DD shares, should be DD-B"""
     return input_stock_symbol.strip().replace('^', '-')
-def scrape(stock_symbol, which_country=None):
-    """Visits website to scrape data on stock_symbol in exchange."""
-    ## SELENIUM PATH CONSTANTS
-    const_page_xpaths_dict = {'income_statements' : """/html/body/div[@class='fjfe-bodywrapper']
-        /div[@id='fjfe-real-body']/div[@id='fjfe-click-wrapper']/div[@class='elastic']
-        /div[@id='app']/div[@id='gf-viewc']/div[@class='fjfe-content']/div[@id='fs-type-tabs']
-        /div[@id=':0']/a[@class='t']/b[@class='t']/b[@class='t']""",
-                              'balance_sheet' : """/html/body/div[@class='fjfe-bodywrapper']
-        /div[@id='fjfe-real-body']/div[@id='fjfe-click-wrapper']/div[@class='elastic']
-        /div[@id='app']/div[@id='gf-viewc']/div[@class='fjfe-content']/div[@id='fs-type-tabs']
-        /div[@id=':1']""",
-                              'annual_data' : """/html/body/div[@class='fjfe-bodywrapper']
-        /div[@id='fjfe-real-body']/div[@id='fjfe-click-wrapper']/div[@class='elastic']
-        /div[@id='app']/div[@id='gf-viewc']/div[@class='fjfe-content']
-        /div[@class='gf-table-control-plain']/div[@class='g-section g-tpl-67-33 g-split']
-        /div[@class='g-unit g-first']/a[@id='annual']""",
-                              'annual_data_alt' : """/html/body/div[@class='fjfe-bodywrapper']
-        /div[@id='fjfe-real-body']/div[@id='fjfe-click-wrapper']/div[@class='elastic']
-        /div[@id='app']/div[@id='gf-viewc']/div[@class='fjfe-content']
-        /div[@class='gf-table-control-plain']/div[@class='gf-control']/a[@id='annual']"""}
-    
-    browser = initialize_browser()
-    if not which_country or which_country != 'Canada':
-        browser_load_url(browser, return_base_url(stock_symbol, NASDAQ)) # assume NASDAQ
-    else: # assume Canada
-        browser_load_url(browser, return_base_url(stock_symbol, TSE)) # assume TSE
-
-    stock_result_dict = dict()
-    stock_result_dict.update(grab_summary_data(browser, stock_symbol, which_country))
-    
-    loaded_income_statement = True
-    loaded_balance_sheet = True
-    try:
-        browser_load_url(browser, return_finance_url(stock_result_dict['Stock Symbol'], stock_result_dict['Exchange']))
-    except:
-        print "Could not load Financial Data"
-        loaded_income_statement = False
-        loaded_balance_sheet = False
-    try:
-        browser_xpath_click(browser, const_page_xpaths_dict['income_statements'])
-    except:
-        print "Could not load Income Statement"
-        loaded_income_statement = False
-    try:
-        if loaded_income_statement:
-            browser_xpath_click(browser, const_page_xpaths_dict['annual_data'])
-    except:
-        if loaded_income_statement:
-            browser_xpath_click(browser, const_page_xpaths_dict['annual_data_alt'])
-            print "Did not work, clicking on alternate Annual Data"
-    if loaded_income_statement:
-        stock_result_dict.update(grab_income_statement_data(browser))
-    try:
-        browser_xpath_click(browser, const_page_xpaths_dict['balance_sheet'])
-    except:
-        print "Could not load Balance Sheet"
-        loaded_balance_sheet = False
-    if loaded_balance_sheet:
-        stock_result_dict.update(grab_balance_sheet_data(browser))
 
-    if loaded_income_statement:
+def symbol_key(stock_symbol, which_country=None):
+    """Symbols with the same key scrape the same pages, eg one ticker in several lists.
+    Case is kept, found_symbol tells 'abc' and 'ABC' apart too"""
+    return clean_up_stock_symbol(stock_symbol), which_country
+
+# derived result column -> (sign, result column) terms it is the sum of
+DERIVED_METRICS = [('Other', [(1, 'Gross Profit'), (-1, 'Selling General Admin Expenses'),
+                              (-1, 'Research and Development'), (-1, 'Net Income Current Year')]),
+                   ('Other Assets', [(1, 'Total Current Assets'),
+                                     (-1, 'Cash and Short Term Investments')]),
+                   ('Fixed Assets', [(1, 'Total Assets'), (-1, 'Total Current Assets')]),
+                   ('Share Equity', [(1, 'Retained Earnings'), (-1, 'Total Liabilities')]),
+                   ('Long Term Liabilities', [(1, 'Total Liabilities'),
+                                              (-1, 'Total Current Liabilities')])]
+
+def derive_metrics(result_dict, metrics=None):
+    """Works out the DERIVED_METRICS of one scraped symbol, 'N/A' where an input is missing"""
+    derived_dict = dict()
+    for metric, terms in metrics or DERIVED_METRICS:
         try:
-            stock_result_dict['Other'] = stock_result_dict['Gross Profit'] - \
-                                     stock_result_dict['Selling General Admin Expenses'] - \
-                                     stock_result_dict['Research and Development'] - \
-                                     stock_result_dict['Net Income Current Year']
+            sign, column = terms[0]
+            value = sign * result_dict[column]
+            for sign, column in terms[1:]:
+                value = value - result_dict[column] if sign < 0 else value + result_dict[column]
+            derived_dict[metric] = value
         except (TypeError, KeyError):
-            stock_result_dict['Other'] = 'N/A'
+            derived_dict[metric] = 'N/A'
+    return derived_dict
+
+def load_annual_statements(browser, stock_symbol, exchange):
+    """Loads the financials page of stock_symbol once and parses it, returns statement ->
+    parsed page holding its annual table. Like on Google Finance the page holds every
+    statement and its tabs only switch which one is shown, so the income statement and
+    balance sheet come from the same load. Tabs are only clicked for a statement it lacks"""
+    browser_load_url(browser, return_finance_url(stock_symbol, exchange), FINANCIALS_READY_XPATH)
+    document = parse_page(browser)
+    documents = dict()
+    for statement, ready_xpath, table_xpath, tab_names_lists in ANNUAL_STATEMENTS:
+        if document is None or not table_xpath(document):
+            TALLY.add('statement tab clicks')
+            try:
+                click_statement_tabs(browser, tab_names_lists, ready_xpath)
+            except:
+                print "Could not load {}".format(statement.title())
+                continue
+            document = parse_page(browser)
+        documents[statement] = document
+    return documents
+
+def click_statement_tabs(browser, tab_names_lists, ready_xpath):
+    """Clicks the first tab or link of each list of STATEMENT_TAB_XPATHS names that is on the
+    page, then waits for the statement matching ready_xpath"""
+    for tab_names in tab_names_lists:
+        for tab_name in tab_names:
+            if browser.find_elements_by_xpath(STATEMENT_TAB_XPATHS[tab_name]):
+                browser_xpath_click(browser, STATEMENT_TAB_XPATHS[tab_name])
+                break
+        else:
+            raise NoSuchElementException('None of {} is on the page'.format(', '.join(tab_names)))
+    wait_until_ready(browser, ready_xpath)
+
+def scrape(stock_symbol, which_country=None, browser=None):
+    """Visits website to scrape data on stock_symbol in exchange.
+    Uses browser if given (eg borrowed from a BrowserPool), otherwise starts and quits its own
+    """
+    if EXCHANGE_CACHE:
+        exchange_known, known_exchange = EXCHANGE_CACHE.lookup(stock_symbol, which_country)
+        if exchange_known and not known_exchange:
+            print "    Skipping {}, it was not found on a recent run".format(stock_symbol)
+            return dict()
     else:
-        stock_result_dict['Other'] = 'N/A'
+        known_exchange = None
+    exchanges = exchanges_to_try(which_country, known_exchange) # NASDAQ or TSE unless known
 
-    if loaded_balance_sheet:
-        try:
-            stock_result_dict['Other Assets'] = stock_result_dict['Total Current Assets'] - \
-                                                stock_result_dict['Cash and Short Term Investments']
-        except (TypeError, KeyError):
-            stock_result_dict['Other Assets'] = 'N/A'
+    owns_browser = browser is None
+    if owns_browser:
+        browser = initialize_fetcher()
+    try:
+        browser_load_url(browser, return_base_url(stock_symbol, exchanges[0]), SUMMARY_READY_XPATH)
+
+        stock_result_dict = dict()
+        stock_result_dict.update(grab_summary_data(browser, stock_symbol, which_country, exchanges))
+        if EXCHANGE_CACHE:
+            if found_symbol(stock_result_dict, stock_symbol, which_country):
+                EXCHANGE_CACHE.record(stock_symbol, which_country, stock_result_dict['Exchange'])
+            elif not getattr(SCRAPE_HEALTH, 'load_failures', 0): # not found, not just failed
+                EXCHANGE_CACHE.record(stock_symbol, which_country, None)
+
+        current_statements = None
+        if FRESHNESS_INDEX and found_symbol(stock_result_dict, stock_symbol, which_country):
+            current_statements = FRESHNESS_INDEX.lookup(stock_symbol, which_country,
+                                                        stock_result_dict['Exchange'])
+            if current_statements is not None:
+                print "    Statements still current, not reloading them"
+                stock_result_dict.update(current_statements)
+
+        statement_documents = dict()
         try:
-            stock_result_dict['Fixed Assets'] = stock_result_dict['Total Assets'] - \
-                                                stock_result_dict['Total Current Assets']
-        except (TypeError, KeyError):
-            stock_result_dict['Fixed Assets'] = 'N/A'
+            if found_symbol(stock_result_dict, stock_symbol, which_country) and \
+                    current_statements is None:
+                statement_documents = load_annual_statements(browser,
+                                                             stock_result_dict['Stock Symbol'],
+                                                             stock_result_dict['Exchange'])
+        except:
+            print "Could not load Financial Data"
+        loaded_income_statement = 'income statement' in statement_documents
+        loaded_balance_sheet = 'balance sheet' in statement_documents
+        if loaded_income_statement and STATEMENT_STORE:
+            try:
+                STATEMENT_STORE.save(stock_result_dict['Stock Symbol'],
+                                     stock_result_dict['Exchange'],
+                                     capture_statement_tables(
+                                         statement_documents['income statement']))
+            except:
+                print "Could not save full statements"
+        if loaded_income_statement:
+            with STAGE_TIMER.span('income statement'):
+                stock_result_dict.update(grab_income_statement_data(
+                    browser, statement_documents['income statement']))
+        if loaded_balance_sheet:
+            with STAGE_TIMER.span('balance sheet'):
+                stock_result_dict.update(grab_balance_sheet_data(
+                    browser, statement_documents['balance sheet']))
+        if FRESHNESS_INDEX and loaded_income_statement and loaded_balance_sheet:
+            FRESHNESS_INDEX.record(stock_symbol, which_country, stock_result_dict)
+
+        stock_result_dict.update(derive_metrics(stock_result_dict))
+        return stock_result_dict
+    finally:
+        if owns_browser:
+            browser_quit(browser)
+
+RESULT_ORDER_LIST = ['Stock Symbol', 'Exchange', 'Stock Name', 'Country', 'Current Year',
+                     'Previous Year', 'Total Revenue Current Year', 'Cost of Revenue Total',
+                     'Gross Profit', 'Selling General Admin Expenses', 'Research and Development',
+                     'Other', 'Net Income Current Year', 'Total Revenue Last Year',
+                     'Net Income Last Year', 'Cash and Short Term Investments', 'Other Assets',
+                     'Total Current Assets', 'Fixed Assets', 'Total Assets',
+                     'Total Current Liabilities', 'Long Term Liabilities', 'Total Liabilities',
+                     'Share Equity', 'Retained Earnings',
+                     'Total Liabilities and Shareholders Equity', 'Employees', 'Market Cap',
+                     'Current PE Ratio']
+
+class TransientScrapeError(Exception):
+    """Pages of a symbol failed to load and its results are incomplete, try it again later.
+    stock_results_dict holds what was scraped, kept if the symbol keeps failing"""
+
+    def __init__(self, message, stock_results_dict=None):
+        Exception.__init__(self, message)
+        self.stock_results_dict = stock_results_dict
+
+def scrape_symbol(stock_symbol, which_country=None, browser_pool=None):
+    """Scrapes stock_symbol into a dict with every column of RESULT_ORDER_LIST,
+    missing data is 'N/A'. Borrows a browser from browser_pool if given.
+    Raises TransientScrapeError if data is missing because pages failed to load"""
+    stock_results_dict = {item: 'N/A' for item in RESULT_ORDER_LIST}
+    SCRAPE_HEALTH.load_failures = 0
+    SCRAPE_HEALTH.page_urls = []
+
+    with concurrency_slot():
+        start_time = time.time()
         try:
-            stock_result_dict['Share Equity'] = stock_result_dict['Retained Earnings'] - \
-                                                stock_result_dict['Total Liabilities']
-        except (TypeError, KeyError):
-            stock_result_dict['Share Equity'] = 'N/A'
+            if browser_pool:
+                browser = browser_pool.acquire()
+                try:
+                    stock_results_dict.update(scrape(clean_up_stock_symbol(stock_symbol),
+                                                     which_country, browser))
+                finally:
+                    browser_pool.release(browser)
+            else:
+                stock_results_dict.update(scrape(clean_up_stock_symbol(stock_symbol),
+                                                 which_country))
+        except Exception as error:
+            if not SCRAPE_HEALTH.load_failures:
+                raise
+            print "    Could not load {}: {}".format(stock_symbol, error)
+        finally:
+            TALLY.add('scrape sec', time.time() - start_time)
+            STAGE_TIMER.record('symbol', time.time() - start_time)
+    if SCRAPE_HEALTH.load_failures and 'N/A' in (stock_results_dict['Stock Symbol'],
+                                                 stock_results_dict['Current Year']):
+        TALLY.add('transient failures')
+        if PAGE_CACHE: # the next attempt loads them from the web again
+            for url_string in SCRAPE_HEALTH.page_urls:
+                PAGE_CACHE.delete(url_string)
+        raise TransientScrapeError('{} of {} pages did not load'.\
+            format(SCRAPE_HEALTH.load_failures, stock_symbol), stock_results_dict)
+    return stock_results_dict
+
+def scrape_with_retries(stock_symbol, which_country=None, browser_pool=None):
+    """scrape_listed_symbol, trying symbols whose pages failed to load again after
+    SCRAPE_RETRY_SEC (doubling), up to SCRAPE_MAX_ATTEMPTS times, then their row keeps what
+    the last attempt scraped"""
+    for attempt in xrange(1, SCRAPE_MAX_ATTEMPTS + 1):
         try:
-            stock_result_dict['Long Term Liabilities'] = stock_result_dict['Total Liabilities'] - \
-                                                stock_result_dict['Total Current Liabilities']
-        except (TypeError, KeyError):
-            stock_result_dict['Long Term Liabilities'] = 'N/A'
-
-    else:
-        stock_result_dict['Other Assets'] = 'N/A'
-        stock_result_dict['Fixed Assets'] = 'N/A'
-        stock_result_dict['Share Equity'] = 'N/A'
-        stock_result_dict['Long Term Liabilities'] = 'N/A'
-
-    browser_quit(browser)
-    return stock_result_dict
-
-def scrape_and_write_to_file(stock_symbol, results_filename, results_dir_name, which_country=None):
-    """Main function to scrape and analyze, split up into scrape and analyze steps"""
-
-    result_order_list = ['Stock Symbol', 'Exchange', 'Stock Name', 'Country', 'Current Year', 'Previous Year',
-                         'Total Revenue Current Year', 'Cost of Revenue Total', 'Gross Profit',
-                         'Selling General Admin Expenses', 'Research and Development', 'Other',
-                         'Net Income Current Year', 'Total Revenue Last Year',
-                         'Net Income Last Year', 'Cash and Short Term Investments', 'Other Assets',
-                         'Total Current Assets', 'Fixed Assets', 'Total Assets',
-                         'Total Current Liabilities', 'Long Term Liabilities', 'Total Liabilities',
-                         'Share Equity', 'Retained Earnings',
-                         'Total Liabilities and Shareholders Equity', 'Employees', 'Market Cap',
-                         'Current PE Ratio']
-    stock_results_dict = {item: 'N/A' for item in result_order_list}
-
-    stock_results_dict.update(scrape(clean_up_stock_symbol(stock_symbol), which_country))
-
+            return scrape_listed_symbol(stock_symbol, which_country, browser_pool)
+        except TransientScrapeError as error:
+            print "   {}, attempt {} of {}".format(error, attempt, SCRAPE_MAX_ATTEMPTS)
+            stock_results_dict = error.stock_results_dict
+            if attempt < SCRAPE_MAX_ATTEMPTS:
+                TALLY.add('transient retries')
+                time.sleep(SCRAPE_RETRY_SEC * 2 ** (attempt - 1))
+    print "   Giving up on", stock_symbol
+    return stock_results_dict
+
+def write_result_row(stock_results_dict, results_filename, results_dir_name):
+    """Appends one row to the results file, writing the header first for a new file"""
+    with STAGE_TIMER.span('write results'):
+        _write_result_row(stock_results_dict, results_filename, results_dir_name)
+
+def _write_result_row(stock_results_dict, results_filename, results_dir_name):
     if not os.path.exists('{}'.format(results_dir_name)):
         os.makedirs(results_dir_name)
     results_fullpath = '{}/{}'.format(results_dir_name, results_filename)
@@ -627,17 +2162,519 @@ def scrape_and_write_to_file(stock_symbol, results_filename, results_dir_name, w
         print "Saving in", results_fullpath
         with open(results_fullpath, 'w') as results_file:
             csv_writer = csv.writer(results_file, quoting=csv.QUOTE_ALL)
-            csv_writer.writerow(result_order_list)
+            csv_writer.writerow(RESULT_ORDER_LIST)
 
     with open(results_fullpath, 'a+') as results_file:
         csv_writer = csv.writer(results_file, quoting=csv.QUOTE_ALL)
-        csv_writer.writerow([stock_results_dict[item] for item in result_order_list])
-
-def process_dir(data_dir_name, logs_dir_name, results_dir_name):
+        csv_writer.writerow([stock_results_dict[item] for item in RESULT_ORDER_LIST])
+
+def scrape_and_write_to_file(stock_symbol, results_filename, results_dir_name, which_country=None,
+                             browser_pool=None):
+    """Main function to scrape and analyze, split up into scrape and analyze steps
+    Borrows a browser from browser_pool if given"""
+    stock_results_dict = scrape_symbol(stock_symbol, which_country, browser_pool)
+    write_result_row(stock_results_dict, results_filename, results_dir_name)
+
+class SharedSymbols(object):
+    """Results of symbols listed more than once in the lists of a run, kept from their first
+    scrape until every other listing took them. listing_counts maps symbol_key to the
+    number of listings still to do, see plan_shared_symbols"""
+
+    def __init__(self, listing_counts):
+        self._remaining = {key: count for key, count in listing_counts.items() if count > 1}
+        self._results = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._remaining)
+
+    def take(self, stock_symbol, which_country=None):
+        """Results already scraped for another listing of the symbol, None if there are none"""
+        key = symbol_key(stock_symbol, which_country)
+        with self._lock:
+            if key not in self._results:
+                return None
+            stock_results_dict = self._results[key]
+            self._listing_done(key)
+        TALLY.add('duplicate symbols skipped')
+        return dict(stock_results_dict)
+
+    def scraped(self, stock_symbol, which_country=None):
+        """True if the results of the symbol are kept for another listing"""
+        with self._lock:
+            return symbol_key(stock_symbol, which_country) in self._results
+
+    def keep(self, stock_symbol, which_country, stock_results_dict):
+        """Holds on to the results of a symbol that other listings still need"""
+        key = symbol_key(stock_symbol, which_country)
+        with self._lock:
+            if key in self._remaining:
+                self._results[key] = stock_results_dict
+                self._listing_done(key)
+
+    def _listing_done(self, key):
+        self._remaining[key] -= 1
+        if not self._remaining[key]:
+            del self._remaining[key]
+            self._results.pop(key, None)
+
+SHARED_SYMBOLS = None
+
+def plan_shared_symbols(file_list, data_dir_name, logs_dir_name):
+    """Planning pass over the rows still to do of every list in file_list,
+    returns SharedSymbols for the symbols listed more than once"""
+    listing_counts = dict()
+    for work_filename in file_list:
+        row_to_work_on = checkpoint_row('{}/log_{}.txt'.format(logs_dir_name, work_filename))
+        if row_to_work_on < 0:
+            continue
+        which_country = which_country_for_file(work_filename)
+        try:
+            row_index = RowOffsetIndex('{}/{}'.format(data_dir_name, work_filename),
+                                       row_index_fullpath(logs_dir_name, work_filename))
+        except (IOError, OSError): # reported when the list is processed
+            continue
+        for row in row_index.rows_from(row_to_work_on):
+            key = symbol_key(row[0] if row else '', which_country)
+            listing_counts[key] = listing_counts.get(key, 0) + 1
+    shared_symbols = SharedSymbols(listing_counts)
+    if shared_symbols:
+        print " {} symbols are listed more than once, each is scraped once".\
+            format(len(shared_symbols))
+    return shared_symbols
+
+def scrape_listed_symbol(stock_symbol, which_country=None, browser_pool=None):
+    """scrape_symbol, except for symbols SHARED_SYMBOLS already has the results of"""
+    if SHARED_SYMBOLS is None:
+        return scrape_symbol(stock_symbol, which_country, browser_pool)
+    stock_results_dict = SHARED_SYMBOLS.take(stock_symbol, which_country)
+    if stock_results_dict is None:
+        stock_results_dict = scrape_symbol(stock_symbol, which_country, browser_pool)
+        SHARED_SYMBOLS.keep(stock_symbol, which_country, stock_results_dict)
+    else:
+        print "   already scraped for another list"
+    return stock_results_dict
+
+class TokenBucket(object):
+    """Token bucket refilled at rate tokens per sec, holding at most burst tokens.
+    Each request takes a token, once they run out requests queue up behind each other"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token, returns sec to wait before the request may be sent"""
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+class HostRateLimiter(object):
+    """Politeness policy, a token bucket per host lets through bursts of up to burst
+    page loads while keeping each host at requests_per_sec on average (None for no cap),
+    host_rates overrides the rate per host. Shared by all threads of a process"""
+
+    def __init__(self, requests_per_sec=None, host_rates=None, burst=1):
+        self.requests_per_sec = requests_per_sec
+        self.host_rates = host_rates or dict()
+        self.burst = burst
+        self.scale = 1.0 # fraction of the rates in use, set by the AdaptiveController
+        self._buckets = dict()
+        self._lock = threading.Lock()
+
+    def _host_rate(self, host):
+        requests_per_sec = self.host_rates.get(host, self.requests_per_sec)
+        return requests_per_sec * self.scale if requests_per_sec else None
+
+    def set_scale(self, scale):
+        """Runs every host at scale times its rate"""
+        with self._lock:
+            self.scale = scale
+            for host, bucket in self._buckets.items():
+                if bucket:
+                    bucket.rate = self._host_rate(host)
+
+    def wait(self, url_string):
+        """Blocks until a request to the host of url_string is allowed, returns sec waited"""
+        host = urlparse.urlparse(url_string).netloc
+        with self._lock:
+            if host not in self._buckets:
+                requests_per_sec = self._host_rate(host)
+                self._buckets[host] = TokenBucket(requests_per_sec, self.burst) \
+                    if requests_per_sec else None
+            bucket = self._buckets[host]
+        if not bucket:
+            return 0.0
+        delay = bucket.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+class AdaptiveController(object):
+    """AIMD control of the symbols scraped at once (up to max_concurrency) and of the request
+    rate (a fraction of the RATE_LIMITER caps). After every window page loads, if more than
+    max_failure_rate of them failed (errors, timeouts) or the median load took over
+    max_load_sec, both are halved and scraping pauses for a backoff that doubles while bad
+    windows follow each other. Otherwise concurrency grows by one and the rate by
+    ADAPTIVE_RATE_STEP. Failures are counted per page load, not per symbol, so the few
+    failed pages retries recover do not make it back off"""
+
+    def __init__(self, max_concurrency, window=None, max_failure_rate=None, max_load_sec=None,
+                 backoff_sec=None):
+        self.max_concurrency = max_concurrency
+        self.window = window or ADAPTIVE_WINDOW
+        self.max_failure_rate = ADAPTIVE_MAX_FAILURE_RATE if max_failure_rate is None \
+            else max_failure_rate
+        self.max_load_sec = max_load_sec or ADAPTIVE_MAX_LOAD_SEC
+        self.backoff_sec = ADAPTIVE_BACKOFF_SEC if backoff_sec is None else backoff_sec
+        self.concurrency = max_concurrency
+        self.rate_scale = 1.0
+        self.adjustments = 0
+        self._backoff = self.backoff_sec
+        self._paused_until = 0.0
+        self._in_flight = 0
+        self._failures = 0
+        self._load_secs = []
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Waits until one more symbol may be scraped"""
+        with self._condition:
+            while True:
+                pause = self._paused_until - time.time()
+                if pause > 0:
+                    self._condition.wait(pause)
+                elif self._in_flight < self.concurrency:
+                    break
+                else:
+                    self._condition.wait(1)
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def record_load(self, seconds, failed=False):
+        """Feedback of one page load, adjusts after every window loads"""
+        with self._condition:
+            self._load_secs.append(seconds)
+            self._failures += bool(failed)
+            if len(self._load_secs) >= self.window:
+                self._adjust()
+
+    def _adjust(self):
+        self.adjustments += 1
+        failure_rate = self._failures / float(len(self._load_secs))
+        median_load = sorted(self._load_secs)[len(self._load_secs) // 2]
+        if failure_rate > self.max_failure_rate or median_load > self.max_load_sec:
+            self.concurrency = max(1, self.concurrency // 2)
+            self.rate_scale = max(ADAPTIVE_MIN_RATE, self.rate_scale / 2)
+            self._paused_until = time.time() + self._backoff
+            print "  Backing off for {} sec, {:.0%} of pages failed, median load {:.1f} sec: " \
+                  "{} at once, {:.0%} of the rate".format(self._backoff, failure_rate,
+                                                         median_load, self.concurrency,
+                                                         self.rate_scale)
+            TALLY.add('adaptive backoffs')
+            self._backoff = min(self._backoff * 2, ADAPTIVE_MAX_BACKOFF_SEC)
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self.rate_scale = min(1.0, self.rate_scale + ADAPTIVE_RATE_STEP)
+            self._backoff = self.backoff_sec
+        if RATE_LIMITER:
+            RATE_LIMITER.set_scale(self.rate_scale)
+        self._failures = 0
+        self._load_secs = []
+        self._condition.notify_all()
+
+CONTROLLER = None
+
+@contextlib.contextmanager
+def concurrency_slot():
+    """Waits for the CONTROLLER, if any, to let one more symbol be scraped"""
+    if CONTROLLER:
+        with CONTROLLER.slot():
+            yield
+    else:
+        yield
+
+def fetch_pages(url_list, max_in_flight=None, ready_xpath=None):
+    """Fetches url_list with up to max_in_flight requests in flight from this one process,
+    each waiting for its host's token bucket first so the pipeline runs at the allowed rate.
+    Every thread keeps its own keep-alive HttpFetcher. Pages in the PAGE_CACHE are not
+    fetched again and fetched ones with an element matching ready_xpath (SITE_PAGE_XPATH
+    by default) are stored there. url_list may be any iterable, eg a generator that waits
+    for more urls to be queued.
+    Yields (url, page source, error) as they complete, page source is None on an error"""
+    max_in_flight = max_in_flight or MAX_IN_FLIGHT
+    ready_xpath = ready_xpath or SITE_PAGE_XPATH
+    thread_state = threading.local()
+    fetchers = []
+    fetchers_lock = threading.Lock()
+
+    def fetch(url_string):
+        """Runs in a pipeline thread"""
+        if PAGE_CACHE:
+            page_source = PAGE_CACHE.get(url_string)
+            if page_source is not None:
+                return url_string, page_source, None
+        if not hasattr(thread_state, 'fetcher'):
+            thread_state.fetcher = HttpFetcher()
+            with fetchers_lock:
+                fetchers.append(thread_state.fetcher)
+        try:
+            rate_limit_wait(url_string)
+            with STAGE_TIMER.span('fetch page'):
+                thread_state.fetcher.get(url_string)
+        except Exception as error:
+            return url_string, None, error
+        if PAGE_CACHE and thread_state.fetcher.find_elements_by_xpath(ready_xpath):
+            PAGE_CACHE.put(url_string, thread_state.fetcher.page_source)
+        return url_string, thread_state.fetcher.page_source, None
+
+    fetch_pool = multiprocessing.pool.ThreadPool(max_in_flight)
+    try:
+        for result in fetch_pool.imap_unordered(fetch, url_list):
+            yield result
+        fetch_pool.close()
+    except:
+        fetch_pool.terminate()
+        raise
+    finally:
+        fetch_pool.join()
+        for fetcher in fetchers:
+            fetcher.quit()
+
+class Prefetcher(object):
+    """Fetches the pages of the next symbols of a list in the background while the current
+    one is scraped, so page loads overlap with extracting and writing results. The pages go
+    through one fetch_pages pipeline with up to depth requests in flight, each waiting for
+    the host's rate limit like any page load: the summary pages on the exchanges the symbol
+    is looked up on, then the financials page on the exchange it was found on, unless the
+    statements are still current.
+    Browsers are served its pages through a CachingFetcher, get hands each page out once,
+    waiting for it while it is in flight, and falls back to the PAGE_CACHE.
+    forget drops the pages of a symbol that was scraped, close cancels all prefetches"""
+    const_in_flight = object() # _pages value of a page being fetched
+
+    def __init__(self, depth=None):
+        self.depth = PREFETCH_DEPTH if depth is None else depth
+        self._pages = dict() # url -> page source, None if it failed to load
+        self._symbol_urls = dict() # (symbol, country) -> urls it may fetch for the symbol
+        self._url_symbols = dict() # the other way around
+        self._active = set() # (symbol, country) of the symbols still being prefetched
+        self._requests = Queue.Queue() # (symbol, country), url, exchanges left to look on
+        self._in_flight = dict() # url -> its request, while fetch_pages has it
+        self._slots = threading.Semaphore(self.depth) # keeps the pipeline to depth requests
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._prefetch_pages)
+        self._thread.daemon = True # a hanging request does not keep the process alive
+        self._thread.start()
+
+    def add(self, stock_symbol, which_country=None):
+        """Queues the pages of stock_symbol to be fetched, unless they are not needed"""
+        stock_symbol = clean_up_stock_symbol(stock_symbol)
+        if EXCHANGE_CACHE:
+            exchange_known, known_exchange = EXCHANGE_CACHE.lookup(stock_symbol, which_country,
+                                                                   count=False)
+            if exchange_known and not known_exchange: # skipped, see scrape
+                return
+        else:
+            known_exchange = None
+        if SHARED_SYMBOLS and SHARED_SYMBOLS.scraped(stock_symbol, which_country):
+            return
+        key = (stock_symbol, which_country)
+        exchanges = exchanges_to_try(which_country, known_exchange)
+        with self._condition:
+            if self._closed or key in self._symbol_urls:
+                return
+            # scrape asks for these, found_symbol takes the symbol the page shows to match
+            self._symbol_urls[key] = [return_base_url(stock_symbol, exchange)
+                                      for exchange in exchanges] + \
+                [return_finance_url(stock_symbol, exchange) for exchange in exchanges if exchange]
+            for url_string in self._symbol_urls[key]:
+                self._url_symbols[url_string] = key
+            self._active.add(key)
+        self._requests.put((key, return_base_url(stock_symbol, exchanges[0]), exchanges[1:]))
+
+    def forget(self, stock_symbol, which_country=None):
+        """Drops the pages of stock_symbol, fetched or not, the scraper is done with it"""
+        key = (clean_up_stock_symbol(stock_symbol), which_country)
+        with self._condition:
+            for url_string in self._symbol_urls.pop(key, []):
+                self._url_symbols.pop(url_string, None)
+                if self._pages.pop(url_string, None) not in (None, self.const_in_flight):
+                    TALLY.add('prefetched pages unused')
+            self._active.discard(key)
+
+    def get(self, url_string):
+        """Prefetched page of url_string, waiting for it while it is in flight or its symbol's
+        prefetch may still get to it, otherwise the PAGE_CACHE's page. None if neither has it"""
+        with self._condition:
+            start_time = time.time()
+            while self._pages.get(url_string) is self.const_in_flight or \
+                    (url_string not in self._pages and
+                     self._url_symbols.get(url_string) in self._active):
+                self._condition.wait(1)
+            page_source = self._pages.pop(url_string, None)
+            if time.time() - start_time > 0.001:
+                TALLY.add('prefetch wait sec', time.time() - start_time)
+                STAGE_TIMER.record('wait for prefetch', time.time() - start_time)
+            if page_source is not None:
+                TALLY.add('prefetched pages used')
+                return page_source
+        return PAGE_CACHE.get(url_string) if PAGE_CACHE else None
+
+    def put(self, url_string, page_source):
+        """Stores a page the browser loaded itself in the PAGE_CACHE"""
+        if PAGE_CACHE:
+            PAGE_CACHE.put(url_string, page_source)
+
+    def close(self):
+        """Cancels the prefetches, waits for the requests in flight to end"""
+        with self._condition:
+            self._closed = True
+            for url_string in self._pages.keys():
+                if self._pages[url_string] is not self.const_in_flight:
+                    TALLY.add('prefetched pages unused')
+            self._pages.clear()
+            self._symbol_urls.clear()
+            self._url_symbols.clear()
+            self._active.clear()
+            self._condition.notify_all()
+        self._requests.put(None)
+        self._thread.join()
+
+    def _prefetch_pages(self):
+        """Runs the fetch_pages pipeline in the prefetch thread until close"""
+        try:
+            self._run_pipeline()
+        finally:
+            with self._condition: # get stops waiting for pages that are not coming
+                self._active.clear()
+                self._condition.notify_all()
+
+    def _run_pipeline(self):
+        for url_string, page_source, _ in fetch_pages(self._urls_to_fetch(), self.depth):
+            self._slots.release()
+            with self._condition:
+                key, exchanges = self._in_flight.pop(url_string)
+                if self._closed or key not in self._active: # forgotten meanwhile
+                    continue
+                self._pages[url_string] = page_source
+                if page_source is not None:
+                    TALLY.add('pages prefetched')
+                self._condition.notify_all()
+            try:
+                request = self._next_request(key, exchanges, page_source)
+            except Exception as error: # the scraper loads the pages itself
+                print "    Could not prefetch {}: {}".format(key[0], error)
+                request = None
+            with self._condition:
+                if request and key in self._active:
+                    self._requests.put(request)
+                else: # no more pages coming for it
+                    self._active.discard(key)
+                    self._condition.notify_all()
+
+    def _urls_to_fetch(self):
+        """Urls of the queued requests for fetch_pages, in order, once a slot is free,
+        skipping those of symbols forgotten meanwhile. Ends on close"""
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            self._slots.acquire()
+            with self._condition:
+                if self._closed or request[0] not in self._active or \
+                        request[1] in self._in_flight: # eg the same url for two countries
+                    self._active.discard(request[0])
+                    self._condition.notify_all()
+                    self._slots.release()
+                    continue
+                self._pages[request[1]] = self.const_in_flight
+                self._in_flight[request[1]] = (request[0], request[2])
+            yield request[1]
+
+    def _next_request(self, key, exchanges, page_source):
+        """The page to fetch for the symbol key after page_source, like grab_summary_data:
+        the summary page on the next exchange until the symbol is found, then its financials
+        page. None once there is nothing left to fetch, or a page failed (the scraper takes
+        it from here). exchanges is None for the financials page"""
+        document = parse_html(page_source) if page_source and exchanges is not None else None
+        if document is None:
+            return None
+        stock_symbol, which_country = key
+        fields = extract_fields(document, SUMMARY_XPATH_TABLE)
+        result_dict = {'Exchange': split_symbol_snippet(fields, 0),
+                       'Stock Symbol': split_symbol_snippet(fields, 1)}
+        if not found_symbol(result_dict, stock_symbol, which_country):
+            if not exchanges:
+                return None
+            return key, return_base_url(stock_symbol, exchanges[0]), exchanges[1:]
+        if FRESHNESS_INDEX and FRESHNESS_INDEX.lookup(stock_symbol, which_country,
+                                                      result_dict['Exchange'],
+                                                      count=False) is not None:
+            return None
+        return key, return_finance_url(result_dict['Stock Symbol'], result_dict['Exchange']), \
+            None
+
+PREFETCHER = None
+
+def prefetched_rows(rows, which_country=None):
+    """Yields rows, with the PREFETCHER fetching the pages of the next ones meanwhile"""
+    if not PREFETCHER:
+        for row in rows:
+            yield row
+        return
+    upcoming = collections.deque()
+    try:
+        for row in rows:
+            PREFETCHER.add(row[0], which_country)
+            upcoming.append(row)
+            if len(upcoming) > PREFETCHER.depth:
+                yield upcoming[0]
+                PREFETCHER.forget(upcoming.popleft()[0], which_country)
+        while upcoming:
+            yield upcoming[0]
+            PREFETCHER.forget(upcoming.popleft()[0], which_country)
+    finally:
+        for row in upcoming:
+            PREFETCHER.forget(row[0], which_country)
+
+def process_dir(data_dir_name, logs_dir_name, results_dir_name, num_workers=1,
+                worker_type='thread', max_requests_per_sec=None, host_rate_limits=None,
+                page_cache_dir=None, full_statements=False, work_queue_fullpath=None,
+                incremental=False):
     """Goes through data needs, the directory names for data,
-    where to put results, where to log output"""
+    where to put results, where to log output.
+    With num_workers > 1 the symbols of all files are scraped by a pool of
+    worker threads or processes (worker_type 'thread' or 'process'),
+    max_requests_per_sec caps the page loads per host across all workers,
+    host_rate_limits maps a host to its own cap.
+    Pages are cached in page_cache_dir if given, full_statements saves every statement
+    table in full to results_dir_name/statements.
+    With work_queue_fullpath the symbols are claimed from a WorkQueue shared with other
+    nodes instead of following the per file checkpoints. incremental reuses the statements
+    in the FreshnessIndex for symbols no new fiscal period is likely for"""
+    global EXCHANGE_CACHE, FRESHNESS_INDEX, PAGE_CACHE, STATEMENT_STORE, SHARED_SYMBOLS, RUN_ID
+    global CONTROLLER, PREFETCHER
 
     print "Begin batch processing"
+    RUN_ID = datetime.datetime.now().isoformat()
+    if COLUMNAR_OUTPUT:
+        require_numpy("COLUMNAR_OUTPUT")
 
     if not os.path.exists('{}'.format(logs_dir_name)):
         os.makedirs(logs_dir_name)
@@ -653,29 +2690,252 @@ def process_dir(data_dir_name, logs_dir_name, results_dir_name):
     with open(master_log_fullpath, 'w') as master_log:
         master_log.writelines('{} Begin batch processing\n'.format(datetime.datetime.now()))
     sys.stdout.flush()
-    for item in file_list:
+    EXCHANGE_CACHE = ExchangeCache('{}/exchange_cache.json'.format(logs_dir_name))
+    FRESHNESS_INDEX = FreshnessIndex('{}/freshness_index.json'.format(logs_dir_name), incremental)
+    PAGE_CACHE = PageCache(page_cache_dir) if page_cache_dir else None
+    STATEMENT_STORE = StatementStore('{}/statements'.format(results_dir_name)) \
+        if full_statements else None
+    CONTROLLER = AdaptiveController(num_workers) if ADAPTIVE_CONCURRENCY else None
+    if work_queue_fullpath:
+        process_work_queue(work_queue_fullpath, file_list, data_dir_name, logs_dir_name,
+                           results_dir_name, master_log_fullpath, num_workers,
+                           max_requests_per_sec, host_rate_limits)
+    elif num_workers > 1:
+        process_files_parallel(file_list, data_dir_name, logs_dir_name, results_dir_name,
+                               master_log_fullpath, num_workers, worker_type, max_requests_per_sec,
+                               host_rate_limits)
+    else:
+        set_rate_limit(max_requests_per_sec, host_rate_limits)
+        SHARED_SYMBOLS = plan_shared_symbols(file_list, data_dir_name, logs_dir_name)
+        # prefetches are plain http, a browser renders the pages itself
+        PREFETCHER = Prefetcher() if PREFETCH_DEPTH and FETCHER_TYPE == 'http' else None
+        browser_pool = BrowserPool() # one browser session shared by all files
         try:
-            process_file(item, data_dir_name, logs_dir_name, results_dir_name)
-            with open(master_log_fullpath, 'a+') as master_log:
-                master_log.writelines('{} finished: {}\n'.format(datetime.datetime.now(), item))
-        except IOError:
-            with open(master_log_fullpath, 'a+') as master_log:
-                master_log.writelines('{} could not process: {}\n'.\
-                    format(datetime.datetime.now(), item))
-        sys.stdout.flush() # forces an output to std
+            for item in file_list:
+                try:
+                    summary = process_file(item, data_dir_name, logs_dir_name, results_dir_name,
+                                           browser_pool)
+                    with open(master_log_fullpath, 'a+') as master_log:
+                        master_log.writelines('{} finished: {}\n'.\
+                            format(datetime.datetime.now(), item))
+                        if summary:
+                            master_log.writelines('{} {}\n'.\
+                                format(datetime.datetime.now(), summary))
+                except IOError:
+                    with open(master_log_fullpath, 'a+') as master_log:
+                        master_log.writelines('{} could not process: {}\n'.\
+                            format(datetime.datetime.now(), item))
+                sys.stdout.flush() # forces an output to std
+        finally:
+            if PREFETCHER:
+                PREFETCHER.close()
+            browser_pool.close()
+            SHARED_SYMBOLS = None
+            PREFETCHER = None
+    EXCHANGE_CACHE.save()
+    FRESHNESS_INDEX.save()
+    export_run_metrics(logs_dir_name)
     print "Batch processing ended"
+    print time_report()
+    print failure_report()
+    print browser_report()
+    print exchange_cache_report()
+    print freshness_report()
+    print page_cache_report()
+    print prefetch_report()
     with open(master_log_fullpath, 'a+') as master_log:
+        master_log.writelines('{} {}\n'.format(datetime.datetime.now(), time_report()))
+        master_log.writelines('{} {}\n'.format(datetime.datetime.now(), failure_report()))
+        master_log.writelines('{} {}\n'.format(datetime.datetime.now(), browser_report()))
+        master_log.writelines('{} {}\n'.format(datetime.datetime.now(), exchange_cache_report()))
+        master_log.writelines('{} {}\n'.format(datetime.datetime.now(), freshness_report()))
+        master_log.writelines('{} {}\n'.format(datetime.datetime.now(), page_cache_report()))
+        master_log.writelines('{} {}\n'.format(datetime.datetime.now(), prefetch_report()))
         master_log.writelines('{} Batch processing ended\n'.format(datetime.datetime.now()))
     sys.stdout.flush()
-def process_file(work_filename, data_dir_name, logs_dir_name, results_dir_name):
-    """works on work_filename, requires where to grab data, write results and logs to"""
 
-    print "File: ", work_filename
+def row_index_fullpath(logs_dir_name, work_filename):
+    """Where the RowOffsetIndex of work_filename is kept"""
+    return '{}/index_{}.bin'.format(logs_dir_name, work_filename)
+
+def which_country_for_file(work_filename):
+    """Lists starting with ca_ hold Canadian symbols, everything else is American"""
     if work_filename.startswith('ca_'):
-        which_country = 'Canada'
+        return 'Canada'
+    return 'USA'
+
+def read_checkpoint(log_fullpath):
+    """Returns the row to resume work_file from, 1 for a new file, -1 once completed"""
+    if os.path.exists(log_fullpath):
+        with open(log_fullpath, 'r') as log_file:
+            try:
+                print " Resuming work"
+                return int(log_file.readline())
+            except ValueError:
+                return 1
+    else:
+        print " Creating", log_fullpath
+        return 1
+
+def write_checkpoint(log_fullpath, row_to_work_on, results_size=None):
+    """Saves the row to resume from, -1 marks a completed file. results_size is the size of
+    the results file holding every row before it, saved on a second line"""
+    checkpoint = '{}'.format(row_to_work_on)
+    if results_size is not None:
+        checkpoint += '\n{}'.format(results_size)
+    write_file_atomically(log_fullpath, checkpoint)
+
+class RowOffsetIndex(object):
+    """Sidecar index of the byte offset each row of an input list starts at, so work resumes
+    at any row with a single seek and the row count needs no pass over the list.
+    Rebuilt whenever the list's size or mtime no longer match the ones it was built for"""
+
+    HEADER = struct.Struct('<qd') # size, mtime of the input list
+    OFFSET = struct.Struct('<q')
+    LINE_END_RE = re.compile(r'\r\n|\r|\n') # same line ends as 'rU' mode
+
+    def __init__(self, work_fullpath, index_fullpath):
+        self.work_fullpath = work_fullpath
+        self.index_fullpath = index_fullpath
+        if not self._is_current():
+            self._build()
+        self.row_count = (os.path.getsize(index_fullpath) - self.HEADER.size) // self.OFFSET.size
+
+    def _work_file_stamp(self):
+        work_stat = os.stat(self.work_fullpath)
+        return work_stat.st_size, work_stat.st_mtime
+
+    def _is_current(self):
+        try:
+            with open(self.index_fullpath, 'rb') as index_file:
+                return self.HEADER.unpack(index_file.read(self.HEADER.size)) == \
+                    self._work_file_stamp()
+        except (IOError, OSError, struct.error):
+            return False
+
+    def _build(self):
+        """One pass over the list noting where each line starts"""
+        print " Indexing", self.work_fullpath
+        stamp = self._work_file_stamp()
+        with open(self.work_fullpath, 'rb') as work_file:
+            data = work_file.read()
+        offsets = [0] if data else []
+        offsets.extend(line_end.end() for line_end in self.LINE_END_RE.finditer(data))
+        if offsets and offsets[-1] == len(data):
+            offsets.pop() # nothing after the last line end
+        write_file_atomically(self.index_fullpath, self.HEADER.pack(*stamp) + \
+            struct.pack('<{}q'.format(len(offsets)), *offsets))
+
+    def offset(self, row_number):
+        """Byte offset row_number starts at, row 0 being the header"""
+        with open(self.index_fullpath, 'rb') as index_file:
+            index_file.seek(self.HEADER.size + row_number * self.OFFSET.size)
+            return self.OFFSET.unpack(index_file.read(self.OFFSET.size))[0]
+
+    def rows_from(self, row_number):
+        """Iterates the csv rows of the list from row_number on"""
+        if row_number >= self.row_count:
+            return
+        with open(self.work_fullpath, 'rU') as work_file:
+            work_file.seek(self.offset(row_number))
+            for row in csv.reader(work_file, delimiter=',', quotechar='"'):
+                yield row
+
+def read_checkpoint_results_size(log_fullpath):
+    """Results file size saved with the checkpoint, None if there is none"""
+    try:
+        with open(log_fullpath, 'r') as log_file:
+            return int(log_file.readlines()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+
+def checkpoint_row(log_fullpath):
+    """Row the list resumes from like read_checkpoint, but without logging"""
+    try:
+        with open(log_fullpath, 'r') as log_file:
+            return int(log_file.readline())
+    except (IOError, ValueError):
+        return 1
+
+class ResultWriter(object):
+    """Buffers the result rows of one results file and appends them in batches, every
+    batch_rows rows or flush_sec sec. The checkpoint is committed with each batch, it
+    holds the row to resume from and the results file size at that point, so rows written
+    after the last checkpoint (eg a crash in between) are cut off again on resume.
+    A new results file is checkpointed with size 0 at row_to_work_on before any batch"""
+
+    def __init__(self, results_fullpath, log_fullpath, row_to_work_on, batch_rows=None,
+                 flush_sec=None):
+        self.results_fullpath = results_fullpath
+        self.log_fullpath = log_fullpath
+        self.batch_rows = batch_rows or RESULT_BATCH_ROWS
+        self.flush_sec = flush_sec or RESULT_FLUSH_SEC
+        self._rows = []
+        self._row_to_work_on = None
+        self._last_flush = time.time()
+        self.row_count = 0 # rows added by this writer
+        results_dir_name = os.path.dirname(results_fullpath)
+        if results_dir_name and not os.path.exists(results_dir_name):
+            os.makedirs(results_dir_name)
+        self._drop_uncommitted_rows()
+        if not os.path.exists(results_fullpath) or os.path.getsize(results_fullpath) == 0:
+            # a crash during the first batch then cuts the file back to nothing
+            write_checkpoint(log_fullpath, row_to_work_on, 0)
+
+    def _drop_uncommitted_rows(self):
+        """Cuts the results file back to the size saved with the checkpoint"""
+        results_size = read_checkpoint_results_size(self.log_fullpath)
+        if results_size is not None and os.path.exists(self.results_fullpath) and \
+                os.path.getsize(self.results_fullpath) > results_size:
+            print " Dropping results written after the last checkpoint"
+            with open(self.results_fullpath, 'r+b') as results_file:
+                results_file.truncate(results_size)
+
+    def add(self, stock_results_dict, row_to_work_on):
+        """Buffers a result row, row_to_work_on is the row to resume from once it is saved"""
+        self._rows.append([stock_results_dict[item] for item in RESULT_ORDER_LIST])
+        self._row_to_work_on = row_to_work_on
+        self.row_count += 1
+        if len(self._rows) >= self.batch_rows or time.time() - self._last_flush >= self.flush_sec:
+            self.flush()
+
+    def flush(self):
+        """Appends the buffered rows in one write, then commits the checkpoint"""
+        with STAGE_TIMER.span('write results'):
+            self._flush()
+
+    def _flush(self):
+        if self._rows:
+            new_file = not os.path.exists(self.results_fullpath) or \
+                os.path.getsize(self.results_fullpath) == 0
+            if new_file:
+                print "Saving in", self.results_fullpath
+            with open(self.results_fullpath, 'ab') as results_file:
+                csv_writer = csv.writer(results_file, quoting=csv.QUOTE_ALL)
+                if new_file:
+                    csv_writer.writerow(RESULT_ORDER_LIST)
+                csv_writer.writerows(self._rows)
+                results_file.flush()
+                os.fsync(results_file.fileno())
+                results_size = results_file.tell()
+            write_checkpoint(self.log_fullpath, self._row_to_work_on, results_size)
+            self._rows = []
+        self._last_flush = time.time()
+
+    def close(self):
+        """Saves whatever is still buffered"""
+        self.flush()
+
+def process_file(work_filename, data_dir_name, logs_dir_name, results_dir_name, browser_pool=None):
+    """works on work_filename, requires where to grab data, write results and logs to
+    Borrows browsers from browser_pool, or uses its own pool if not given.
+    Returns a summary of the symbols scraped, None if there were none"""
+
+    print "File: ", work_filename
+    which_country = which_country_for_file(work_filename)
+    if which_country == 'Canada':
         print "Canadian list"
     else:
-        which_country = 'USA'
         print "American list"
 
 
@@ -685,48 +2945,835 @@ def process_file(work_filename, data_dir_name, logs_dir_name, results_dir_name):
     log_fullpath = '{}/log_{}.txt'.format(logs_dir_name, work_filename)
     work_fullpath = '{}/{}'.format(data_dir_name, work_filename)
     results_filename = 'result_{}'.format(work_filename)
-    if os.path.exists(log_fullpath):
-        with open(log_fullpath, 'r') as log_file:
-            try:
-                print " Resuming work"
-                row_to_work_on = int(log_file.readline())
-            except ValueError:
-                row_to_work_on = 1
-    else:
-        print " Creating", log_fullpath
-        row_to_work_on = 1
-    with open(work_fullpath, 'rU') as work_file:
-        csv_reader = csv.reader(work_file, delimiter=',', quotechar='"')
-        
-        row_count = sum(1 for row in csv_reader)
+    row_to_work_on = read_checkpoint(log_fullpath)
+    row_index = RowOffsetIndex(work_fullpath, row_index_fullpath(logs_dir_name, work_filename))
+    owns_browser_pool = browser_pool is None
+    if owns_browser_pool:
+        browser_pool = BrowserPool()
+    start_time = time.time()
+    tally_before = TALLY.snapshot()
+    try:
+        with STAGE_TIMER.task() as file_timer:
+            row_count = _process_file_rows(row_index, log_fullpath, results_filename,
+                                           results_dir_name, which_country, row_to_work_on,
+                                           browser_pool)
+    finally:
+        if owns_browser_pool:
+            browser_pool.close()
+    if not file_timer.count('symbol'):
+        return None
+    summary = file_summary(work_filename, file_timer, time.time() - start_time, row_count,
+                           TALLY.since(tally_before).get('transient retries', 0))
+    print summary
+    export_file_metrics(logs_dir_name, work_filename, file_timer)
+    return summary
+
+def _process_file_rows(row_index, log_fullpath, results_filename, results_dir_name,
+                       which_country, row_to_work_on, browser_pool):
+    """Scrapes the rows of the list in row_index starting at row_to_work_on,
+    checkpointing in log_fullpath. Returns the number of rows written"""
+    row_count = row_index.row_count
 
     if row_to_work_on >= 0:
-        with open(work_fullpath, 'rU') as work_file:
-            csv_reader = csv.reader(work_file, delimiter=',', quotechar='"')
-            
-            csv_reader.next() #skip header
-            if row_to_work_on < row_count:
-                for i in xrange(row_to_work_on - 1): # skip everything right before
-                    print "  skipping {}".format(csv_reader.next()[0])
-
-                for row in csv_reader:
+        if row_to_work_on < row_count:
+            print " Row {} of {}".format(row_to_work_on, row_count - 1)
+            result_writer = ResultWriter('{}/{}'.format(results_dir_name, results_filename),
+                                         log_fullpath, row_to_work_on)
+            try:
+                for row in prefetched_rows(row_index.rows_from(row_to_work_on), which_country):
                     print "  {}. {}".format(row_to_work_on, row[0])
-                    scrape_and_write_to_file(row[0], results_filename,
-                                             results_dir_name, which_country)
+                    stock_results_dict = scrape_with_retries(row[0], which_country,
+                                                             browser_pool)
                     row_to_work_on += 1
-                    with open(log_fullpath, 'w') as log_file:
-                        log_file.writelines('{}'.format(row_to_work_on))
+                    result_writer.add(stock_results_dict, row_to_work_on)
                     sys.stdout.flush()
-            else:
-                row_to_work_on = -1
-                print "Completed File"
-                with open(log_fullpath, 'w') as log_file:
-                    log_file.writelines('{}'.format(row_to_work_on))
+            finally:
+                result_writer.close()
+            finish_result_file(result_writer.results_fullpath)
+            return result_writer.row_count
+        else:
+            row_to_work_on = -1
+            print "Completed File"
+            write_checkpoint(log_fullpath, row_to_work_on)
     else:
         print "File already completed"
+    return 0
+
+## COLUMNAR OUTPUT
+RESULT_TEXT_COLUMNS = ['Stock Symbol', 'Exchange', 'Stock Name', 'Country']
+RESULT_DATE_COLUMNS = ['Current Year', 'Previous Year']
+RESULT_INT_COLUMNS = ['Employees']
+
+def result_column_dtype(column):
+    """numpy dtype a results column is stored as, text columns are sized to fit later"""
+    if column in RESULT_TEXT_COLUMNS:
+        return 'S'
+    if column in RESULT_DATE_COLUMNS:
+        return 'M8[D]'
+    if column in RESULT_INT_COLUMNS:
+        return 'i8'
+    return 'f8'
+
+def result_columns_dir(results_fullpath):
+    """Where the columns of a results file are saved, eg results/columns/result_a"""
+    results_dir_name, results_filename = os.path.split(results_fullpath)
+    return os.path.join(results_dir_name, 'columns', os.path.splitext(results_filename)[0])
+
+def result_column_filename(column):
+    """eg 'Total Assets' -> 'total_assets.npy'"""
+    return re.sub(r'[^a-z0-9]+', '_', column.lower()).strip('_') + '.npy'
+
+def parse_result_cell(dtype, text):
+    """Returns (value, valid) of one results cell, 'N/A' and unparsable cells are not valid"""
+    if dtype == 'S':
+        return (text, True) if text != 'N/A' else ('', False)
+    try:
+        if dtype == 'M8[D]':
+            return numpy.datetime64(text, 'D'), True
+        if dtype == 'i8':
+            return int(text), True
+        return float(text), True
+    except ValueError:
+        if dtype == 'M8[D]':
+            return numpy.datetime64('NaT'), False
+        if dtype == 'i8':
+            return 0, False
+        return float('nan'), False
+
+def save_npy_atomically(fullpath, array):
+    """Saves array as a .npy file no reader sees half written"""
+    npy_buffer = StringIO.StringIO()
+    numpy.save(npy_buffer, array)
+    write_file_atomically(fullpath, npy_buffer.getvalue())
+
+def write_result_columns(results_fullpath, columns_dir=None):
+    """Converts a results csv into one typed .npy file per column plus a validity mask,
+    described by schema.json. Missing values are masked out instead of being 'N/A' text"""
+    require_numpy("COLUMNAR_OUTPUT")
+    columns_dir = columns_dir or result_columns_dir(results_fullpath)
+    if not os.path.exists(columns_dir):
+        os.makedirs(columns_dir)
+
+    with open(results_fullpath, 'rb') as results_file:
+        csv_reader = csv.reader(results_file, quoting=csv.QUOTE_ALL)
+        header = csv_reader.next()
+        rows = list(csv_reader)
+
+    schema = {'row_count': len(rows), 'columns': []}
+    for column_number, column in enumerate(header):
+        dtype = result_column_dtype(column)
+        cells = [parse_result_cell(dtype, row[column_number]) for row in rows]
+        values = numpy.array([value for value, valid in cells], dtype=dtype if dtype != 'S' else None)
+        if dtype == 'S':
+            values = values.astype('S{}'.format(max(1, values.dtype.itemsize)))
+        valid = numpy.array([valid for value, valid in cells], dtype=bool)
+        filename = result_column_filename(column)
+        save_npy_atomically(os.path.join(columns_dir, filename), values)
+        save_npy_atomically(os.path.join(columns_dir, 'valid_' + filename), valid)
+        schema['columns'].append({'name': column, 'dtype': values.dtype.str, 'file': filename,
+                                  'valid_file': 'valid_' + filename})
+    # the schema goes last, so it only ever describes complete columns
+    write_file_atomically(os.path.join(columns_dir, 'schema.json'), json.dumps(schema, indent=1))
+    return columns_dir
+
+def load_result_columns(columns_dir, mmap_mode='r'):
+    """Returns {column: numpy masked array} of a results file saved by write_result_columns,
+    memory mapped unless mmap_mode is None, masked where the value is missing"""
+    with open(os.path.join(columns_dir, 'schema.json'), 'r') as schema_file:
+        schema = json.load(schema_file)
+    columns = dict()
+    for column in schema['columns']:
+        values = numpy.load(os.path.join(columns_dir, column['file']), mmap_mode=mmap_mode)
+        valid = numpy.load(os.path.join(columns_dir, column['valid_file']), mmap_mode=mmap_mode)
+        columns[column['name']] = numpy.ma.MaskedArray(values, mask=~valid)
+    return columns
+
+def load_all_result_columns(results_dir_name):
+    """Every columnar results file under results_dir_name joined into one table"""
+    all_columns_dir = os.path.join(results_dir_name, 'columns')
+    tables = [load_result_columns(os.path.join(all_columns_dir, item))
+              for item in sorted(os.listdir(all_columns_dir))
+              if os.path.exists(os.path.join(all_columns_dir, item, 'schema.json'))]
+    if not tables:
+        return dict()
+    return {column: numpy.ma.concatenate([table[column] for table in tables])
+            for column in tables[0]}
+
+def _row_fingerprints(columns):
+    """uint64 hash per row of the values and masks of a list of masked float columns"""
+    fingerprints = numpy.zeros(len(columns[0]) if columns else 0, dtype=numpy.uint64)
+    for column in columns:
+        bits = numpy.ma.getdata(column).astype(numpy.float64).view(numpy.uint64)
+        bits = numpy.where(numpy.ma.getmaskarray(column), numpy.uint64(0x7ff8dead), bits)
+        fingerprints = (fingerprints ^ bits) * numpy.uint64(1099511628211) # FNV style
+    return fingerprints
+
+def _metric_values(columns, terms, rows):
+    """Masked array of one derived metric over the selected rows, masked where an input is"""
+    sign, column = terms[0]
+    value = sign * columns[column][rows]
+    for sign, column in terms[1:]:
+        value = value - columns[column][rows] if sign < 0 else value + columns[column][rows]
+    return value
+
+def update_derived_metrics(columns_dir, metrics=None):
+    """Recomputes the derived metrics of a columnar results file and saves them as columns.
+    Only rows whose inputs changed since the last update are recomputed, all rows of a
+    metric that is new or whose definition changed. Returns the number of rows recomputed"""
+    metrics = metrics or DERIVED_METRICS
+    columns = load_result_columns(columns_dir)
+    row_count = len(columns['Stock Symbol'])
+    input_columns = sorted(set(column for metric, terms in metrics for sign, column in terms))
+    fingerprints = _row_fingerprints([columns[column] for column in input_columns])
+
+    state_fullpath = os.path.join(columns_dir, 'derived.json')
+    fingerprints_fullpath = os.path.join(columns_dir, 'derived_fingerprints.npy')
+    try:
+        with open(state_fullpath, 'r') as state_file:
+            state = json.load(state_file)
+        previous_fingerprints = numpy.load(fingerprints_fullpath)
+    except (IOError, ValueError):
+        state, previous_fingerprints = {'inputs': [], 'metrics': {}}, numpy.zeros(0, numpy.uint64)
+    changed = numpy.ones(row_count, dtype=bool)
+    if state['inputs'] == input_columns:
+        compared = min(row_count, len(previous_fingerprints))
+        changed[:compared] = previous_fingerprints[:compared] != fingerprints[:compared]
+
+    with open(os.path.join(columns_dir, 'schema.json'), 'r') as schema_file:
+        schema = json.load(schema_file)
+    schema_columns = {column['name']: column for column in schema['columns']}
+    recomputed = 0
+    for metric, terms in metrics:
+        same_definition = state['metrics'].get(metric) == [list(term) for term in terms]
+        if same_definition and metric in columns:
+            rows = changed
+            values = numpy.array(numpy.ma.getdata(columns[metric]), dtype=numpy.float64)
+            valid = ~numpy.ma.getmaskarray(columns[metric])
+        else:
+            rows = numpy.ones(row_count, dtype=bool)
+            values = numpy.full(row_count, numpy.nan)
+            valid = numpy.zeros(row_count, dtype=bool)
+        metric_values = _metric_values(columns, terms, rows)
+        values[rows] = metric_values.filled(numpy.nan)
+        valid[rows] = ~numpy.ma.getmaskarray(metric_values)
+        recomputed = max(recomputed, rows.sum())
+
+        filename = result_column_filename(metric)
+        save_npy_atomically(os.path.join(columns_dir, filename), values)
+        save_npy_atomically(os.path.join(columns_dir, 'valid_' + filename), valid)
+        if metric not in schema_columns:
+            schema_columns[metric] = {'name': metric, 'file': filename,
+                                      'valid_file': 'valid_' + filename}
+            schema['columns'].append(schema_columns[metric])
+        schema_columns[metric]['dtype'] = values.dtype.str
+
+    write_file_atomically(os.path.join(columns_dir, 'schema.json'), json.dumps(schema, indent=1))
+    save_npy_atomically(fingerprints_fullpath, fingerprints)
+    write_file_atomically(state_fullpath, json.dumps(
+        {'inputs': input_columns, 'metrics': {metric: terms for metric, terms in metrics}}))
+    return int(recomputed)
+
+def update_all_derived_metrics(results_dir_name, metrics=None):
+    """update_derived_metrics over every columnar results file, no scraping involved"""
+    all_columns_dir = os.path.join(results_dir_name, 'columns')
+    recomputed = 0
+    for item in sorted(os.listdir(all_columns_dir)):
+        if os.path.exists(os.path.join(all_columns_dir, item, 'schema.json')):
+            recomputed += update_derived_metrics(os.path.join(all_columns_dir, item), metrics)
+    return recomputed
+
+def finish_result_file(results_fullpath):
+    """Called once all rows of a results file are written"""
+    if COLUMNAR_OUTPUT and os.path.exists(results_fullpath):
+        columns_dir = write_result_columns(results_fullpath)
+        update_derived_metrics(columns_dir)
+        print "Saving columns in", columns_dir
+
+## PARALLEL PROCESSING
+_WORKER_BROWSER_POOL = None
+RATE_LIMITER = None
+
+def set_rate_limit(max_requests_per_sec, host_rate_limits=None, burst=None):
+    """Caps page loads per host for this process, host_rate_limits maps host to its own cap,
+    burst (default RATE_LIMIT_BURST) page loads may go out at once.
+    None and no host limits removes the cap"""
+    global RATE_LIMITER
+    if max_requests_per_sec or host_rate_limits:
+        RATE_LIMITER = HostRateLimiter(max_requests_per_sec, host_rate_limits,
+                                       burst or RATE_LIMIT_BURST)
+    else:
+        RATE_LIMITER = None
+
+def _init_process_worker(max_requests_per_sec, host_rate_limits, burst):
+    """Runs once in every worker process, each process keeps one browser session"""
+    global _WORKER_BROWSER_POOL, CONTROLLER
+    set_rate_limit(max_requests_per_sec, host_rate_limits, burst)
+    if CONTROLLER: # each process adapts its share of the rate
+        CONTROLLER = AdaptiveController(1)
+    _WORKER_BROWSER_POOL = BrowserPool()
+    multiprocessing.util.Finalize(_WORKER_BROWSER_POOL, _WORKER_BROWSER_POOL.close,
+                                  exitpriority=10)
+    if EXCHANGE_CACHE: # inherited from the parent process
+        multiprocessing.util.Finalize(EXCHANGE_CACHE, EXCHANGE_CACHE.save, exitpriority=10)
+    if FRESHNESS_INDEX:
+        multiprocessing.util.Finalize(FRESHNESS_INDEX, FRESHNESS_INDEX.save, exitpriority=10)
+
+def _scrape_task(task):
+    """Worker entry point, task is (work_filename, row number, stock symbol, country).
+    transient is True if the symbol should be tried again, see TransientScrapeError,
+    its results are what was scraped so far"""
+    work_filename, row_number, stock_symbol, which_country = task
+    print "  {} {}. {}".format(work_filename, row_number, stock_symbol)
+    tally_before = TALLY.snapshot()
+    transient = False
+    with STAGE_TIMER.task() as task_timer:
+        try:
+            stock_results_dict = scrape_symbol(stock_symbol, which_country, _WORKER_BROWSER_POOL)
+        except TransientScrapeError as error:
+            print "   {}, trying again later".format(error)
+            stock_results_dict = error.stock_results_dict
+            transient = True
+        except Exception as error:
+            print "  Could not scrape {}: {}".format(stock_symbol, error)
+            TALLY.add('scrape errors')
+            stock_results_dict = {item: 'N/A' for item in RESULT_ORDER_LIST}
+    sys.stdout.flush()
+    # totals for this task, so process workers can report back to the parent's tally,
+    # and the task's timings for the summary of its file
+    tally_delta = TALLY.since(tally_before)
+    return (work_filename, row_number, stock_results_dict, transient, tally_delta,
+            task_timer.histograms)
+
+class OrderedFileProgress(object):
+    """Collects results of one input file as they finish in any order, passes them to the
+    file's ResultWriter in input order so the checkpoint moves along the same way
+    as for sequential processing"""
+
+    def __init__(self, log_fullpath, results_filename, results_dir_name, row_to_work_on, row_count):
+        self.log_fullpath = log_fullpath
+        self.row_to_work_on = row_to_work_on
+        self.row_count = row_count
+        self.result_writer = ResultWriter('{}/{}'.format(results_dir_name, results_filename),
+                                          log_fullpath, row_to_work_on)
+        self.file_timer = StageTimer() # timings of this file's symbols, for its summary
+        self.retry_count = 0 # symbols of this file tried again
+        self._finished_rows = dict()
+
+    def add(self, row_number, stock_results_dict):
+        """Record a finished row, passing on every row that is now in order"""
+        self._finished_rows[row_number] = stock_results_dict
+        while self.row_to_work_on in self._finished_rows:
+            self.row_to_work_on += 1
+            self.result_writer.add(self._finished_rows.pop(self.row_to_work_on - 1),
+                                   self.row_to_work_on)
+
+    def is_done(self):
+        """True once every row of the file has been written"""
+        return self.row_to_work_on >= self.row_count
+
+def _plan_file_tasks(work_filename, data_dir_name, logs_dir_name, results_dir_name):
+    """Returns (OrderedFileProgress, list of tasks) for the rows of work_filename still to do"""
+    log_fullpath = '{}/log_{}.txt'.format(logs_dir_name, work_filename)
+    work_fullpath = '{}/{}'.format(data_dir_name, work_filename)
+    row_to_work_on = read_checkpoint(log_fullpath)
+    which_country = which_country_for_file(work_filename)
+    row_index = RowOffsetIndex(work_fullpath, row_index_fullpath(logs_dir_name, work_filename))
+    row_count = row_index.row_count
+
+    if row_to_work_on < 0 or row_to_work_on >= row_count:
+        if row_to_work_on >= 0:
+            write_checkpoint(log_fullpath, -1)
+        print " {} already completed".format(work_filename)
+        return None, []
+
+    progress = OrderedFileProgress(log_fullpath, 'result_{}'.format(work_filename),
+                                   results_dir_name, row_to_work_on, row_count)
+    tasks = [(work_filename, row_number, row[0], which_country)
+             for row_number, row in enumerate(row_index.rows_from(row_to_work_on), row_to_work_on)]
+    return progress, tasks
+
+def _dedupe_tasks(task_lists):
+    """Keeps the first task of every symbol_key, returns (task lists, fan out), fan out maps
+    (work_filename, row number) of a kept task to the rows of the other listings of its
+    symbol, which get its results too"""
+    first_tasks = dict()
+    fan_out = dict()
+    deduped_task_lists = []
+    for tasks in task_lists:
+        deduped_tasks = []
+        for task in tasks:
+            work_filename, row_number, stock_symbol, which_country = task
+            key = symbol_key(stock_symbol, which_country)
+            if key in first_tasks:
+                fan_out.setdefault(first_tasks[key], []).append((work_filename, row_number))
+            else:
+                first_tasks[key] = (work_filename, row_number)
+                deduped_tasks.append(task)
+        deduped_task_lists.append(deduped_tasks)
+    if fan_out:
+        print " {} symbols are listed more than once, each is scraped once".format(len(fan_out))
+    return deduped_task_lists, fan_out
+
+def _interleave(task_lists):
+    """Round robin over the task lists so all files make progress together"""
+    task_iters = [iter(task_list) for task_list in task_lists]
+    while task_iters:
+        for task_iter in list(task_iters):
+            try:
+                yield task_iter.next()
+            except StopIteration:
+                task_iters.remove(task_iter)
+
+def _scrape_in_rounds(worker_pool, tasks):
+    """Runs _scrape_task over tasks on worker_pool, yielding its results as they finish.
+    Symbols whose pages failed to load come back as transient and go to the end of the
+    queue, a new round, up to SCRAPE_MAX_ATTEMPTS times, then they keep the results of
+    their last attempt"""
+    for attempt in xrange(1, SCRAPE_MAX_ATTEMPTS + 1):
+        tasks_by_row = {(task[0], task[1]): task for task in tasks}
+        retry_tasks = []
+        for result in worker_pool.imap_unordered(_scrape_task, tasks):
+            work_filename, row_number, stock_results_dict, transient, tally_delta, \
+                task_histograms = result
+            if transient:
+                if attempt < SCRAPE_MAX_ATTEMPTS:
+                    retry_tasks.append(tasks_by_row[(work_filename, row_number)])
+                else:
+                    print "   Giving up on", tasks_by_row[(work_filename, row_number)][2]
+                    result = (work_filename, row_number, stock_results_dict, False,
+                              tally_delta, task_histograms)
+            yield result
+        if not retry_tasks:
+            return
+        print " Trying {} symbols again whose pages failed to load".format(len(retry_tasks))
+        TALLY.add('transient retries', len(retry_tasks))
+        tasks = retry_tasks
+
+def process_files_parallel(file_list, data_dir_name, logs_dir_name, results_dir_name,
+                           master_log_fullpath, num_workers, worker_type='thread',
+                           max_requests_per_sec=None, host_rate_limits=None):
+    """Shards the symbols of every file in file_list across num_workers workers,
+    worker_type 'thread' shares one browser pool, 'process' runs a browser per process"""
+    global _WORKER_BROWSER_POOL
+
+    progress_dict = dict()
+    task_lists = []
+    for item in file_list:
+        try:
+            progress, tasks = _plan_file_tasks(item, data_dir_name, logs_dir_name,
+                                               results_dir_name)
+        except IOError:
+            with open(master_log_fullpath, 'a+') as master_log:
+                master_log.writelines('{} could not process: {}\n'.\
+                    format(datetime.datetime.now(), item))
+            continue
+        if progress:
+            progress_dict[item] = progress
+            task_lists.append(tasks)
+        else:
+            with open(master_log_fullpath, 'a+') as master_log:
+                master_log.writelines('{} finished: {}\n'.format(datetime.datetime.now(), item))
+
+    task_lists, fan_out = _dedupe_tasks(task_lists)
+
+    if worker_type == 'process':
+        # each process gets an equal share of the per host rate
+        worker_rate = max_requests_per_sec / float(num_workers) if max_requests_per_sec else None
+        worker_host_rates = {host: rate / float(num_workers)
+                             for host, rate in (host_rate_limits or dict()).items()}
+        worker_burst = max(1, RATE_LIMIT_BURST // num_workers)
+        worker_pool = multiprocessing.Pool(num_workers, _init_process_worker,
+                                           (worker_rate, worker_host_rates, worker_burst))
+    else:
+        set_rate_limit(max_requests_per_sec, host_rate_limits)
+        _WORKER_BROWSER_POOL = BrowserPool(num_workers)
+        worker_pool = multiprocessing.pool.ThreadPool(num_workers)
+
+    start_time = time.time()
+    try:
+        for work_filename, row_number, stock_results_dict, transient, tally_delta, \
+                task_histograms in _scrape_in_rounds(worker_pool, list(_interleave(task_lists))):
+            if worker_type == 'process': # threads already add to this process's tally
+                TALLY.merge(tally_delta)
+                STAGE_TIMER.merge(task_histograms)
+            progress_dict[work_filename].file_timer.merge(task_histograms)
+            if transient: # tried again in the next round
+                progress_dict[work_filename].retry_count += 1
+                continue
+            listings = fan_out.get((work_filename, row_number), [])
+            TALLY.add('duplicate symbols skipped', len(listings))
+            for listed_filename, listed_row_number in [(work_filename, row_number)] + listings:
+                progress = progress_dict[listed_filename]
+                progress.add(listed_row_number, stock_results_dict)
+                if progress.is_done():
+                    print "Completed File", listed_filename
+                    progress.result_writer.close()
+                    write_checkpoint(progress.log_fullpath, -1)
+                    finish_result_file(progress.result_writer.results_fullpath)
+                    summary = file_summary(listed_filename, progress.file_timer,
+                                           time.time() - start_time,
+                                           progress.result_writer.row_count,
+                                           progress.retry_count)
+                    print summary
+                    with open(master_log_fullpath, 'a+') as master_log:
+                        master_log.writelines('{} finished: {}\n'.\
+                            format(datetime.datetime.now(), listed_filename))
+                        master_log.writelines('{} {}\n'.format(datetime.datetime.now(), summary))
+                    export_file_metrics(logs_dir_name, listed_filename, progress.file_timer)
+            sys.stdout.flush()
+        worker_pool.close()
+    except:
+        worker_pool.terminate()
+        raise
+    finally:
+        worker_pool.join()
+        for progress in progress_dict.values(): # save what finished before an error
+            progress.result_writer.close()
+        if worker_type != 'process':
+            _WORKER_BROWSER_POOL.close()
+            _WORKER_BROWSER_POOL = None
+
+## WORK QUEUE
+class WorkQueue(object):
+    """Symbols of the input lists in a SQLite database that workers on several nodes share,
+    eg on a shared volume. A worker claims a symbol with a lease of lease_sec, its node keeps
+    the lease alive with heartbeats, and completes it with the scraped results or fails it.
+    Failed symbols are retried up to max_attempts times. Leases of a node that stopped
+    heartbeating (crashed, lost) expire and their symbols are claimed again, completed
+    symbols are never redone. A symbol listed more than once is scraped for one listing and
+    its results complete the others too. Results files are exported once all rows of a list
+    are in"""
+
+    STATES = ['pending', 'leased', 'done', 'failed']
+
+    def __init__(self, db_fullpath, lease_sec=None, max_attempts=None):
+        self.db_fullpath = db_fullpath
+        self.lease_sec = lease_sec or WORK_QUEUE_LEASE_SEC
+        self.max_attempts = max_attempts or WORK_QUEUE_MAX_ATTEMPTS
+        self.local_changes = 0 # symbols this process completed, failed or handed back
+        self._local_change = threading.Condition()
+        db_dir_name = os.path.dirname(db_fullpath)
+        if db_dir_name and not os.path.exists(db_dir_name):
+            os.makedirs(db_dir_name)
+        with self._transaction() as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS work (
+                work_filename TEXT, row_number INTEGER, stock_symbol TEXT, which_country TEXT,
+                symbol_key TEXT, state TEXT DEFAULT 'pending', attempts INTEGER DEFAULT 0, lease_owner TEXT,
+                lease_expires REAL, result TEXT, error TEXT,
+                PRIMARY KEY (work_filename, row_number))""")
+            # claims walk the pending rows in order and stop after a batch, without a sort
+            connection.execute("DROP INDEX IF EXISTS work_state")
+            connection.execute("""CREATE INDEX IF NOT EXISTS work_claim
+                ON work (state, row_number, work_filename)""")
+            connection.execute("""CREATE INDEX IF NOT EXISTS work_symbol_key
+                ON work (symbol_key, which_country)""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS lists (
+                work_filename TEXT PRIMARY KEY, row_count INTEGER, exported INTEGER DEFAULT 0)""")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Connection in a write transaction, committed if the block finishes.
+        A connection per call, so threads and processes of a node can share the queue"""
+        connection = sqlite3.connect(self.db_fullpath, timeout=60, isolation_level=None)
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+    def feed(self, work_filename, row_index):
+        """Adds the rows of the list in row_index, rows already in the queue keep their state
+        unless the list changed their symbol. Returns the number of rows queued anew"""
+        which_country = which_country_for_file(work_filename)
+        rows = [(work_filename, row_number, stock_symbol, which_country,
+                 symbol_key(stock_symbol, which_country)[0])
+                for row_number, stock_symbol in enumerate((row[0] if row else '' for row in
+                                                           row_index.rows_from(1)), 1)]
+        with self._transaction() as connection:
+            queued = connection.executemany("""UPDATE work SET stock_symbol=?, symbol_key=?,
+                state='pending', attempts=0, lease_owner=NULL, result=NULL, error=NULL
+                WHERE work_filename=? AND row_number=? AND stock_symbol!=?""",
+                [(stock_symbol, key, filename, row_number, stock_symbol)
+                 for filename, row_number, stock_symbol, country, key in rows]).rowcount
+            queued += connection.executemany("""INSERT OR IGNORE INTO work
+                (work_filename, row_number, stock_symbol, which_country, symbol_key)
+                VALUES (?, ?, ?, ?, ?)""", rows).rowcount
+            # keys of queues fed before symbol_key kept the case
+            connection.executemany("""UPDATE work SET symbol_key=? WHERE work_filename=?
+                AND row_number=? AND symbol_key!=?""",
+                [(key, filename, row_number, key)
+                 for filename, row_number, stock_symbol, country, key in rows])
+            connection.execute("DELETE FROM work WHERE work_filename=? AND row_number>=?",
+                               (work_filename, len(rows) + 1))
+            row_count = connection.execute("SELECT row_count FROM lists WHERE work_filename=?",
+                                           (work_filename,)).fetchone()
+            if queued or not row_count or row_count[0] != len(rows):
+                connection.execute("""INSERT OR REPLACE INTO lists (work_filename, row_count,
+                    exported) VALUES (?, ?, 0)""", (work_filename, len(rows)))
+        return queued
+
+    def claim(self, owner, count=1):
+        """Leases up to count pending symbols to owner, returns them as
+        (work_filename, row number, stock symbol, country) tasks, rows of all lists mixed.
+        Symbols another listing of which is leased already are left for its results"""
+        now = time.time()
+        with self._transaction() as connection:
+            self._expire_leases(connection, now)
+            tasks = []
+            claimed_keys = set()
+            for row in connection.execute("""SELECT work_filename, row_number, stock_symbol,
+                    which_country, symbol_key FROM work AS pending WHERE state='pending'
+                    AND NOT EXISTS (SELECT 1 FROM work WHERE state='leased'
+                    AND symbol_key=pending.symbol_key AND which_country=pending.which_country)
+                    ORDER BY row_number, work_filename"""):
+                if (row[4], row[3]) not in claimed_keys:
+                    claimed_keys.add((row[4], row[3]))
+                    tasks.append(tuple(row[:4]))
+                    if len(tasks) == count:
+                        break
+            connection.executemany("""UPDATE work SET state='leased', lease_owner=?,
+                lease_expires=?, attempts=attempts+1 WHERE work_filename=? AND row_number=?""",
+                [(owner, now + self.lease_sec, task[0], task[1]) for task in tasks])
+        return tasks
+
+    def _expire_leases(self, connection, now):
+        """Leases nobody heartbeated count as a failed attempt"""
+        expired = connection.execute("""SELECT work_filename, row_number, stock_symbol,
+            which_country, lease_owner FROM work WHERE state='leased' AND lease_expires<?""",
+            (now,)).fetchall()
+        for work_filename, row_number, stock_symbol, which_country, lease_owner in expired:
+            print "  Lease of {} on {} expired".format(stock_symbol, lease_owner)
+            TALLY.add('work queue leases expired')
+            self._fail(connection, (work_filename, row_number, stock_symbol, which_country),
+                       'lease of {} expired'.format(lease_owner))
+
+    def heartbeat(self, owner):
+        """Extends every lease held by owner, returns how many it holds"""
+        with self._transaction() as connection:
+            return connection.execute("""UPDATE work SET lease_expires=? WHERE state='leased'
+                AND lease_owner=?""", (time.time() + self.lease_sec, owner)).rowcount
+
+    def complete(self, owner, task, stock_results_dict):
+        """Saves the results of a leased task, and of the pending listings of the same symbol.
+        False if owner lost the lease in between"""
+        result = json.dumps(stock_results_dict)
+        with self._transaction() as connection:
+            if connection.execute("""UPDATE work SET state='done', result=?, lease_owner=NULL,
+                    error=NULL WHERE work_filename=? AND row_number=? AND state='leased'
+                    AND lease_owner=?""", (result, task[0], task[1], owner)).rowcount != 1:
+                return False
+            key = symbol_key(task[2], task[3])[0]
+            listings = connection.execute("""UPDATE work SET state='done', result=?, error=NULL
+                WHERE state='pending' AND symbol_key=? AND which_country=?""",
+                (result, key, task[3])).rowcount
+        TALLY.add('duplicate symbols skipped', listings)
+        self.notify_workers()
+        return True
+
+    def fail(self, owner, task, error, stock_results_dict=None):
+        """Puts a leased task back for a retry, or gives it up after max_attempts with the
+        last stock_results_dict any attempt scraped, N/A results if none did.
+        False if owner lost the lease in between"""
+        with self._transaction() as connection:
+            held = connection.execute("""SELECT 1 FROM work WHERE work_filename=?
+                AND row_number=? AND state='leased' AND lease_owner=?""",
+                (task[0], task[1], owner)).fetchone()
+            if held:
+                self._fail(connection, task, error, stock_results_dict)
+        self.notify_workers()
+        return bool(held)
+
+    def _fail(self, connection, task, error, stock_results_dict=None):
+        attempts = connection.execute("""SELECT attempts FROM work WHERE work_filename=?
+            AND row_number=?""", (task[0], task[1])).fetchone()[0]
+        result = json.dumps(stock_results_dict) if stock_results_dict else None
+        if attempts < self.max_attempts:
+            TALLY.add('work queue retries')
+            connection.execute("""UPDATE work SET state='pending', lease_owner=NULL, error=?,
+                result=COALESCE(?, result) WHERE work_filename=? AND row_number=?""",
+                ('{}'.format(error), result, task[0], task[1]))
+        else:
+            print "  Giving up on {} after {} attempts".format(task[2], attempts)
+            TALLY.add('work queue symbols given up')
+            connection.execute("""UPDATE work SET state='failed', lease_owner=NULL,
+                result=COALESCE(?, result, ?), error=? WHERE work_filename=? AND row_number=?""",
+                (result, json.dumps({item: 'N/A' for item in RESULT_ORDER_LIST}),
+                 '{}'.format(error), task[0], task[1]))
+
+    def release(self, owner):
+        """Hands the leases of owner back without counting an attempt, eg on shutdown"""
+        with self._transaction() as connection:
+            released = connection.execute("""UPDATE work SET state='pending', lease_owner=NULL,
+                attempts=attempts-1 WHERE state='leased' AND lease_owner=?""", (owner,)).rowcount
+        self.notify_workers()
+        return released
+
+    def notify_workers(self):
+        """Wakes the workers of this process waiting in wait_for_change"""
+        with self._local_change:
+            self.local_changes += 1
+            self._local_change.notify_all()
+
+    def wait_for_change(self, local_changes, timeout):
+        """Waits up to timeout sec, while this process changed no symbol since local_changes
+        was read. Changes by other nodes are only seen once timeout is up"""
+        deadline = time.time() + timeout
+        with self._local_change:
+            while self.local_changes == local_changes and time.time() < deadline:
+                self._local_change.wait(deadline - time.time())
+
+    def counts(self):
+        """Number of symbols per state"""
+        with self._transaction() as connection:
+            counts = dict(connection.execute("SELECT state, COUNT(*) FROM work GROUP BY state"))
+        return {state: counts.get(state, 0) for state in self.STATES}
+
+    def export(self, results_dir_name):
+        """Writes the results file of every list whose rows are all done or given up and that
+        was not exported yet, rows in list order. Returns the results files written"""
+        results_fullpaths = []
+        with self._transaction() as connection:
+            finished = connection.execute("""SELECT work_filename FROM lists WHERE exported=0
+                AND NOT EXISTS (SELECT 1 FROM work WHERE work.work_filename=lists.work_filename
+                AND state IN ('pending', 'leased'))""").fetchall()
+            for (work_filename,) in finished:
+                results_file = StringIO.StringIO()
+                csv_writer = csv.writer(results_file, quoting=csv.QUOTE_ALL)
+                csv_writer.writerow(RESULT_ORDER_LIST)
+                for (result,) in connection.execute("""SELECT result FROM work
+                        WHERE work_filename=? ORDER BY row_number""", (work_filename,)):
+                    stock_results_dict = json.loads(result)
+                    csv_writer.writerow([_encode_result_cell(stock_results_dict[item])
+                                         for item in RESULT_ORDER_LIST])
+                if not os.path.exists(results_dir_name):
+                    os.makedirs(results_dir_name)
+                results_fullpath = '{}/result_{}'.format(results_dir_name, work_filename)
+                write_file_atomically(results_fullpath, results_file.getvalue())
+                connection.execute("UPDATE lists SET exported=1 WHERE work_filename=?",
+                                   (work_filename,))
+                results_fullpaths.append(results_fullpath)
+        return results_fullpaths
+
+def _encode_result_cell(value):
+    """Results come back from json as unicode, csv needs them as bytes"""
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+def work_queue_owner():
+    """Lease owner name of this node's process"""
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+def work_queue_report(work_queue):
+    """Summary of the symbols per state in the shared work queue"""
+    counts = work_queue.counts()
+    return 'Work queue: {done} done, {failed} given up, {pending} pending, ' \
+           '{leased} leased'.format(**counts)
+
+def _work_queue_worker(work_queue, owner, browser_pool, stop_event):
+    """Claims and scrapes symbols until the queue has none left or stop_event is set"""
+    while not stop_event.is_set():
+        local_changes = work_queue.local_changes
+        tasks = work_queue.claim(owner, WORK_QUEUE_CLAIM_BATCH)
+        if not tasks:
+            counts = work_queue.counts()
+            if not counts['pending'] and not counts['leased']:
+                return
+            # this node's other workers or other nodes hold the rest, a retry may come back
+            # or a lease expire
+            work_queue.wait_for_change(local_changes, WORK_QUEUE_POLL_SEC)
+            continue
+        for task in tasks:
+            if stop_event.is_set(): # the leases left are handed back on shutdown
+                break
+            work_filename, row_number, stock_symbol, which_country = task
+            print "  {} {}. {}".format(work_filename, row_number, stock_symbol)
+            try:
+                stock_results_dict = scrape_symbol(stock_symbol, which_country, browser_pool)
+            except TransientScrapeError as error:
+                print "   {}, trying again later".format(error)
+                work_queue.fail(owner, task, error, error.stock_results_dict)
+            except Exception as error:
+                print "  Could not scrape {}: {}".format(stock_symbol, error)
+                TALLY.add('scrape errors')
+                work_queue.fail(owner, task, error)
+            else:
+                if not work_queue.complete(owner, task, stock_results_dict):
+                    print "  Lease on {} was lost, dropping its results".format(stock_symbol)
+            sys.stdout.flush()
+
+def _heartbeat_leases(work_queue, owner, stop_event):
+    """Keeps the leases of owner alive until stop_event is set"""
+    while not stop_event.wait(work_queue.lease_sec / 3.0):
+        try:
+            work_queue.heartbeat(owner)
+        except sqlite3.Error as error:
+            print "  Could not heartbeat leases: {}".format(error)
+
+def process_work_queue(work_queue_fullpath, file_list, data_dir_name, logs_dir_name,
+                       results_dir_name, master_log_fullpath, num_workers=1,
+                       max_requests_per_sec=None, host_rate_limits=None):
+    """Feeds the lists in file_list to the shared WorkQueue at work_queue_fullpath and scrapes
+    symbols claimed from it with num_workers threads, until no symbols are left on any node.
+    Every node runs the same, exports the results files of finished lists"""
+    work_queue = WorkQueue(work_queue_fullpath)
+    for item in file_list:
+        try:
+            row_index = RowOffsetIndex('{}/{}'.format(data_dir_name, item),
+                                       row_index_fullpath(logs_dir_name, item))
+            print " Queued {} new symbols of {}".format(work_queue.feed(item, row_index), item)
+        except IOError:
+            with open(master_log_fullpath, 'a+') as master_log:
+                master_log.writelines('{} could not process: {}\n'.\
+                    format(datetime.datetime.now(), item))
+
+    owner = work_queue_owner()
+    print " Working the queue as", owner
+    set_rate_limit(max_requests_per_sec, host_rate_limits)
+    browser_pool = BrowserPool(num_workers)
+    stop_event = threading.Event()
+    heartbeat_thread = threading.Thread(target=_heartbeat_leases,
+                                        args=(work_queue, owner, stop_event))
+    heartbeat_thread.daemon = True
+    heartbeat_thread.start()
+    worker_threads = [threading.Thread(target=_work_queue_worker,
+                                       args=(work_queue, owner, browser_pool, stop_event))
+                      for _ in xrange(num_workers)]
+    try:
+        for worker_thread in worker_threads:
+            worker_thread.daemon = True
+            worker_thread.start()
+        for worker_thread in worker_threads:
+            while worker_thread.is_alive():
+                worker_thread.join(1) # wakes up for KeyboardInterrupt
+    finally:
+        stop_event.set()
+        work_queue.notify_workers()
+        for worker_thread in worker_threads:
+            worker_thread.join()
+        heartbeat_thread.join()
+        browser_pool.close()
+        if work_queue.release(owner):
+            print " Handed unfinished leases back to the queue"
+        for results_fullpath in work_queue.export(results_dir_name):
+            print "Completed", results_fullpath
+            finish_result_file(results_fullpath)
+            with open(master_log_fullpath, 'a+') as master_log:
+                master_log.writelines('{} finished: {}\n'.\
+                    format(datetime.datetime.now(), os.path.basename(results_fullpath)))
+        print work_queue_report(work_queue)
+        with open(master_log_fullpath, 'a+') as master_log:
+            master_log.writelines('{} {}\n'.format(datetime.datetime.now(),
+                                                   work_queue_report(work_queue)))
 
 def main():
     """Main function to call scraper"""
-    process_dir('data', 'logs', 'results')
+    process_dir('data', 'logs', 'results', NUM_WORKERS, WORKER_TYPE, MAX_REQUESTS_PER_SEC,
+                HOST_RATE_LIMITS, PAGE_CACHE_DIR, FULL_STATEMENTS, WORK_QUEUE_DB,
+                INCREMENTAL_REFRESH)
 
-main()
+if __name__ == '__main__':
+    main()
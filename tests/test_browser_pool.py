@@ -0,0 +1,160 @@
+"""Tests of the BrowserPool with a fake driver, run with python -m unittest discover tests"""
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import stock_scrape
+
+class FakeDriver(object):
+    """Stands in for a selenium session, dies on demand"""
+
+    def __init__(self):
+        self.alive = True
+        self.quit_count = 0
+        self.service = None
+
+    @property
+    def current_url(self):
+        if not self.alive:
+            raise IOError('session died')
+        return 'about:blank'
+
+    def quit(self):
+        self.quit_count += 1
+        self.alive = False
+
+class FakeService(object):
+    """Stands in for the selenium service, its process is the one measured for memory"""
+
+    def __init__(self, pid):
+        self.process = FakeProcess(pid)
+
+class FakeProcess(object):
+
+    def __init__(self, pid):
+        self.pid = pid
+
+class FakeDriverFactory(object):
+    """Browser factory of the pool, keeps every driver it started"""
+
+    def __init__(self):
+        self.drivers = []
+
+    def __call__(self):
+        self.drivers.append(FakeDriver())
+        return self.drivers[-1]
+
+class BrowserPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = FakeDriverFactory()
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w') # the pool's progress output
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+    def pool(self, size=1, **kwargs):
+        return stock_scrape.BrowserPool(size, self.factory, **kwargs)
+
+    def test_returned_session_is_reused(self):
+        browser_pool = self.pool(2)
+        first, second = browser_pool.acquire(), browser_pool.acquire()
+        self.assertIsNot(first, second)
+        browser_pool.release(first)
+        self.assertIs(browser_pool.acquire(), first)
+        self.assertEqual(len(self.factory.drivers), 2)
+
+    def test_acquire_waits_for_a_session_when_the_pool_is_full(self):
+        browser_pool = self.pool(1)
+        browser = browser_pool.acquire()
+        releaser = threading.Timer(0.1, browser_pool.release, [browser])
+        releaser.start()
+        start_time = time.time()
+        self.assertIs(browser_pool.acquire(), browser)
+        self.assertGreaterEqual(time.time() - start_time, 0.05)
+        releaser.join()
+        self.assertEqual(len(self.factory.drivers), 1)
+
+    def test_dead_session_is_replaced(self):
+        browser_pool = self.pool(1)
+        browser = browser_pool.acquire()
+        browser.alive = False
+        browser_pool.release(browser)
+        replacement = browser_pool.acquire()
+        self.assertIsNot(replacement, browser)
+        self.assertEqual(browser.quit_count, 1)
+
+    def test_session_that_died_while_idle_is_replaced(self):
+        browser_pool = self.pool(1)
+        browser = browser_pool.acquire()
+        browser_pool.release(browser)
+        browser.alive = False
+        self.assertIsNot(browser_pool.acquire(), browser)
+        self.assertEqual(len(self.factory.drivers), 2)
+
+    def test_failed_start_frees_its_slot(self):
+        browser_pool = stock_scrape.BrowserPool(1, lambda: 1 / 0)
+        self.assertRaises(ZeroDivisionError, browser_pool.acquire)
+        browser_pool.browser_factory = self.factory
+        self.assertIs(browser_pool.acquire(), self.factory.drivers[0])
+
+    def test_close_quits_idle_and_returned_sessions(self):
+        browser_pool = self.pool(2)
+        idle, borrowed = browser_pool.acquire(), browser_pool.acquire()
+        browser_pool.release(idle)
+        browser_pool.close()
+        self.assertEqual(idle.quit_count, 1)
+        self.assertEqual(borrowed.quit_count, 0)
+        browser_pool.release(borrowed)
+        self.assertEqual(borrowed.quit_count, 1)
+
+    def test_session_is_recycled_after_max_pages(self):
+        browser_pool = self.pool(1, max_pages=3)
+        browser = browser_pool.acquire()
+        for _ in range(2):
+            stock_scrape.count_page_served(browser)
+        browser_pool.release(browser)
+        self.assertIs(browser_pool.acquire(), browser)
+        stock_scrape.count_page_served(browser)
+        browser_pool.release(browser)
+        self.assertEqual(browser.quit_count, 1)
+        self.assertIsNot(browser_pool.acquire(), browser)
+
+    @unittest.skipUnless(os.path.isdir('/proc'), 'memory is read from /proc')
+    def test_session_is_recycled_over_max_rss(self):
+        small_pool, large_pool = self.pool(1, max_rss_mb=1), self.pool(1, max_rss_mb=1024 ** 2)
+        for browser_pool in small_pool, large_pool:
+            browser = browser_pool.acquire()
+            browser.service = FakeService(os.getpid()) # this test process, well over 1 MB
+            browser_pool.release(browser)
+        self.assertEqual([browser.quit_count for browser in self.factory.drivers], [1, 0])
+        self.assertIs(large_pool.acquire(), self.factory.drivers[1])
+
+class ScrapeOwnedBrowserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((name, getattr(stock_scrape, name))
+                          for name in ('initialize_fetcher', 'browser_load_url', 'EXCHANGE_CACHE'))
+        self.factory = FakeDriverFactory()
+        stock_scrape.initialize_fetcher = self.factory
+        stock_scrape.EXCHANGE_CACHE = None
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(stock_scrape, name, value)
+
+    def test_owned_browser_is_quit_when_scrape_raises(self):
+        def failed_load(browser, url, ready_xpath=None):
+            raise IOError('page failed')
+        stock_scrape.browser_load_url = failed_load
+        self.assertRaises(IOError, stock_scrape.scrape, 'AAPL', 'USA')
+        self.assertEqual(self.factory.drivers[0].quit_count, 1)
+
+if __name__ == '__main__':
+    unittest.main()
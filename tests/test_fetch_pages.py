@@ -0,0 +1,58 @@
+"""Tests of the fetch_pages pipeline against fake_finance_server.py with injected latency,
+run with python -m unittest discover tests"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import stock_scrape
+import fake_finance_server
+
+LATENCY = 0.2 # sec the fake server takes for every page
+LISTINGS = dict(('SYM{}'.format(number), 'NASDAQ') for number in xrange(8))
+
+class FetchPagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fake_finance_server.FakeFinanceServer(LISTINGS, latency=LATENCY).start()
+        self.saved = dict((name, getattr(stock_scrape, name))
+                          for name in ('BASE_URL', 'PAGE_CACHE', 'RATE_LIMITER'))
+        stock_scrape.BASE_URL = self.server.base_url
+        stock_scrape.PAGE_CACHE = None
+        stock_scrape.RATE_LIMITER = None
+        self.url_list = [stock_scrape.return_base_url(symbol, 'NASDAQ')
+                         for symbol in sorted(LISTINGS)]
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(stock_scrape, name, value)
+        self.server.stop()
+
+    def fetch(self, max_in_flight):
+        """Fetches url_list, returns the seconds it took"""
+        start_time = time.time()
+        results = list(stock_scrape.fetch_pages(self.url_list, max_in_flight))
+        elapsed = time.time() - start_time
+        self.assertEqual(sorted(url_string for url_string, _, _ in results),
+                         sorted(self.url_list))
+        for url_string, page_source, error in results:
+            self.assertIsNone(error)
+            self.assertIn(url_string.split('%3A')[-1], page_source)
+        return elapsed
+
+    def test_overlapping_requests_beat_serial_ones(self):
+        serial_sec = self.fetch(1)
+        overlapped_sec = self.fetch(len(self.url_list))
+        self.assertGreaterEqual(serial_sec, LATENCY * len(self.url_list))
+        self.assertLess(overlapped_sec, serial_sec / 3)
+
+    def test_rate_limit_holds_with_requests_in_flight(self):
+        stock_scrape.set_rate_limit(20, burst=1) # one page every 0.05 sec after the first
+        elapsed = self.fetch(len(self.url_list))
+        self.assertGreaterEqual(elapsed, (len(self.url_list) - 1) / 20.0)
+        self.assertLess(elapsed, LATENCY * len(self.url_list))
+
+if __name__ == '__main__':
+    unittest.main()
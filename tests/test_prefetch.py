@@ -0,0 +1,102 @@
+"""Tests of the Prefetcher against fake_finance_server.py, run with
+python -m unittest discover tests"""
+
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import stock_scrape
+import fake_finance_server
+
+LISTINGS = {'AAA': 'NASDAQ', 'BBB': 'NYSE', 'CCC': 'NASDAQ', 'DDD': 'NYSE', 'EEE': 'NASDAQ'}
+
+class RecordingBrowser(stock_scrape.HttpFetcher):
+    """Stands in for Firefox, records the urls it loaded itself"""
+
+    def __init__(self, loaded_urls):
+        stock_scrape.HttpFetcher.__init__(self)
+        self.loaded_urls = loaded_urls
+
+    def get(self, url_string):
+        self.loaded_urls.append(url_string)
+        stock_scrape.HttpFetcher.get(self, url_string)
+
+class PrefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir_name = tempfile.mkdtemp(prefix='test_prefetch_')
+        os.makedirs(os.path.join(self.work_dir_name, 'data'))
+        with open(os.path.join(self.work_dir_name, 'data', 'symbols.csv'), 'w') as list_file:
+            list_file.write('Symbol\n' + ''.join(symbol + '\n' for symbol in sorted(LISTINGS)))
+        self.server = fake_finance_server.FakeFinanceServer(LISTINGS).start()
+        self.saved = dict((name, getattr(stock_scrape, name))
+                          for name in ('BASE_URL', 'FETCHER_TYPE', 'PREFETCH_DEPTH',
+                                       'PREFETCHER', 'initialize_browser'))
+        stock_scrape.BASE_URL = self.server.base_url
+        stock_scrape.PREFETCH_DEPTH = 4
+        self.loaded_urls = []
+        stock_scrape.initialize_browser = lambda: RecordingBrowser(self.loaded_urls)
+        self.prefetcher_calls = []
+        self.saved_prefetcher_get = stock_scrape.Prefetcher.get
+        def recording_get(prefetcher, url_string):
+            self.prefetcher_calls.append(url_string)
+            return self.saved_prefetcher_get(prefetcher, url_string)
+        stock_scrape.Prefetcher.get = recording_get
+
+    def tearDown(self):
+        stock_scrape.Prefetcher.get = self.saved_prefetcher_get
+        for name, value in self.saved.items():
+            setattr(stock_scrape, name, value)
+        self.server.stop()
+        shutil.rmtree(self.work_dir_name, True)
+
+    def process_dir(self):
+        """Scrapes the list sequentially, returns the result rows"""
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w') # the scraper's progress output
+        try:
+            stock_scrape.process_dir(os.path.join(self.work_dir_name, 'data'),
+                                     os.path.join(self.work_dir_name, 'logs'),
+                                     os.path.join(self.work_dir_name, 'results'))
+        finally:
+            sys.stdout = stdout
+        with open(os.path.join(self.work_dir_name, 'results', 'result_symbols.csv')) as results:
+            return list(csv.DictReader(results))
+
+    def test_selenium_never_reads_prefetched_pages(self):
+        stock_scrape.FETCHER_TYPE = 'selenium'
+        pages_prefetched = stock_scrape.TALLY.snapshot().get('pages prefetched', 0)
+        rows = self.process_dir()
+        self.assertEqual(sorted(row['Stock Symbol'] for row in rows), sorted(LISTINGS))
+        self.assertEqual(self.prefetcher_calls, [])
+        self.assertEqual(stock_scrape.TALLY.snapshot().get('pages prefetched', 0),
+                         pages_prefetched)
+        # the browser loaded every financials page itself
+        self.assertEqual(sorted(url_string.split('%3A')[-1].split('&')[0]
+                                for url_string in self.loaded_urls if 'fstype=ii' in url_string),
+                         sorted(LISTINGS))
+
+    def test_http_reads_prefetched_pages(self):
+        stock_scrape.FETCHER_TYPE = 'http'
+        pages_used = stock_scrape.TALLY.snapshot().get('prefetched pages used', 0)
+        rows = self.process_dir()
+        self.assertEqual(sorted(row['Stock Symbol'] for row in rows), sorted(LISTINGS))
+        self.assertTrue(self.prefetcher_calls)
+        self.assertGreater(stock_scrape.TALLY.snapshot().get('prefetched pages used', 0),
+                           pages_used)
+
+    def test_initialize_fetcher_does_not_wrap_a_browser_in_the_prefetcher(self):
+        stock_scrape.PREFETCHER = stock_scrape.Prefetcher(depth=1)
+        try:
+            browser = stock_scrape.initialize_fetcher('selenium')
+            self.assertIsInstance(browser, RecordingBrowser)
+            browser.quit()
+        finally:
+            stock_scrape.PREFETCHER.close()
+
+if __name__ == '__main__':
+    unittest.main()
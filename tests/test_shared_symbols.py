@@ -0,0 +1,77 @@
+"""Tests of symbols listed in more than one list against fake_finance_server.py, run with
+python -m unittest discover tests"""
+
+import csv
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import stock_scrape
+import fake_finance_server
+
+LISTINGS = {'AAA': 'NASDAQ', 'BBB': 'NYSE', 'CCC': 'NASDAQ'}
+# the fake server, like the scraper, only knows the upper case tickers
+LISTS = {'index.csv': ['aaa', 'BBB', 'ccc'], 'us.csv': ['AAA', 'BBB', 'CCC', 'DDD']}
+
+class MixedCaseListingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir_name = tempfile.mkdtemp(prefix='test_shared_symbols_')
+        os.makedirs(os.path.join(self.work_dir_name, 'data'))
+        for filename, symbols in LISTS.items():
+            with open(os.path.join(self.work_dir_name, 'data', filename), 'w') as list_file:
+                list_file.write('Symbol\n' + ''.join(symbol + '\n' for symbol in symbols))
+        self.server = fake_finance_server.FakeFinanceServer(LISTINGS).start()
+        self.saved = dict((name, getattr(stock_scrape, name))
+                          for name in ('BASE_URL', 'FETCHER_TYPE', 'SCRAPE_MAX_ATTEMPTS'))
+        stock_scrape.BASE_URL = self.server.base_url
+        stock_scrape.FETCHER_TYPE = 'http'
+        stock_scrape.SCRAPE_MAX_ATTEMPTS = 1
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(stock_scrape, name, value)
+        self.server.stop()
+        shutil.rmtree(self.work_dir_name, True)
+
+    def process_dir(self, num_workers, work_queue=False):
+        """Scrapes both lists, returns the exchange of every row per results file"""
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w') # the scraper's progress output
+        try:
+            stock_scrape.process_dir(
+                os.path.join(self.work_dir_name, 'data'), os.path.join(self.work_dir_name, 'logs'),
+                os.path.join(self.work_dir_name, 'results'), num_workers,
+                work_queue_fullpath=os.path.join(self.work_dir_name, 'queue.db')
+                if work_queue else None)
+        finally:
+            sys.stdout = stdout
+        exchanges = dict()
+        for filename in LISTS:
+            with open(os.path.join(self.work_dir_name, 'results',
+                                   'result_' + filename)) as results_file:
+                exchanges[filename] = [row['Exchange'] for row in csv.DictReader(results_file)]
+        return exchanges
+
+    def assert_listings_kept_apart(self, exchanges):
+        self.assertEqual(exchanges['us.csv'], ['NASDAQ', 'NYSE', 'NASDAQ', 'N/A'])
+        self.assertEqual(exchanges['index.csv'], ['N/A', 'NYSE', 'N/A'])
+
+    def test_sequential(self):
+        self.assert_listings_kept_apart(self.process_dir(1))
+
+    def test_threads(self):
+        self.assert_listings_kept_apart(self.process_dir(2))
+
+    def test_work_queue(self):
+        self.assert_listings_kept_apart(self.process_dir(2, work_queue=True))
+
+    def test_symbol_key_keeps_case(self):
+        self.assertNotEqual(stock_scrape.symbol_key('abc'), stock_scrape.symbol_key('ABC'))
+        self.assertEqual(stock_scrape.symbol_key(' DD^B ', 'Canada'), ('DD-B', 'Canada'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+"""Tests of the shared SQLite WorkQueue, run with python -m unittest discover tests"""
+
+import csv
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import stock_scrape
+import fake_finance_server
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir_name = tempfile.mkdtemp(prefix='test_work_queue_')
+        self.queue_fullpath = os.path.join(self.work_dir_name, 'queue.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir_name, True)
+
+    def work_queue(self, lists, **kwargs):
+        """WorkQueue fed with lists, a dict of list filename -> symbols"""
+        work_queue = stock_scrape.WorkQueue(self.queue_fullpath, **kwargs)
+        for filename, symbols in sorted(lists.items()):
+            work_fullpath = os.path.join(self.work_dir_name, filename)
+            with open(work_fullpath, 'w') as list_file:
+                list_file.write('Symbol\n' + ''.join(symbol + '\n' for symbol in symbols))
+            work_queue.feed(filename, stock_scrape.RowOffsetIndex(
+                work_fullpath, os.path.join(self.work_dir_name, 'index_' + filename)))
+        return work_queue
+
+    def results(self, symbol, name='done'):
+        results_dict = {item: 'N/A' for item in stock_scrape.RESULT_ORDER_LIST}
+        results_dict.update({'Stock Symbol': symbol, 'Stock Name': name})
+        return results_dict
+
+    def test_claim_and_complete(self):
+        work_queue = self.work_queue({'a.csv': ['AAA', 'BBB'], 'b.csv': ['BBB', 'CCC']})
+        tasks = work_queue.claim('node1', 10)
+        # rows of both lists in row order, the second listing of BBB is left for its results
+        self.assertEqual(tasks, [('a.csv', 1, 'AAA', 'USA'), ('b.csv', 1, 'BBB', 'USA'),
+                                 ('b.csv', 2, 'CCC', 'USA')])
+        self.assertEqual(work_queue.claim('node2', 10), [])
+        for task in tasks:
+            self.assertTrue(work_queue.complete('node1', task, self.results(task[2])))
+        self.assertEqual(work_queue.counts(),
+                         {'done': 4, 'failed': 0, 'pending': 0, 'leased': 0})
+        self.assertFalse(work_queue.complete('node2', tasks[0], self.results('AAA')))
+
+    def test_expired_lease_is_claimed_again(self):
+        work_queue = self.work_queue({'a.csv': ['AAA']}, lease_sec=0.05)
+        task, = work_queue.claim('lost node')
+        time.sleep(0.1)
+        self.assertEqual(work_queue.claim('node2'), [task])
+        self.assertFalse(work_queue.complete('lost node', task, self.results('AAA')))
+        self.assertTrue(work_queue.complete('node2', task, self.results('AAA')))
+
+    def test_heartbeat_keeps_the_lease(self):
+        work_queue = self.work_queue({'a.csv': ['AAA']}, lease_sec=0.2)
+        work_queue.claim('node1')
+        for _ in xrange(3):
+            time.sleep(0.1)
+            self.assertEqual(work_queue.heartbeat('node1'), 1)
+        self.assertEqual(work_queue.claim('node2'), [])
+
+    def test_failed_symbol_is_given_up_after_max_attempts(self):
+        work_queue = self.work_queue({'a.csv': ['AAA']}, max_attempts=2)
+        task, = work_queue.claim('node1')
+        work_queue.fail('node1', task, 'pages did not load', self.results('AAA', 'partial'))
+        self.assertEqual(work_queue.claim('node1'), [task])
+        work_queue.fail('node1', task, 'pages did not load again')
+        self.assertEqual(work_queue.claim('node1'), [])
+        self.assertEqual(work_queue.counts()['failed'], 1)
+        # the row keeps what an attempt scraped
+        results_fullpath, = work_queue.export(self.work_dir_name)
+        with open(results_fullpath) as results_file:
+            row, = csv.DictReader(results_file)
+        self.assertEqual(row['Stock Name'], 'partial')
+
+    def test_export_in_list_order_once_every_row_is_in(self):
+        work_queue = self.work_queue({'a.csv': ['AAA', 'BBB', 'CCC']})
+        tasks = work_queue.claim('node1', 3)
+        for task in reversed(tasks[1:]):
+            work_queue.complete('node1', task, self.results(task[2]))
+        self.assertEqual(work_queue.export(self.work_dir_name), [])
+        work_queue.complete('node1', tasks[0], self.results(tasks[0][2]))
+        results_fullpath, = work_queue.export(self.work_dir_name)
+        with open(results_fullpath) as results_file:
+            self.assertEqual([row['Stock Symbol'] for row in csv.DictReader(results_file)],
+                             ['AAA', 'BBB', 'CCC'])
+        self.assertEqual(work_queue.export(self.work_dir_name), [])
+
+    def test_release_hands_leases_back_without_an_attempt(self):
+        work_queue = self.work_queue({'a.csv': ['AAA']}, max_attempts=1)
+        task, = work_queue.claim('node1')
+        self.assertEqual(work_queue.release('node1'), 1)
+        self.assertEqual(work_queue.claim('node2'), [task])
+
+    def test_wait_for_change_wakes_on_a_local_change(self):
+        work_queue = self.work_queue({'a.csv': ['AAA']})
+        task, = work_queue.claim('node1')
+        local_changes = work_queue.local_changes
+        work_queue.complete('node1', task, self.results('AAA'))
+        start_time = time.time()
+        work_queue.wait_for_change(local_changes, 10)
+        self.assertLess(time.time() - start_time, 1)
+
+class WorkQueueRunTest(unittest.TestCase):
+
+    def test_single_node_run_does_not_wait_for_the_poll(self):
+        listings = dict(('SYM{}'.format(number), 'NASDAQ') for number in xrange(12))
+        work_dir_name = tempfile.mkdtemp(prefix='test_work_queue_run_')
+        server = fake_finance_server.FakeFinanceServer(listings, latency=0.05).start()
+        saved = dict((name, getattr(stock_scrape, name)) for name in ('BASE_URL', 'FETCHER_TYPE'))
+        stock_scrape.BASE_URL = server.base_url
+        stock_scrape.FETCHER_TYPE = 'http'
+        stdout = sys.stdout
+        try:
+            os.makedirs(os.path.join(work_dir_name, 'data'))
+            with open(os.path.join(work_dir_name, 'data', 'a.csv'), 'w') as list_file:
+                list_file.write('Symbol\n' + ''.join(symbol + '\n' for symbol in sorted(listings)))
+            sys.stdout = open(os.devnull, 'w') # the scraper's progress output
+            start_time = time.time()
+            stock_scrape.process_dir(os.path.join(work_dir_name, 'data'),
+                                     os.path.join(work_dir_name, 'logs'),
+                                     os.path.join(work_dir_name, 'results'), 4,
+                                     work_queue_fullpath=os.path.join(work_dir_name, 'q.db'))
+            elapsed = time.time() - start_time
+        finally:
+            sys.stdout = stdout
+            for name, value in saved.items():
+                setattr(stock_scrape, name, value)
+            server.stop()
+        with open(os.path.join(work_dir_name, 'results', 'result_a.csv')) as results_file:
+            self.assertEqual(len(list(csv.DictReader(results_file))), len(listings))
+        shutil.rmtree(work_dir_name, True)
+        self.assertLess(elapsed, stock_scrape.WORK_QUEUE_POLL_SEC)
+
+if __name__ == '__main__':
+    unittest.main()